@@ -7,7 +7,10 @@ import asyncio
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__))))
 
-from sd_model_manager.db import DB
+from sd_model_manager.db import DB, setup_db
+from sd_model_manager.jobs import setup_jobs
+from sd_model_manager.watcher import setup_watcher
+from sd_model_manager.hashing import setup_hashing
 from sd_model_manager.api.views import routes as api_routes
 from sd_model_manager.utils.common import get_config
 
@@ -40,11 +43,32 @@ async def initialize_comfyui():
     app = prompt_server.app
     app["sdmm_config"] = get_config([])
 
-    db = DB()
-    await db.init(app["sdmm_config"].model_paths)
-    # await db.scan(app["sdmm_config"].model_paths)
+    db = DB(
+        scan_workers=app["sdmm_config"].scan_workers,
+        scan_processes=app["sdmm_config"].scan_processes,
+        journal_mode=app["sdmm_config"].db_journal_mode,
+        synchronous=app["sdmm_config"].db_synchronous,
+        mmap_size=app["sdmm_config"].db_mmap_size * 1024 * 1024,
+        cache_size=app["sdmm_config"].db_cache_size * 1024 * 1024,
+        readers=app["sdmm_config"].db_readers,
+        result_cache_size=app["sdmm_config"].result_cache_size * 1024 * 1024,
+        memory_index=app["sdmm_config"].memory_index,
+    )
     app["sdmm_db"] = db
 
+    # This coroutine runs on a throwaway event loop, so set up the database
+    # on the server's own loop once it starts. Any scan then runs in the
+    # background instead of holding up ComfyUI's startup.
+    async def init_db(app):
+        config = app["sdmm_config"]
+        await db.init(config.model_paths, rescan=config.rescan)
+
+    app.on_startup.append(init_db)
+    setup_jobs(app)
+    setup_watcher(app)
+    setup_hashing(app)
+    setup_db(app)
+
     print("[SD-Model-Manager] Initialized via ComfyUI server.")
 
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Checks the headers and hashes computed by safetensors_hack against the
+safetensors library.
+
+    python benchmarks/check_hashes.py
+
+Each case writes a model with the library, then compares `save`'s header
+with the library's and `hash_model`'s hashes with ones worked out the way
+sd-webui-additional-networks does, by re-saving the tensors with only the
+`ss_` metadata. Uses `safetensors.torch` if torch is installed, and
+`safetensors.numpy`, which shares its serializer, otherwise.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), "../..")))
+
+from sd_model_manager.utils import safetensors_hack
+
+
+try:
+    import torch
+    import safetensors.torch
+
+    def reference_save(tensors, metadata):
+        tensors = {name: torch.from_numpy(t) for name, t in tensors.items()}
+        return safetensors.torch.save(tensors, metadata)
+
+    def reference_load(data):
+        return {name: t.numpy() for name, t in safetensors.torch.load(data).items()}
+
+except ModuleNotFoundError:
+    import safetensors.numpy
+
+    def reference_save(tensors, metadata):
+        return safetensors.numpy.save(tensors, metadata)
+
+    def reference_load(data):
+        return safetensors.numpy.load(data)
+
+
+def reference_hashes(data):
+    n = int.from_bytes(data[:8], "little")
+    header = json.loads(data[8 : 8 + n])
+    metadata = header.pop("__metadata__", {})
+
+    legacy = data
+    if not all(k.startswith("ss_") for k in metadata):
+        tensors = reference_load(data)
+        metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+        legacy = reference_save(tensors, metadata)
+
+    def window(b):
+        offset = safetensors_hack.LEGACY_HASH_OFFSET
+        return hashlib.sha256(b[offset : offset + safetensors_hack.LEGACY_HASH_SIZE])
+
+    return {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "model_hash": hashlib.sha256(data[8 + n :]).hexdigest(),
+        "legacy_hash": window(legacy).hexdigest()[0:8],
+        "autov1": window(data).hexdigest()[0:8],
+    }
+
+
+def make_tensors(size):
+    rng = np.random.default_rng(0)
+    return {
+        "lora_te.weight": rng.standard_normal(size // 4, dtype=np.float32),
+        "lora_unet.weight": rng.standard_normal(size // 8).astype(np.float16),
+        "lora_unet.alpha": np.array(4.0, dtype=np.float32),
+    }
+
+
+def tag_frequency(tags):
+    return json.dumps({"1_dataset": tags}, ensure_ascii=False)
+
+
+LARGE_TAG_FREQUENCY = tag_frequency({f"tag_{i}_{'x' * 40}": i for i in range(100000)})
+
+CASES = {
+    "ascii": {"ss_network_dim": "32", "ssmd_display_name": "Test"},
+    "non-ascii": {
+        "ss_tag_frequency": tag_frequency({"青い髪": 3, "café": 1}),
+        "ss_network_dim": "32",
+        "ssmd_display_name": "テスト",
+    },
+    "training metadata only": {"ss_network_dim": "32", "ss_network_alpha": "16"},
+    # Headers larger than a read in hash_model
+    "large header": {"ss_tag_frequency": LARGE_TAG_FREQUENCY},
+    "large header, user metadata": {
+        "ss_tag_frequency": LARGE_TAG_FREQUENCY,
+        "ssmd_author": "someone",
+    },
+}
+
+
+def main():
+    failed = 0
+    tensors = make_tensors(3 * 1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, metadata in CASES.items():
+            data = reference_save(tensors, metadata)
+            path = os.path.join(tmp, "model.safetensors")
+            with open(path, "wb") as f:
+                f.write(data)
+
+            # Metadata keys come out in a different order, so only the
+            # header's length and the data after it can be compared
+            errors = []
+            ours = safetensors_hack.save(tensors, metadata)
+            n = int.from_bytes(data[:8], "little")
+            if ours[:8] != data[:8] or ours[8 + n :] != data[8 + n :]:
+                errors.append("save() header length or tensor data differs")
+
+            expected = reference_hashes(data)
+            got = safetensors_hack.hash_model(path)
+            for key, value in expected.items():
+                if got[key] != value:
+                    errors.append(f"{key}: expected {value}, got {got[key]}")
+
+            print(f"{name:>30}: {'ok' if not errors else 'FAILED'}")
+            for error in errors:
+                print(f"{'':>32}{error}")
+            failed += bool(errors)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Times API reads and edits while a scan is writing to the database.
+
+    python benchmarks/concurrency.py --existing 20000 --count 20000
+
+Each run scans `existing` models into a fresh database, then scans another
+`count` new ones while one task pages through the model list the way the
+GUI does and another edits models the way PATCH /api/v1/lora/{id} does. This
+is repeated for each storage profile: the rollback journal SQLite uses by
+default, which is what the database used to run with, and WAL.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), "../..")))
+
+from scan import make_library
+
+
+PROFILES = {
+    "rollback": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "mmap_size": 0,
+        "cache_size": 2 * 1024 * 1024,
+    },
+    "wal": {},
+}
+
+
+def summarize(latencies):
+    if not latencies:
+        return 0.0, 0.0, 0.0
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statistics.median(latencies), p95, latencies[-1]
+
+
+async def run(profile, args):
+    from sqlalchemy import select, update
+    from sqlalchemy.orm import selectin_polymorphic
+    from sqlakeyset.asyncio import select_page
+
+    from sd_model_manager.models.sd_models import SDModel, LoRAModel
+
+    with tempfile.TemporaryDirectory() as tmp:
+        existing = os.path.join(tmp, "existing")
+        new = os.path.join(tmp, "new")
+        random.seed(0)
+        make_library(existing, args.existing)
+        make_library(new, args.count)
+
+        from sd_model_manager import db as db_module
+
+        db_module.DATABASE_NAME = os.path.join(tmp, "model_database")
+        db_module.HEADER_CACHE_NAME = os.path.join(tmp, "header_cache")
+        db = db_module.DB(scan_workers=args.workers, **PROFILES[profile])
+        await db.init([existing, new])
+        await db.scan([existing])
+
+        reads = []
+        edits = []
+        errors = 0
+        done = asyncio.Event()
+
+        async def read():
+            nonlocal errors
+            while not done.is_set():
+                query = (
+                    select(LoRAModel)
+                    .options(selectin_polymorphic(SDModel, [LoRAModel]))
+                    .order_by(SDModel.id)
+                )
+                start = time.perf_counter()
+                try:
+                    async with db.AsyncSession() as session:
+                        await select_page(session, query, per_page=100)
+                except Exception:
+                    errors += 1
+                reads.append(time.perf_counter() - start)
+                await asyncio.sleep(args.interval)
+
+        async def edit():
+            nonlocal errors
+            while not done.is_set():
+                id = random.randrange(1, args.existing + 1)
+
+                async def write(session):
+                    await session.execute(
+                        update(SDModel)
+                        .where(SDModel.id == id)
+                        .values(rating=random.randrange(1, 10))
+                    )
+
+                start = time.perf_counter()
+                try:
+                    await db.write(write)
+                except Exception:
+                    errors += 1
+                edits.append(time.perf_counter() - start)
+                await asyncio.sleep(args.interval)
+
+        # Reads with nothing else going on, for comparison
+        readers = [asyncio.create_task(read()) for _ in range(args.readers)]
+        await asyncio.sleep(args.idle)
+        done.set()
+        await asyncio.gather(*readers)
+        idle, reads = reads, []
+        done.clear()
+
+        readers = [asyncio.create_task(read()) for _ in range(args.readers)]
+        editor = asyncio.create_task(edit())
+
+        start = time.perf_counter()
+        await db.scan([new])
+        scan = time.perf_counter() - start
+
+        done.set()
+        await asyncio.gather(*readers, editor)
+        await db.close()
+
+    return scan, idle, reads, edits, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--existing", type=int, default=20000)
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument(
+        "--interval", type=float, default=0.01, help="Seconds between requests"
+    )
+    parser.add_argument(
+        "--idle", type=float, default=2, help="Seconds of reads timed before the scan"
+    )
+    parser.add_argument(
+        "--profiles", type=str, nargs="+", default=list(PROFILES), choices=PROFILES
+    )
+    args = parser.parse_args()
+
+    results = []
+    for profile in args.profiles:
+        results.append((profile, *asyncio.run(run(profile, args))))
+
+    print()
+    print(
+        f"{'profile':>10} {'idle read p50/p95 (ms)':>22} {'scan (s)':>9} {'reads':>6} "
+        f"{'read p50/p95/max (ms)':>22} "
+        f"{'edits':>6} {'edit p50/p95/max (ms)':>22} {'errors':>7}"
+    )
+    for profile, scan, idle, reads, edits, errors in results:
+        idle_ms = "/".join(f"{t * 1000:.0f}" for t in summarize(idle)[:2])
+        read_ms = "/".join(f"{t * 1000:.0f}" for t in summarize(reads))
+        edit_ms = "/".join(f"{t * 1000:.0f}" for t in summarize(edits))
+        print(
+            f"{profile:>10} {idle_ms:>22} {scan:>9.2f} {len(reads):>6} {read_ms:>22} "
+            f"{len(edits):>6} {edit_ms:>22} {errors:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Times DB.scan against a synthetic LoRA library.
+
+    python benchmarks/scan.py --count 10000 50000 100000
+
+Each run writes `count` small .safetensors files with realistic sd-scripts
+metadata into a temporary directory, then times an initial scan into a fresh
+database followed by a rescan where nothing changed.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), "../..")))
+
+
+def make_metadata(i):
+    tags = {
+        f"tag_{random.randrange(5000)}": random.randrange(1, 100) for _ in range(50)
+    }
+    return {
+        "ss_session_id": str(random.randrange(2**31)),
+        "ss_training_started_at": str(1680000000 + i),
+        "ss_output_name": f"model_{i}",
+        "ss_learning_rate": "0.0001",
+        "ss_text_encoder_lr": "5e-05",
+        "ss_unet_lr": "0.0001",
+        "ss_num_train_images": str(random.randrange(10, 500)),
+        "ss_num_epochs": "10",
+        "ss_network_module": "networks.lora",
+        "ss_network_dim": str(random.choice([8, 16, 32, 64, 128])),
+        "ss_network_alpha": str(random.choice([1.0, 4.0, 8.0])),
+        "ss_resolution": "(512, 512)",
+        "ss_optimizer": "bitsandbytes.optim.adamw.AdamW8bit(weight_decay=0.1)",
+        "ss_tag_frequency": json.dumps({"1_dataset": tags}),
+        "ss_dataset_dirs": json.dumps(
+            {"1_dataset": {"n_repeats": 1, "img_count": 100}}
+        ),
+        "sshs_model_hash": "%064x" % random.randrange(2**256),
+    }
+
+
+def write_model(path, metadata):
+    tensor = bytes(64)
+    header = {
+        "__metadata__": metadata,
+        "lora_unet_down.weight": {
+            "dtype": "F16",
+            "shape": [4, 8],
+            "data_offsets": [0, len(tensor)],
+        },
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        f.write(tensor)
+
+
+def make_library(root, count, per_dir=500):
+    for i in range(count):
+        d = os.path.join(root, f"dir_{i // per_dir}")
+        if i % per_dir == 0:
+            os.makedirs(d, exist_ok=True)
+        write_model(os.path.join(d, f"model_{i}.safetensors"), make_metadata(i))
+
+
+async def run(count, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "loras")
+        make_library(root, count)
+
+        os.environ["DATABASE_NAME"] = os.path.join(tmp, "model_database")
+        from sd_model_manager import db as db_module
+
+        db_module.DATABASE_NAME = os.environ["DATABASE_NAME"]
+        db_module.HEADER_CACHE_NAME = os.path.join(tmp, "header_cache")
+
+        db = db_module.DB(scan_workers=args.workers, scan_processes=args.processes)
+
+        await db.init([root])
+
+        start = time.perf_counter()
+        await db.scan([root])
+        initial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await db.scan([root])
+        rescan = time.perf_counter() - start
+
+        await db.close()
+
+    return initial, rescan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--processes", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.count:
+        results.append((count, *asyncio.run(run(count, args))))
+
+    print()
+    print(f"{'models':>10} {'scan (s)':>10} {'models/s':>10} {'rescan (s)':>11}")
+    for count, initial, rescan in results:
+        print(f"{count:>10} {initial:>10.2f} {count / initial:>10.0f} {rescan:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
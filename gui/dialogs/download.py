@@ -333,6 +333,8 @@ class PreviewGeneratorDialog(wx.Dialog):
         result = await self.app.api.update_lora(item["id"], changes)
         print(result)
         item["preview_images"] = new_images
+        item["preview_count"] = len(new_images)
+        item["cover_image"] = new_images[0]["filepath"] if new_images else None
 
         try_load_image.cache_clear()
         await self.app.frame.results_panel.refresh_one_item(item)
@@ -1,6 +1,5 @@
 import os
 import subprocess
-import re
 import io
 import asyncio
 import aiopubsub
@@ -11,7 +10,8 @@ import wx
 import wx.aui
 import wx.lib.newevent
 
-from sd_model_manager.utils.common import find_image, try_load_image
+from sd_model_manager.utils.common import try_load_image
+from sd_model_manager.utils.previews import find_image
 
 
 PROGRAM_ROOT = os.path.dirname(
@@ -42,15 +42,10 @@ def load_bitmap(path):
 
 def find_image_for_model(item):
     image = None
-    image_path = None
+    image_path = item.get("cover_image")
 
-    image_paths = item["preview_images"]
-    if len(image_paths) > 0:
-        for path in image_paths:
-            image = try_load_image(path["filepath"])
-            if image is not None:
-                image_path = path["filepath"]
-                break
+    if image_path is not None:
+        image = try_load_image(image_path)
 
     if image is None:
         filepath = item["filepath"]
@@ -60,13 +55,9 @@ def find_image_for_model(item):
 
 
 def find_image_path_for_model(item):
-    image_path = None
-
-    image_paths = item["preview_images"]
-    if len(image_paths) > 0:
-        for path in image_paths:
-            if os.path.isfile(path["filepath"]):
-                return path["filepath"]
+    image_path = item.get("cover_image")
+    if image_path is not None and os.path.isfile(image_path):
+        return image_path
 
     filepath = item["filepath"]
     _, image_path = find_image(filepath, load=False)
@@ -137,61 +128,27 @@ def format_rating(rating):
     return "\u2605" * int(rating / 2) + "\u00BD" * int(rating % 2 != 0)
 
 
-re_optimizer = re.compile(r"([^.]+)(\(.*\))?$")
-
-
-def format_optimizer(m):
-    optimizer = m["optimizer"]
-    if optimizer is None:
-        return None
-
-    matches = re_optimizer.search(optimizer)
-    if matches is None:
-        return optimizer
-    return matches[1]
-
-
-def format_optimizer_args(m):
-    optimizer = m["optimizer"]
-    if optimizer is None:
-        return None
-
-    matches = re_optimizer.search(optimizer)
-    if matches is None or matches[2] is None:
-        return None
-    return matches[2].lstrip("(").rstrip(")")
-
-    # result = {}
-    # for pair in args.split(","):
-    #     spl = pair.split("=", 1)
-    #     if len(spl) > 1:
-    #         result[spl[0]] = spl[1]
-
-    # return str(result)
-
-
-def format_network_alpha(v):
-    try:
-        return int(float(v))
-    except Exception:
-        try:
-            return float(v)
-        except Exception:
-            return v
+def format_network_size(m, key):
+    value = m.get(f"{key}_value")
+    if value is None:
+        return m[key]
+    if value.is_integer():
+        return int(value)
+    return value
 
 
-def format_shorthash(m):
-    hash = m.get("model_hash")
-    if hash is None:
+def format_file_size(m):
+    size = m.get("file_size")
+    if size is None:
         return None
-    return hash[0:12]
+    return f"{size / (1024 * 1024):.1f} MiB"
 
 
 COLUMNS = [
     # ColumnInfo("ID", lambda m: m["id"]),
     ColumnInfo(
         "Has Image",
-        lambda m: "★" if len(m["preview_images"] or []) > 0 else "",
+        lambda m: "★" if m["preview_count"] else "",
         width=20,
     ),
     ColumnInfo("Filename", lambda m: os.path.basename(m["filepath"]), width=240),
@@ -199,15 +156,15 @@ COLUMNS = [
     ColumnInfo("Name", lambda m: m["display_name"], is_meta=True, width=100),
     ColumnInfo("Author", lambda m: m["author"], is_meta=True, width=100),
     ColumnInfo("Rating", lambda m: format_rating(m["rating"]), is_meta=True, width=60),
-    ColumnInfo("Dim.", lambda m: format_network_alpha(m["network_dim"]), width=60),
-    ColumnInfo("Alpha", lambda m: format_network_alpha(m["network_alpha"]), width=60),
+    ColumnInfo("Dim.", lambda m: format_network_size(m, "network_dim"), width=60),
+    ColumnInfo("Alpha", lambda m: format_network_size(m, "network_alpha"), width=60),
     ColumnInfo("Resolution", lambda m: m["resolution_width"]),
     ColumnInfo("Unique Tags", lambda m: m["unique_tags"]),
     ColumnInfo("Learning Rate", lambda m: m["learning_rate"]),
     ColumnInfo("UNet LR", lambda m: m["unet_lr"]),
     ColumnInfo("Text Encoder LR", lambda m: m["text_encoder_lr"]),
-    ColumnInfo("Optimizer", format_optimizer, width=120),
-    ColumnInfo("Optimizer Args", format_optimizer_args, width=240),
+    ColumnInfo("Optimizer", lambda m: m["optimizer_name"], width=120),
+    ColumnInfo("Optimizer Args", lambda m: m["optimizer_args"], width=240),
     ColumnInfo("Scheduler", lambda m: m["lr_scheduler"], width=120),
     ColumnInfo("# Train Images", lambda m: m["num_train_images"]),
     ColumnInfo("# Reg Images", lambda m: m["num_reg_images"]),
@@ -217,7 +174,8 @@ COLUMNS = [
     ColumnInfo("Total Batch Size", lambda m: m["total_batch_size"]),
     ColumnInfo("Keep Tokens", lambda m: m["keep_tokens"]),
     ColumnInfo("Noise Offset", lambda m: m["noise_offset"]),
-    ColumnInfo("Shorthash", format_shorthash, width=100),
+    ColumnInfo("Shorthash", lambda m: m["short_hash"], width=100),
+    ColumnInfo("File Size", format_file_size, width=80, is_visible=False),
     ColumnInfo(
         "Training Comment", lambda m: m["training_comment"], width=140, is_visible=False
     ),
@@ -2,7 +2,10 @@
 
 from aiohttp import web
 from sd_model_manager.app import init_app
-from sd_model_manager.db import DB
+from sd_model_manager.db import DB, setup_db
+from sd_model_manager.jobs import setup_jobs
+from sd_model_manager.watcher import setup_watcher
+from sd_model_manager.hashing import setup_hashing
 from sd_model_manager.utils.common import get_config
 import sys
 
@@ -13,11 +16,25 @@ async def create_app(argv=None) -> web.Application:
         argv = sys.argv
     app["sdmm_config"] = get_config(argv)
 
-    db = DB()
-    await db.init(app["sdmm_config"].model_paths)
+    db = DB(
+        scan_workers=app["sdmm_config"].scan_workers,
+        scan_processes=app["sdmm_config"].scan_processes,
+        journal_mode=app["sdmm_config"].db_journal_mode,
+        synchronous=app["sdmm_config"].db_synchronous,
+        mmap_size=app["sdmm_config"].db_mmap_size * 1024 * 1024,
+        cache_size=app["sdmm_config"].db_cache_size * 1024 * 1024,
+        readers=app["sdmm_config"].db_readers,
+        result_cache_size=app["sdmm_config"].result_cache_size * 1024 * 1024,
+        memory_index=app["sdmm_config"].memory_index,
+    )
+    await db.init(app["sdmm_config"].model_paths, rescan=app["sdmm_config"].rescan)
     # await db.scan(app["sdmm_config"].model_paths)
 
     app["sdmm_db"] = db
+    setup_jobs(app)
+    setup_watcher(app)
+    setup_hashing(app)
+    setup_db(app)
 
     try:
         import aiohttp_debugtoolbar
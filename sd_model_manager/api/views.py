@@ -1,4 +1,5 @@
 import os
+import asyncio
 from aiohttp import web
 from sqlalchemy import create_engine, select, or_
 from sqlalchemy.orm import Session, selectinload, selectin_polymorphic
@@ -12,7 +13,15 @@ from sd_model_manager.models.sd_models import (
     LoRAModel,
     LoRAModelSchema,
 )
-from sd_model_manager.query import build_search_query
+from sd_model_manager.query import build_search_query, tokenize
+from sd_model_manager.hashing import PRIORITY_USER
+from sd_model_manager.utils.lru_cache import LRUCache
+
+
+# Number of recent searches whose statements are kept for reuse
+SEARCH_QUERY_CACHE_SIZE = 256
+
+search_queries = LRUCache(max_entries=SEARCH_QUERY_CACHE_SIZE)
 
 
 def paging_to_json(paging, limit):
@@ -24,6 +33,24 @@ def paging_to_json(paging, limit):
     }
 
 
+def lora_search_query(search_query, full_text):
+    """The statement listing the LoRAs matched by `search_query`. Building it
+    doesn't touch the database, so it's kept across requests, keyed by the
+    query's tokens so the same search typed with different spacing shares
+    it. Returns the statement and its key."""
+    key = (tuple(tokenize(search_query)), full_text)
+    query = search_queries.get(key)
+    if query is None:
+        query = build_search_query(select(LoRAModel), search_query, full_text)
+        query = query.options(selectin_polymorphic(SDModel, [LoRAModel]))
+        search_queries.put(key, query)
+    return query, key
+
+
+class NotFound(Exception):
+    pass
+
+
 routes = web.RouteTableDef()
 
 
@@ -77,24 +104,38 @@ async def index_loras(request):
     limit = int(request.rel_url.query.get("limit", 100))
     search_query = request.rel_url.query.get("query", None)
 
-    async with request.app["sdmm_db"].AsyncSession() as s:
-        query = select(LoRAModel)
-        if search_query:
-            query = build_search_query(query, search_query)
-        query = query.options(selectin_polymorphic(SDModel, [LoRAModel])).options(
-            selectinload(SDModel.preview_images)
-        )
-
-        page = await select_page(s, query, per_page=limit, page=page_marker)
+    db = request.app["sdmm_db"]
+    query, key = lora_search_query(search_query or "", db.full_text_search)
+
+    # Taken before reading, so a page read while a write is committed is
+    # cached under the revision before it and not served again after
+    cache_key = (key, page_marker, limit, db.revision)
+    body = db.result_cache.get(cache_key)
+    if body is not None:
+        return web.json_response(text=body)
+
+    async with db.AsyncSession() as s:
+        paging = None
+        if db.index is not None:
+            paging = await db.index.select_page(
+                s, search_query or "", limit, page_marker
+            )
+        if paging is None:
+            page = await select_page(s, query, per_page=limit, page=page_marker)
+            paging = page.paging
 
-        schema = LoRAModelSchema()
+        # Listings carry each model's preview count and cover image instead
+        # of its preview images, which are only loaded for a single model
+        schema = LoRAModelSchema(exclude=["preview_images"])
 
         resp = {
-            "paging": paging_to_json(page.paging, limit),
-            "data": [schema.dump(m[0]) for m in page],
+            "paging": paging_to_json(paging, limit),
+            "data": [schema.dump(m[0]) for m in paging.rows],
         }
 
-        return web.json_response(resp, dumps=simplejson.dumps)
+    body = simplejson.dumps(resp)
+    db.result_cache.put(cache_key, body, len(body))
+    return web.json_response(text=body)
 
 
 @routes.get("/api/v1/lora/{id}")
@@ -135,7 +176,9 @@ async def update_lora(request):
     if changes is None:
         return web.Response(status=400)
 
-    async with request.app["sdmm_db"].AsyncSession() as s:
+    # Edits go through the database's writer, so they aren't held up behind a
+    # scan's locks. Raising undoes the edit.
+    async def write(s):
         query = select(LoRAModel).filter(LoRAModel.id == model_id)
         query = query.options(selectin_polymorphic(SDModel, [LoRAModel])).options(
             selectinload(SDModel.preview_images)
@@ -143,9 +186,7 @@ async def update_lora(request):
 
         row = (await s.execute(query)).one()
         if row is None:
-            return web.json_response(
-                {"message": f"LoRA not found: {model_id}"}, status=404
-            )
+            raise NotFound(f"LoRA not found: {model_id}")
         row = row[0]
 
         updated = 0
@@ -177,10 +218,7 @@ async def update_lora(request):
                 if "id" in image:
                     existing = await s.get(PreviewImage, image["id"])
                     if existing is None:
-                        return web.json_response(
-                            {"message": f"Preview image not found: {image['id']}"},
-                            status=404,
-                        )
+                        raise NotFound(f"Preview image not found: {image['id']}")
                     for k, v in image.items():
                         if k == "filepath":
                             v = os.path.normpath(v)
@@ -197,8 +235,156 @@ async def update_lora(request):
             row.preview_images = new_images
             updated += 1
 
-        await s.commit()
+        return updated
 
-        resp = {"status": "ok", "fields_updated": updated}
+    try:
+        updated = await request.app["sdmm_db"].write(write)
+    except NotFound as e:
+        return web.json_response({"message": str(e)}, status=404)
 
-        return web.json_response(resp, dumps=simplejson.dumps)
+    resp = {"status": "ok", "fields_updated": updated}
+
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.get("/api/v1/scans")
+async def index_scans(request):
+    jobs = request.app["sdmm_db"].jobs.list("scan")
+    resp = {"data": [job.to_json() for job in jobs]}
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.post("/api/v1/scan")
+async def start_scan(request):
+    db = request.app["sdmm_db"]
+
+    data = {}
+    if request.can_read_body:
+        data = await request.json()
+    full = bool(data.get("full", False))
+
+    running = db.jobs.active("scan")
+    if running:
+        resp = {
+            "message": "A scan is already running",
+            "data": running[0].to_json(),
+        }
+        return web.json_response(resp, status=409, dumps=simplejson.dumps)
+
+    job = db.start_scan(full=full)
+
+    resp = {"data": job.to_json()}
+    return web.json_response(resp, status=202, dumps=simplejson.dumps)
+
+
+@routes.get("/api/v1/scan/{id}")
+async def show_scan(request):
+    job_id = request.match_info.get("id", None)
+    job = request.app["sdmm_db"].jobs.get(job_id)
+    if job is None or job.kind != "scan":
+        return web.json_response({"message": f"Scan not found: {job_id}"}, status=404)
+
+    resp = {"data": job.to_json()}
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.delete("/api/v1/scan/{id}")
+async def cancel_scan(request):
+    job_id = request.match_info.get("id", None)
+    jobs = request.app["sdmm_db"].jobs
+    job = jobs.get(job_id)
+    if job is None or job.kind != "scan":
+        return web.json_response({"message": f"Scan not found: {job_id}"}, status=404)
+
+    cancelled = jobs.cancel(job_id)
+
+    resp = {"status": "ok", "cancelled": cancelled}
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.get("/api/v1/scan/{id}/events")
+async def stream_scan(request):
+    """Streams the scan's progress as server-sent events until it's done."""
+    job_id = request.match_info.get("id", None)
+    job = request.app["sdmm_db"].jobs.get(job_id)
+    if job is None or job.kind != "scan":
+        return web.json_response({"message": f"Scan not found: {job_id}"}, status=404)
+
+    interval = float(request.rel_url.query.get("interval", 0.5))
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    while True:
+        active = job.is_active
+        data = simplejson.dumps(job.to_json())
+        await response.write(f"event: progress\ndata: {data}\n\n".encode("utf-8"))
+        if not active:
+            break
+        await asyncio.sleep(interval)
+
+    await response.write_eof()
+    return response
+
+
+@routes.get("/api/v1/duplicates")
+async def show_duplicates(request):
+    jobs = request.app["sdmm_db"].jobs.list("duplicates")
+    if not jobs:
+        resp = {"message": "No search for duplicates has been run yet"}
+        return web.json_response(resp, status=404, dumps=simplejson.dumps)
+
+    resp = {"data": jobs[-1].to_json()}
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.post("/api/v1/duplicates")
+async def start_finding_duplicates(request):
+    job = request.app["sdmm_db"].start_finding_duplicates()
+
+    resp = {"data": job.to_json()}
+    return web.json_response(resp, status=202, dumps=simplejson.dumps)
+
+
+@routes.post("/api/v1/resolve")
+async def resolve_models(request):
+    data = await request.json()
+    hashes = [str(h) for h in data.get("hashes", [])]
+    names = [str(n) for n in data.get("names", [])]
+
+    by_hash, by_name = await request.app["sdmm_db"].resolve(hashes, names)
+
+    resp = {"data": {"hashes": by_hash, "names": by_name}}
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.get("/api/v1/hash")
+async def show_hashing(request):
+    resp = {"data": request.app["sdmm_hasher"].stats()}
+    return web.json_response(resp, dumps=simplejson.dumps)
+
+
+@routes.post("/api/v1/hash")
+async def start_hashing(request):
+    hasher = request.app["sdmm_hasher"]
+
+    data = {}
+    if request.can_read_body:
+        data = await request.json()
+    ids = data.get("ids", None)
+
+    if ids is None:
+        queued = await hasher.enqueue()
+    else:
+        queued = await hasher.enqueue(
+            [int(id) for id in ids], PRIORITY_USER, force=bool(data.get("force"))
+        )
+
+    resp = {"status": "ok", "queued": queued, "data": hasher.stats()}
+    return web.json_response(resp, status=202, dumps=simplejson.dumps)
+
+
+@routes.get("/api/v1/header_cache")
+async def show_header_cache(request):
+    stats = await request.app["sdmm_db"].header_cache_stats()
+    return web.json_response({"data": stats}, dumps=simplejson.dumps)
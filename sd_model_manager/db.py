@@ -2,24 +2,83 @@ import os
 import os.path
 import io
 import sys
-import glob
+import time
 import tqdm
 import asyncio
 import simplejson
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from ast import literal_eval as make_tuple
-from PIL import Image
 from datetime import datetime
-from sqlalchemy import select, delete, func, and_
+from sqlalchemy import (
+    select,
+    insert,
+    update,
+    delete,
+    func,
+    and_,
+    or_,
+    bindparam,
+    inspect,
+    text,
+    event,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
 
-from sd_model_manager.utils.common import PATH, find_image
+from sd_model_manager.utils.common import PATH
 from sd_model_manager.utils import safetensors_hack
-from sd_model_manager.models.sd_models import Base, PreviewImage, SDModel, LoRAModel
+from sd_model_manager.utils.walker import MODEL_EXTENSIONS, walk_models
+from sd_model_manager.utils import previews
+from sd_model_manager.utils.header_cache import get_cache
+from sd_model_manager.utils.lru_cache import LRUCache
+from sd_model_manager.jobs import JobRegistry, ScanJob, DuplicatesJob
+from sd_model_manager.writer import Writer
+from sd_model_manager.migrations import migrate
+from sd_model_manager import model_index
+from sd_model_manager.models.sd_models import (
+    Base,
+    PreviewImage,
+    FileFingerprint,
+    ScannedDirectory,
+    ModelLookup,
+    ModelTrainedTag,
+    SDModel,
+    LoRAModel,
+    network_size,
+    optimizer_parts,
+    short_hash,
+)
 
 
 DATABASE_NAME = os.getenv("DATABASE_NAME", "model_database")
 
+# Kept apart from the model database so that it survives rebuilds of it
+HEADER_CACHE_NAME = os.getenv("HEADER_CACHE_NAME", "header_cache")
+
+# Stay under SQLite's limit on bound parameters per statement
+DELETE_CHUNK_SIZE = 500
+
+# Number of header reads allowed in flight per scan worker
+SCAN_QUEUE_DEPTH = 4
+
+# Directories modified less than this long before a scan are listed again on
+# the next one
+RACY_MTIME_NS = 2 * 10**9
+
+# Number of scanned models written to the database per transaction
+SCAN_CHUNK_SIZE = 2000
+
+# Columns filled in by hashing the file rather than from its metadata
+HASH_COLUMNS = ["sha256", "autov1", "autov2", "autov3"]
+
+# Connections kept open for API reads
+READ_POOL_SIZE = 4
+
+# Bytes of serialized search results kept for repeated requests
+RESULT_CACHE_SIZE = 32 * 1024 * 1024
+
 
 def to_bool(s):
     if s is None or s == "None":
@@ -71,6 +130,24 @@ def to_unique_tags(s):
     return len(tags)
 
 
+def trained_tags(tag_frequency):
+    """Yields `(dataset, tag, count)` for each tag in a decoded
+    `ss_tag_frequency`, skipping anything malformed."""
+    if not isinstance(tag_frequency, dict):
+        return
+    for dataset, tags in tag_frequency.items():
+        if not isinstance(tags, dict):
+            continue
+        for tag, count in tags.items():
+            try:
+                count = int(count)
+            except (TypeError, ValueError):
+                continue
+            tag = str(tag).strip()
+            if tag:
+                yield dataset, tag, count
+
+
 def format_resolution(tuple_str, idx):
     try:
         t = make_tuple(tuple_str)
@@ -82,36 +159,6 @@ def format_resolution(tuple_str, idx):
         return None
 
 
-def can_load_image(path):
-    try:
-        image = Image.open(path)
-        image.load()
-        return True
-    except Exception:
-        return False
-
-
-def find_preview_images(basepath):
-    i = 0
-    images = []
-    path = basepath + ".png"
-    if os.path.isfile(path):
-        images.append(path)
-
-    while True:
-        if i == 0:
-            path = f"{basepath}.preview.png"
-        else:
-            path = f"{basepath}.preview.{i}.png"
-        if not os.path.isfile(path):
-            break
-        images.append(path)
-        i += 1
-
-    images = [os.path.normpath(i) for i in images if can_load_image(i)]
-    return images
-
-
 MODEL_TYPES = {
     "networks.lora": "LoRA",
     "sd_scripts.networks.lora": "LoRA",
@@ -142,221 +189,1366 @@ def format_module_name(m):
     return module
 
 
+# Columns that can be edited by the user through the API. These are only read
+# from the file when the model is first added, so that rescanning a changed
+# file doesn't clobber the user's edits.
+USER_COLUMNS = [
+    "display_name",
+    "author",
+    "source",
+    "keywords",
+    "negative_keywords",
+    "version",
+    "description",
+    "rating",
+    "tags",
+]
+
+
+def user_columns(metadata):
+    return {
+        "display_name": metadata.get("ssmd_display_name", None),
+        "author": metadata.get("ssmd_author", None),
+        "source": metadata.get("ssmd_source", None),
+        "keywords": metadata.get("ssmd_keywords", None),
+        "negative_keywords": metadata.get("ssmd_negative_keywords", None),
+        "version": metadata.get("ssmd_version", None),
+        "description": metadata.get("ssmd_description", None),
+        "rating": to_int(metadata.get("ssmd_rating", None)),
+        "tags": metadata.get("ssmd_tags", None),
+    }
+
+
+def training_columns(metadata):
+    optimizer_name, optimizer_args = optimizer_parts(metadata.get("ss_optimizer", None))
+    return {
+        "model_hash": metadata.get("sshs_model_hash", None),
+        "short_hash": short_hash(metadata.get("sshs_model_hash", None)),
+        "legacy_hash": metadata.get("sshs_legacy_hash", None),
+        "session_id": to_int(metadata.get("ss_session_id", None)),
+        "training_started_at": to_datetime(
+            metadata.get("ss_training_started_at", None)
+        ),
+        "output_name": metadata.get("ss_output_name", None),
+        "learning_rate": to_float(metadata.get("ss_learning_rate", None)),
+        "text_encoder_lr": to_float(metadata.get("ss_text_encoder_lr", None)),
+        "unet_lr": to_float(metadata.get("ss_unet_lr", None)),
+        "num_train_images": to_int(metadata.get("ss_num_train_images", None)),
+        "num_reg_images": to_int(metadata.get("ss_num_reg_images", None)),
+        "num_batches_per_epoch": to_int(metadata.get("ss_num_batches_per_epoch", None)),
+        "num_epochs": to_int(metadata.get("ss_num_epochs", None)),
+        "epoch": to_int(metadata.get("ss_epoch", None)),
+        "batch_size_per_device": to_int(metadata.get("ss_batch_size_per_device", None)),
+        "total_batch_size": to_int(metadata.get("ss_total_batch_size", None)),
+        "gradient_checkpointing": to_bool(
+            metadata.get("ss_gradient_checkpointing", None)
+        ),
+        "gradient_accumulation_steps": to_int(
+            metadata.get("ss_gradient_accumulation_steps", None)
+        ),
+        "max_train_steps": to_int(metadata.get("ss_max_train_steps", None)),
+        "lr_warmup_steps": to_int(metadata.get("ss_lr_warmup_steps", None)),
+        "lr_scheduler": metadata.get("ss_lr_scheduler", None),
+        "network_module": metadata.get("ss_network_module", None),
+        "module_name": format_module_name(metadata),
+        "network_dim": metadata.get("ss_network_dim", None),
+        "network_alpha": metadata.get("ss_network_alpha", None),
+        "network_dim_value": network_size(metadata.get("ss_network_dim", None)),
+        "network_alpha_value": network_size(metadata.get("ss_network_alpha", None)),
+        "network_args": to_json(metadata.get("ss_network_args", None)),
+        "mixed_precision": to_bool(metadata.get("ss_mixed_precision", None)),
+        "full_fp16": to_bool(metadata.get("ss_full_fp16", None)),
+        "v2": to_bool(metadata.get("ss_v2", None)),
+        "resolution_width": format_resolution(metadata.get("ss_resolution", None), 0),
+        "resolution_height": format_resolution(metadata.get("ss_resolution", None), 1),
+        "clip_skip": to_int(metadata.get("ss_clip_skip", None)),
+        "max_token_length": to_int(metadata.get("ss_max_token_length", None)),
+        "color_aug": to_bool(metadata.get("ss_color_aug", None)),
+        "flip_aug": to_bool(metadata.get("ss_flip_aug", None)),
+        "random_crop": to_bool(metadata.get("ss_random_crop", None)),
+        "shuffle_caption": to_bool(metadata.get("ss_shuffle_caption", None)),
+        "cache_latents": to_bool(metadata.get("ss_cache_latents", None)),
+        "enable_bucket": to_bool(metadata.get("ss_enable_bucket", None)),
+        "min_bucket_reso": to_int(metadata.get("ss_min_bucket_reso", None)),
+        "max_bucket_reso": to_int(metadata.get("ss_max_bucket_reso", None)),
+        "seed": to_int(metadata.get("ss_seed", None)),
+        "keep_tokens": to_bool(metadata.get("ss_keep_tokens", None)),
+        "dataset_dirs": to_json(metadata.get("ss_dataset_dirs", None)),
+        "reg_dataset_dirs": to_json(metadata.get("ss_reg_dataset_dirs", None)),
+        "tag_frequency": to_json(metadata.get("ss_tag_frequency", None)),
+        "unique_tags": to_unique_tags(metadata.get("ss_tag_frequency", None)),
+        "sd_model_name": metadata.get("ss_sd_model_name", None),
+        "sd_model_hash": metadata.get("ss_sd_model_hash", None),
+        "new_sd_model_hash": metadata.get("ss_new_sd_model_hash", None),
+        "vae_name": metadata.get("ss_vae_name", None),
+        "vae_hash": metadata.get("ss_vae_hash", None),
+        "new_vae_hash": metadata.get("ss_new_vae_hash", None),
+        "training_comment": to_str(metadata.get("ss_training_comment", None)),
+        "bucket_info": to_json(metadata.get("ss_bucket_info", None)),
+        "sd_scripts_commit_hash": metadata.get("ss_sd_scripts_commit_hash", None),
+        "noise_offset": to_float(metadata.get("ss_noise_offset", None)),
+        "optimizer": metadata.get("ss_optimizer", None),
+        "optimizer_name": optimizer_name,
+        "optimizer_args": optimizer_args,
+        "max_grad_norm": to_float(metadata.get("ss_max_grad_norm", None)),
+        "caption_dropout_rate": to_float(metadata.get("ss_caption_dropout_rate", None)),
+        "caption_dropout_every_n_epochs": to_int(
+            metadata.get("ss_caption_dropout_every_n_epochs", None)
+        ),
+        "caption_tag_dropout_rate": to_float(
+            metadata.get("ss_caption_tag_dropout_rate", None)
+        ),
+        "face_crop_aug_range": metadata.get("ss_face_crop_aug_range", None),
+        "prior_loss_weight": to_float(metadata.get("ss_prior_loss_weight", None)),
+        "min_snr_gamma": to_float(metadata.get("ss_min_snr_gamma", None)),
+        "scale_weight_norms": to_float(metadata.get("ss_scale_weight_norms", None)),
+    }
+
+
+def under_paths(column, paths, inclusive=False):
+    """Filters `column` to filepaths beneath any of `paths`."""
+    clauses = []
+    for path in paths:
+        clauses.append(column.startswith(os.path.join(path, ""), autoescape=True))
+        if inclusive:
+            clauses.append(column == path)
+    return or_(*clauses)
+
+
+def read_model_file(filepath, preview_images=None, fingerprint=None, cache_path=None):
+    """Reads and converts everything the scanner needs from one model file.
+    Runs inside the scan worker pool, so it must stay picklable and must not
+    touch the database.
+
+    `preview_images` are the candidate previews found when the model's folder
+    was listed. If not given, the folder is listed to find them.
+
+    If `cache_path` is given, the header is looked up in the header cache
+    there first, by the size and mtime in `fingerprint`."""
+    try:
+        if cache_path is not None:
+            metadata, _, cache_hit = get_cache(cache_path).read_header(
+                filepath, fingerprint
+            )
+        else:
+            metadata, cache_hit = safetensors_hack.read_metadata(filepath), False
+    except Exception:
+        return None
+
+    if preview_images is None:
+        preview_images = previews.find_preview_images(filepath)
+    else:
+        preview_images = previews.check_preview_images(preview_images)
+
+    return {
+        "user_columns": user_columns(metadata),
+        "training_columns": training_columns(metadata),
+        "preview_images": preview_images,
+        "cache_hit": cache_hit,
+    }
+
+
+def lookup_keys(
+    filename, output_name, model_hash, legacy_hash, sha256, autov1, autov2, autov3
+):
+    """Returns the `(kind, key)` pairs a model can be looked up by. Keys are
+    lowercased, and names are matched by the model's file name without its
+    extension as well as its `ss_output_name`."""
+    keys = [
+        ("sha256", sha256),
+        ("model_hash", model_hash),
+        ("legacy_hash", legacy_hash),
+        ("autov1", autov1),
+        ("autov2", autov2 or (sha256 and sha256[:10])),
+        ("autov3", autov3 or (model_hash and model_hash[:12])),
+        ("name", os.path.splitext(filename)[0] if filename else None),
+        ("name", output_name),
+    ]
+    return {(kind, key.lower()) for kind, key in keys if key}
+
+
+def set_pragmas(engine, pragmas, begin=None):
+    """Sets `pragmas` on each new connection `engine` opens. If `begin` is
+    given, transactions are started with it instead of leaving it to the
+    driver, which otherwise never starts one for SAVEPOINT."""
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        if begin is not None:
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    if begin is not None:
+
+        @event.listens_for(engine.sync_engine, "begin")
+        def on_begin(conn):
+            conn.exec_driver_sql(begin)
+
+
+def hash_model_file(filepath, fingerprint, cache_path, throttle=None):
+    """Computes every hash of one model file. Runs in a worker thread.
+
+    Hashes stored for the same fingerprint are reused without reading the
+    file. Returns `(hashes, from_store)`, or None if the file couldn't be read
+    or no longer matches `fingerprint`, its `(size, mtime_ns, inode)` as
+    recorded at the last scan, since the hashes would then be of a different
+    file than the one in the database."""
+    size, mtime_ns, inode = fingerprint
+    cache = get_cache(cache_path)
+
+    def matches():
+        st = os.stat(filepath)
+        return (st.st_size, st.st_mtime_ns) == (size, mtime_ns)
+
+    try:
+        hashes = cache.get_hashes(filepath, size, mtime_ns, inode)
+        if hashes is not None:
+            return hashes, True
+
+        if not matches():
+            return None
+        hashes = safetensors_hack.hash_model(filepath, throttle=throttle)
+        if not matches():
+            return None
+
+        cache.put_hashes(filepath, size, mtime_ns, inode, hashes)
+    except Exception:
+        return None
+    return hashes, False
+
+
+def partial_hash_file(filepath, fingerprint, cache_path):
+    """Computes the partial hash of one model file, reusing the one stored
+    for the same path, size and mtime if there is one. Returns None if the
+    file couldn't be read."""
+    size, mtime_ns, _ = fingerprint
+    cache = get_cache(cache_path)
+    try:
+        partial = cache.get_partial_hash(filepath, size, mtime_ns)
+        if partial is None:
+            partial = safetensors_hack.partial_hash(filepath)
+            cache.put_partial_hash(filepath, size, mtime_ns, partial)
+    except Exception:
+        return None
+    return partial
+
+
 class DB:
-    def __init__(self):
+    def __init__(
+        self,
+        scan_workers=None,
+        scan_processes=False,
+        journal_mode="wal",
+        synchronous="normal",
+        mmap_size=256 * 1024 * 1024,
+        cache_size=64 * 1024 * 1024,
+        readers=READ_POOL_SIZE,
+        result_cache_size=RESULT_CACHE_SIZE,
+        memory_index=False,
+    ):
         self.engine = None
-        self.Session = None
-        pass
+        self.read_engine = None
+        self.writer = None
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.mmap_size = int(mmap_size)
+        self.cache_size = int(cache_size)
+        self.readers = max(1, readers or READ_POOL_SIZE)
+        self.scan_workers = scan_workers or os.cpu_count() or 4
+        self.scan_processes = scan_processes
+        self.model_paths = []
+        self.write_lock = asyncio.Lock()
+        self.jobs = JobRegistry()
+        self.needs_scan = False
+        self.full_text_search = False
+        # Set to the hashing service when models should be hashed as they're
+        # found
+        self.hasher = None
+        self.header_cache_path = os.path.join(PATH, f"{HEADER_CACHE_NAME}.db")
+        self.header_cache_hits = 0
+        self.header_cache_misses = 0
+        # Serialized pages of search results, keyed by the revision they were
+        # read at
+        self.result_cache = LRUCache(max_bytes=int(result_cache_size))
+        self.memory_index = memory_index
+        # Set to the in-memory index of model columns if there is one
+        self.index = None
+
+    async def init(self, model_paths, rescan=False):
+        self.model_paths = [os.path.normpath(p) for p in model_paths]
 
-    async def init(self, model_paths):
         path = os.path.join(PATH, DATABASE_NAME)
-        self.engine = create_async_engine(f"sqlite+aiosqlite:///{path}.db")
+        url = f"sqlite+aiosqlite:///{path}.db"
+
+        # Every write goes through the writer's one connection, and API reads
+        # through a pool of connections that can't write. In WAL mode the
+        # readers keep working from the last commit while a write is under
+        # way, instead of waiting for the lock.
+        pragmas = {
+            "mmap_size": self.mmap_size,
+            # Negative sizes are in KiB rather than pages
+            "cache_size": -(self.cache_size // 1024),
+        }
+        self.engine = create_async_engine(url, pool_size=1, max_overflow=0)
+        set_pragmas(
+            self.engine,
+            {
+                "journal_mode": self.journal_mode,
+                "synchronous": self.synchronous,
+                **pragmas,
+            },
+            begin="BEGIN IMMEDIATE",
+        )
+        self.read_engine = create_async_engine(
+            url, pool_size=self.readers, max_overflow=0
+        )
+        set_pragmas(self.read_engine, {"query_only": 1, **pragmas})
 
         async with self.engine.begin() as conn:
+            created = not await conn.run_sync(
+                lambda conn: inspect(conn).has_table(SDModel.__tablename__)
+            )
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(migrate, created)
+            self.full_text_search = await conn.run_sync(
+                lambda conn: inspect(conn).has_table("model_search")
+            )
 
-        self.AsyncSession = async_sessionmaker(bind=self.engine)
+        self.WriteSession = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.AsyncSession = async_sessionmaker(bind=self.read_engine)
+        self.writer = Writer(self.WriteSession)
 
-        async with self.AsyncSession() as session:
+        async with self.WriteSession() as session:
             stmt = select(func.count()).select_from(SDModel)
             count = (await session.execute(stmt)).scalar()
 
+            # Fill in lookup keys for models added before there were any
+            stmt = select(func.count()).select_from(ModelLookup)
+            if count > 0 and (await session.execute(stmt)).scalar() == 0:
+                ids = (await session.execute(select(LoRAModel.id))).scalars().all()
+                await self.refresh_lookups(session, ids)
+
+            # Likewise for trained tags
+            stmt = select(func.count()).select_from(ModelTrainedTag)
+            if count > 0 and (await session.execute(stmt)).scalar() == 0:
+                stmt = select(LoRAModel.id).where(LoRAModel.tag_frequency.is_not(None))
+                ids = (await session.execute(stmt)).scalars().all()
+                await self.refresh_trained_tags(session, ids)
+            await session.commit()
+
+        if self.memory_index:
+            await self._load_index()
+
         print(f"Database is at {path}.db.")
 
         if count == 0:
-            print("Database was newly created, running initial scan.")
-            await self.scan(model_paths)
+            print("Database was newly created, an initial scan will be run.")
+            self.needs_scan = True
+        elif rescan:
+            print("Model paths will be rescanned for changes.")
+            self.needs_scan = True
+
+    async def _load_index(self):
+        if model_index.np is None:
+            print("NumPy isn't installed, so models won't be indexed in memory.")
+            return
+
+        index = model_index.ModelIndex()
+        async with self.WriteSession() as session:
+            await index.install(session)
+            await index.load(session)
+            await session.commit()
+        self.index = index
+        self.writer.on_commit = index.collect
+        print(f"Indexed {len(index)} models in memory.")
+
+    async def close(self):
+        """Finishes any queued writes and closes the database."""
+        if self.writer is not None:
+            await self.writer.stop()
+        if self.read_engine is not None:
+            await self.read_engine.dispose()
+        if self.engine is not None:
+            await self.engine.dispose()
+
+    async def write(self, write):
+        """Runs `await write(session)` on the database's single writer and
+        returns its result once committed. See `Writer`."""
+        return await self.writer.submit(write)
+
+    @property
+    def revision(self):
+        """Goes up whenever a write is committed, so anything read from the
+        database can be cached under the revision it was read at."""
+        return self.writer.batches if self.writer is not None else 0
+
+    async def header_cache_stats(self):
+        """Header cache hits and misses since startup, and its size."""
+        loop = asyncio.get_running_loop()
+        entries = await loop.run_in_executor(
+            None, lambda: get_cache(self.header_cache_path).entries()
+        )
+        return {
+            "hits": self.header_cache_hits,
+            "misses": self.header_cache_misses,
+            "entries": entries,
+        }
+
+    def start_scan(self, full=False):
+        """Starts scanning the model paths as a background job. If a scan is
+        already running, returns that one instead."""
+        running = self.jobs.active("scan")
+        if running:
+            return running[0]
+
+        self.needs_scan = False
+        job = ScanJob(self.model_paths, full=full)
+        return self.jobs.start(job, self.scan(self.model_paths, full=full, job=job))
+
+    def start_finding_duplicates(self):
+        """Starts looking for duplicate models as a background job. If one is
+        already running, returns that one instead."""
+        running = self.jobs.active("duplicates")
+        if running:
+            return running[0]
+
+        job = DuplicatesJob()
+        return self.jobs.start(job, self.find_duplicates(job))
+
+    def _root_for(self, path):
+        """Returns the model path that `path` lives under, if any."""
+        for root in sorted(self.model_paths, key=len, reverse=True):
+            if path == root or path.startswith(os.path.join(root, "")):
+                return root
+        return None
+
+    async def _load_known_files(self, session, paths):
+        """Returns a mapping of filepath -> (id, root_path, fingerprint) for every
+        model beneath `paths`. Fingerprint is None for models scanned before
+        fingerprints were recorded."""
+        query = select(
+            SDModel.id,
+            SDModel.root_path,
+            SDModel.filepath,
+            FileFingerprint.size,
+            FileFingerprint.mtime_ns,
+            FileFingerprint.inode,
+        ).outerjoin(FileFingerprint, FileFingerprint.model_id == SDModel.id)
+        query = query.where(under_paths(SDModel.filepath, paths))
+
+        known = {}
+        for id, root_path, filepath, size, mtime_ns, inode in await session.execute(
+            query
+        ):
+            fingerprint = None
+            if size is not None:
+                fingerprint = (size, mtime_ns, inode)
+            known[filepath] = (id, root_path, fingerprint)
+        return known
+
+    async def _delete_models(self, session, ids):
+        ids = list(ids)
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[i : i + DELETE_CHUNK_SIZE]
+            await session.execute(
+                delete(PreviewImage).where(PreviewImage.model_id.in_(chunk))
+            )
+            await session.execute(
+                delete(FileFingerprint).where(FileFingerprint.model_id.in_(chunk))
+            )
+            await session.execute(
+                delete(ModelLookup).where(ModelLookup.model_id.in_(chunk))
+            )
+            await session.execute(
+                delete(ModelTrainedTag).where(ModelTrainedTag.model_id.in_(chunk))
+            )
+            lora_table = LoRAModel.__table__
+            await session.execute(delete(lora_table).where(lora_table.c.id.in_(chunk)))
+            await session.execute(delete(SDModel).where(SDModel.id.in_(chunk)))
+
+    async def refresh_lookups(self, session, ids):
+        """Rebuilds the lookup keys of the given models from their current
+        hashes and names."""
+        ids = list(ids)
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[i : i + DELETE_CHUNK_SIZE]
+            await session.execute(
+                delete(ModelLookup).where(ModelLookup.model_id.in_(chunk))
+            )
+            models = await session.execute(
+                select(
+                    LoRAModel.id,
+                    LoRAModel.filename,
+                    LoRAModel.output_name,
+                    LoRAModel.model_hash,
+                    LoRAModel.legacy_hash,
+                    LoRAModel.sha256,
+                    LoRAModel.autov1,
+                    LoRAModel.autov2,
+                    LoRAModel.autov3,
+                ).where(LoRAModel.id.in_(chunk))
+            )
+            rows = [
+                {"model_id": id, "kind": kind, "key": key}
+                for id, *values in models
+                for kind, key in lookup_keys(*values)
+            ]
+            if rows:
+                await session.execute(insert(ModelLookup), rows)
+
+    async def refresh_trained_tags(self, session, ids):
+        """Rebuilds the trained tag counts of the given models from their
+        `tag_frequency`."""
+        ids = list(ids)
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[i : i + DELETE_CHUNK_SIZE]
+            await session.execute(
+                delete(ModelTrainedTag).where(ModelTrainedTag.model_id.in_(chunk))
+            )
+            models = await session.execute(
+                select(LoRAModel.id, LoRAModel.tag_frequency).where(
+                    LoRAModel.id.in_(chunk), LoRAModel.tag_frequency.is_not(None)
+                )
+            )
+            counts = [
+                (id, dataset, tag, count)
+                for id, tag_frequency in models
+                for dataset, tag, count in trained_tags(tag_frequency)
+            ]
+            if not counts:
+                continue
+            # Sent straight to the driver, since there can be hundreds of rows
+            # per model and SQLAlchemy's per-row parameter handling would take
+            # longer than the inserts themselves. Tags are interned on the
+            # way, by name.
+            conn = await session.connection()
+            await conn.exec_driver_sql(
+                "INSERT OR IGNORE INTO trained_tags (name) VALUES (?)",
+                [(tag,) for tag in {tag for _, _, tag, _ in counts}],
+            )
+            await conn.exec_driver_sql(
+                "INSERT INTO model_trained_tags (model_id, dataset, tag_id, count) "
+                "SELECT ?, ?, id, ? FROM trained_tags WHERE name = ?",
+                [(id, dataset, count, tag) for id, dataset, tag, count in counts],
+            )
+
+    async def resolve(self, hashes=(), names=()):
+        """Looks up models by any of their hashes or short hashes, and by
+        name. Returns `(by_hash, by_name)`, each mapping a reference to the
+        models it matched, as dicts with `id`, `filepath` and the `kind` of
+        key that matched."""
+        refs = {}
+        for ref in hashes:
+            refs.setdefault(ref.lower(), []).append((ref, False))
+        for ref in names:
+            refs.setdefault(ref.lower(), []).append((ref, True))
+
+        by_hash = {ref: [] for ref in hashes}
+        by_name = {ref: [] for ref in names}
+
+        keys = list(refs)
+        async with self.AsyncSession() as session:
+            for i in range(0, len(keys), DELETE_CHUNK_SIZE):
+                chunk = keys[i : i + DELETE_CHUNK_SIZE]
+                matches = await session.execute(
+                    select(
+                        ModelLookup.key,
+                        ModelLookup.kind,
+                        SDModel.id,
+                        SDModel.filepath,
+                    )
+                    .join(SDModel, SDModel.id == ModelLookup.model_id)
+                    .where(ModelLookup.key.in_(chunk))
+                    .order_by(SDModel.id)
+                )
+                for key, kind, id, filepath in matches:
+                    for ref, is_name in refs[key]:
+                        if is_name != (kind == "name"):
+                            continue
+                        found = by_name[ref] if is_name else by_hash[ref]
+                        if not any(m["id"] == id for m in found):
+                            found.append({"id": id, "filepath": filepath, "kind": kind})
+
+        return by_hash, by_name
+
+    def _make_scan_executor(self):
+        if self.scan_processes:
+            return ProcessPoolExecutor(max_workers=self.scan_workers)
+        return ThreadPoolExecutor(
+            max_workers=self.scan_workers, thread_name_prefix="sdmm-scan"
+        )
+
+    async def _match_moves(self, session, gone, pending):
+        """Matches models whose files are gone to new files found by the
+        scan, so that moved and renamed models keep their rows, and with them
+        anything the user entered.
+
+        Files are first matched by inode and size, which survive a move or
+        rename within a filesystem. New files left over with the same size as
+        a gone model with a known hash are then hashed and matched by
+        content, which catches copies across filesystems.
+
+        Returns `(moves, pending)`. `moves` holds `(id, root_path, filepath,
+        fingerprint, preview_images)` for each match, and `pending` is what's
+        left to read. Files matched by inode whose mtime changed are left in
+        `pending` as updates of the moved model, since their contents might
+        have changed too."""
+        by_inode = {}
+        for f, (id, _, fingerprint) in gone.items():
+            if fingerprint is not None and fingerprint[2]:
+                by_inode[(fingerprint[2], fingerprint[0])] = (id, fingerprint)
+
+        moves = []
+        moved_ids = set()
+        unmatched = []
+        remaining = []
+        for item in pending:
+            path, f, fingerprint, id, preview_images = item
+            match = None
+            if id is None and fingerprint[2]:
+                match = by_inode.pop((fingerprint[2], fingerprint[0]), None)
+            if match is None:
+                remaining.append(item)
+                if id is None:
+                    unmatched.append(item)
+                continue
+
+            old_id, old_fingerprint = match
+            moves.append((old_id, path, f, fingerprint, preview_images))
+            moved_ids.add(old_id)
+            if old_fingerprint[1] != fingerprint[1]:
+                remaining.append((path, f, fingerprint, old_id, preview_images))
+
+        # Fall back to content hashes for what's left
+        by_size = {}
+        gone_ids = [id for id, _, _ in gone.values() if id not in moved_ids]
+        for i in range(0, len(gone_ids), DELETE_CHUNK_SIZE):
+            chunk = gone_ids[i : i + DELETE_CHUNK_SIZE]
+            rows = await session.execute(
+                select(LoRAModel.id, LoRAModel.sha256, FileFingerprint.size)
+                .join(FileFingerprint, FileFingerprint.model_id == LoRAModel.id)
+                .where(LoRAModel.id.in_(chunk), LoRAModel.sha256 != None)
+            )
+            # Identical copies may have been moved together, so each hash
+            # keeps every model it was gone from
+            for id, sha256, size in rows:
+                by_size.setdefault(size, {}).setdefault(sha256, []).append(id)
+
+        candidates = [item for item in unmatched if item[2][0] in by_size]
+        if not candidates:
+            return moves, remaining
+
+        # Hashed a few at a time, and held to the hashing service's rate limit
+        # if it's running, since these are whole files
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(
+            max_workers=self.scan_workers, thread_name_prefix="sdmm-moves"
+        )
+        bucket = self.hasher.bucket if self.hasher is not None else None
+        throttle = bucket.consume if bucket is not None else None
+        try:
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        executor,
+                        hash_model_file,
+                        item[1],
+                        item[2],
+                        self.header_cache_path,
+                        throttle,
+                    )
+                    for item in candidates
+                )
+            )
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        matched = set()
+        for item, result in zip(candidates, results):
+            if result is None:
+                continue
+            path, f, fingerprint, _, preview_images = item
+            old_ids = by_size[fingerprint[0]].get(result[0]["sha256"])
+            if not old_ids:
+                continue
+            old_id = old_ids.pop()
+            moves.append((old_id, path, f, fingerprint, preview_images))
+            matched.add(f)
+
+        remaining = [item for item in remaining if item[1] not in matched]
+        return moves, remaining
+
+    async def _move_models(self, session, moves):
+        """Points moved models at their new files in bulk, and swaps preview
+        images that didn't move along with them for the ones next to the new
+        file."""
+        if not moves:
+            return
 
-    async def scan(self, paths):
+        ids = [id for id, _, _, _, _ in moves]
+        sd_model_table = SDModel.__table__
+        await session.execute(
+            update(sd_model_table).where(sd_model_table.c.id == bindparam("_id")),
+            [
+                {
+                    "_id": id,
+                    "root_path": root_path,
+                    "filepath": filepath,
+                    "filename": os.path.basename(filepath),
+                    "file_size": fingerprint[0],
+                }
+                for id, root_path, filepath, fingerprint, _ in moves
+            ],
+        )
+
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            await session.execute(
+                delete(FileFingerprint).where(
+                    FileFingerprint.model_id.in_(ids[i : i + DELETE_CHUNK_SIZE])
+                )
+            )
+        await session.execute(
+            insert(FileFingerprint),
+            [
+                {
+                    "model_id": id,
+                    "size": fingerprint[0],
+                    "mtime_ns": fingerprint[1],
+                    "inode": fingerprint[2],
+                }
+                for id, _, _, fingerprint, _ in moves
+            ],
+        )
+
+        old_images = []
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            old_images += (
+                await session.execute(
+                    select(PreviewImage.id, PreviewImage.filepath).where(
+                        PreviewImage.model_id.in_(ids[i : i + DELETE_CHUNK_SIZE])
+                    )
+                )
+            ).all()
+
+        def check_images():
+            missing = [id for id, path in old_images if not os.path.exists(path)]
+            found = [
+                (id, previews.check_preview_images(preview_images))
+                for id, _, _, _, preview_images in moves
+            ]
+            return missing, found
+
+        loop = asyncio.get_running_loop()
+        missing, found = await loop.run_in_executor(None, check_images)
+
+        for i in range(0, len(missing), DELETE_CHUNK_SIZE):
+            await session.execute(
+                delete(PreviewImage).where(
+                    PreviewImage.id.in_(missing[i : i + DELETE_CHUNK_SIZE])
+                )
+            )
+        preview_image_rows = [
+            {"filepath": image_path, "is_autogenerated": False, "model_id": id}
+            for id, image_paths in found
+            for image_path in image_paths
+        ]
+        if preview_image_rows:
+            await session.execute(
+                sqlite_insert(PreviewImage.__table__).on_conflict_do_nothing(),
+                preview_image_rows,
+            )
+
+        await self.refresh_lookups(session, ids)
+
+    async def _insert_models(self, session, rows):
+        """Bulk inserts newly scanned models and their preview images.
+
+        Model ids are assigned up front from the current maximum, so that the
+        subclass, fingerprint and preview image rows can be inserted without
+        a round trip per model to learn its id. Returns the new ids."""
+        next_id = (await session.execute(select(func.max(SDModel.id)))).scalar() or 0
+
+        sd_model_rows = []
+        lora_model_rows = []
+        fingerprint_rows = []
+        preview_image_rows = []
+
+        for root_path, filepath, fingerprint, result in rows:
+            next_id += 1
+            size, mtime_ns, inode = fingerprint
+            sd_model_rows.append(
+                {
+                    "id": next_id,
+                    "type": "lora_model",
+                    "root_path": root_path,
+                    "filepath": filepath,
+                    "filename": os.path.basename(filepath),
+                    "last_modified": datetime.fromtimestamp(mtime_ns / 1e9),
+                    "last_embedded": datetime.min,
+                    "file_size": size,
+                    **result["user_columns"],
+                }
+            )
+            lora_model_rows.append({"id": next_id, **result["training_columns"]})
+            fingerprint_rows.append(
+                {
+                    "model_id": next_id,
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "inode": inode,
+                }
+            )
+            for image_path in result["preview_images"]:
+                preview_image_rows.append(
+                    {
+                        "filepath": image_path,
+                        "is_autogenerated": False,
+                        "model_id": next_id,
+                    }
+                )
+
+        await session.execute(insert(SDModel.__table__), sd_model_rows)
+        await session.execute(insert(LoRAModel.__table__), lora_model_rows)
+        await session.execute(insert(FileFingerprint), fingerprint_rows)
+        if preview_image_rows:
+            # An image may already belong to another model if it was attached
+            # by hand, in which case leave it there.
+            await session.execute(
+                sqlite_insert(PreviewImage).on_conflict_do_nothing(),
+                preview_image_rows,
+            )
+
+        return [row["id"] for row in sd_model_rows]
+
+    async def _update_models(self, session, rows):
+        """Bulk refreshes the training metadata of models whose files changed."""
+        sd_model_table = SDModel.__table__
+        lora_model_table = LoRAModel.__table__
+
+        sd_model_rows = []
+        lora_model_rows = []
+        fingerprint_rows = []
+
+        for id, fingerprint, result in rows:
+            size, mtime_ns, inode = fingerprint
+            sd_model_rows.append(
+                {
+                    "_id": id,
+                    "last_modified": datetime.fromtimestamp(mtime_ns / 1e9),
+                    "file_size": size,
+                }
+            )
+            lora_model_rows.append(
+                {
+                    "_id": id,
+                    **result["training_columns"],
+                    **{column: None for column in HASH_COLUMNS},
+                }
+            )
+            fingerprint_rows.append(
+                {"model_id": id, "size": size, "mtime_ns": mtime_ns, "inode": inode}
+            )
+
+        await session.execute(
+            update(sd_model_table).where(sd_model_table.c.id == bindparam("_id")),
+            sd_model_rows,
+        )
+        await session.execute(
+            update(lora_model_table).where(lora_model_table.c.id == bindparam("_id")),
+            lora_model_rows,
+        )
+        await session.execute(
+            delete(FileFingerprint).where(
+                FileFingerprint.model_id.in_([id for id, _, _ in rows])
+            )
+        )
+        await session.execute(insert(FileFingerprint), fingerprint_rows)
+
+    async def _load_dir_mtimes(self, session, paths):
+        # Directories saved without an mtime are still loaded, as None, so
+        # that the walker knows to descend into them from an unchanged parent
+        query = select(ScannedDirectory.path, ScannedDirectory.mtime_ns).where(
+            under_paths(ScannedDirectory.path, paths, inclusive=True)
+        )
+        return {path: mtime_ns for path, mtime_ns in await session.execute(query)}
+
+    async def _save_dir_mtimes(self, session, paths, dir_rows):
+        await session.execute(
+            delete(ScannedDirectory).where(
+                under_paths(ScannedDirectory.path, paths, inclusive=True)
+            )
+        )
+        if dir_rows:
+            await session.execute(insert(ScannedDirectory), dir_rows)
+
+    def _discover(self, walks, known, dir_mtimes, job):
+        """Walks each `(root_path, start)` in `walks` and works out which files
+        need their header read. Blocking, so it's run off the event loop."""
+        known_by_dir = {}
+        for filepath in known:
+            known_by_dir.setdefault(os.path.dirname(filepath), []).append(filepath)
+
+        seen = set()
+        pending = []
+        dir_rows = []
+
+        # Files can still be landing in a directory modified this recently
+        # without its mtime moving on, so don't trust it for skipping yet.
+        racy_mtime_ns = time.time_ns() - RACY_MTIME_NS
+
+        for path, start in walks:
+            for dirpath, mtime_ns, files, filenames in walk_models(start, dir_mtimes):
+                if mtime_ns is None:
+                    # Unreadable, so assume everything beneath it is still there
+                    prefix = dirpath + os.sep
+                    seen.update(f for f in known if f.startswith(prefix))
+                    continue
+
+                dir_rows.append(
+                    {
+                        "root_path": path,
+                        "path": dirpath,
+                        "mtime_ns": mtime_ns if mtime_ns < racy_mtime_ns else None,
+                    }
+                )
+
+                if files is None:
+                    unchanged = known_by_dir.get(dirpath, [])
+                    seen.update(unchanged)
+                    job.files_seen += len(unchanged)
+                    continue
+
+                preview_groups = None
+
+                for f, fingerprint in files:
+                    seen.add(f)
+                    job.files_seen += 1
+
+                    id, _, old_fingerprint = known.get(f, (None, None, None))
+                    if id is not None and old_fingerprint == fingerprint:
+                        continue
+
+                    if preview_groups is None:
+                        preview_groups = previews.group_preview_images(
+                            dirpath, filenames
+                        )
+                    preview_images = preview_groups.get(previews.model_stem(f), [])
+
+                    pending.append((path, f, fingerprint, id, preview_images))
+
+        return seen, pending, dir_rows
+
+    async def scan(self, paths, full=False, job=None):
+        """Incrementally scans the given paths for models.
+
+        Directories whose mtime hasn't changed since the last scan aren't
+        listed again, unless `full` is set. Files whose (size, mtime, inode)
+        fingerprint matches the one recorded at the last scan are skipped
+        without reading their header. Changed files have their training
+        metadata refreshed in place, and models whose files were deleted from
+        a scanned path are removed.
+
+        A file edited in place doesn't change its directory's mtime, so only a
+        full scan is guaranteed to notice it.
+
+        Headers are read and converted in a pool of scan workers, feeding a
+        bounded queue that this coroutine drains into the database in chunks
+        of SCAN_CHUNK_SIZE models, committing after each one so that readers
+        aren't blocked for the whole scan."""
         for p in paths:
             if not os.path.isdir(p):
                 raise RuntimeError(f"Invalid path: {p}")
 
         print("Building model database...")
 
+        paths = [os.path.normpath(p) for p in paths]
+
+        if job is None:
+            job = ScanJob(paths, full=full)
+
+        async with self.write_lock:
+            added, updated, moved, removed = await self._sync(
+                [(p, p) for p in paths], job, full=full
+            )
+
+        print(
+            f"Scan finished: {added} added, {updated} updated, {moved} moved, "
+            f"{removed} removed."
+        )
+
+    async def sync_paths(self, changed):
+        """Brings the database up to date with changes to the given files and
+        directories, as reported by the watcher.
+
+        The directory containing each changed path is listed again, along with
+        anything new beneath it, so creations, edits, deletions and moves are
+        all picked up without rescanning the whole model path."""
+        forced = set()
+        images = []
+
+        for path in changed:
+            path = os.path.normpath(path)
+            root = self._root_for(path)
+            if root is None:
+                continue
+            forced.add(os.path.dirname(path) if path != root else root)
+            if previews.preview_key(os.path.basename(path)) is not None:
+                images.append(path)
+
+        walks = []
+        for dirpath in sorted(forced, key=len):
+            if not any(
+                dirpath == start or dirpath.startswith(os.path.join(start, ""))
+                for _, start in walks
+            ):
+                walks.append((self._root_for(dirpath), dirpath))
+
+        if not walks:
+            return
+        starts = [start for _, start in walks]
+
+        async with self.write_lock:
+            added, updated, moved, removed = await self._sync(
+                walks, ScanJob(starts), forced=forced, progress=False
+            )
+            removed_images = await self._remove_missing_preview_images(images)
+            added_images = await self._add_preview_images(images)
+
+        if added or updated or moved or removed or added_images or removed_images:
+            print(
+                f"Synced model changes: {added} added, {updated} updated, "
+                f"{moved} moved, {removed} removed, {added_images} preview "
+                f"images added, {removed_images} preview images removed."
+            )
+
+    async def _remove_missing_preview_images(self, images):
+        """Drops the preview images among `images` that were deleted or moved
+        away. The preview triggers then pick a new cover for their models."""
+        loop = asyncio.get_running_loop()
+        missing = await loop.run_in_executor(
+            None, lambda: [path for path in images if not os.path.exists(path)]
+        )
+        if not missing:
+            return 0
+
+        async def write(session):
+            count = 0
+            for i in range(0, len(missing), DELETE_CHUNK_SIZE):
+                result = await session.execute(
+                    delete(PreviewImage).where(
+                        PreviewImage.filepath.in_(missing[i : i + DELETE_CHUNK_SIZE])
+                    )
+                )
+                count += result.rowcount
+            return count
+
+        return await self.write(write)
+
+    async def _add_preview_images(self, images):
+        """Attaches newly created preview images to the models they're named
+        after."""
+        rows = []
+
         async with self.AsyncSession() as session:
-            for path in paths:
-                path = os.path.normpath(path)
-                files = list(glob.iglob(f"{path}/**/*.safetensors", recursive=True))
-
-                for f in tqdm.tqdm(files):
-                    f = os.path.normpath(f)
-                    try:
-                        metadata = safetensors_hack.read_metadata(f)
-                    except:
-                        continue
+            for image_path in images:
+                stem, _ = previews.preview_key(os.path.basename(image_path))
+                dirpath = os.path.dirname(image_path)
+                model_paths = [
+                    os.path.join(dirpath, stem + ext) for ext in MODEL_EXTENSIONS
+                ]
+                query = select(SDModel.id).where(SDModel.filepath.in_(model_paths))
+                model_id = (await session.execute(query)).scalar()
+                if model_id is None:
+                    continue
+                for path in previews.check_preview_images([image_path]):
+                    rows.append(
+                        {
+                            "filepath": path,
+                            "is_autogenerated": False,
+                            "model_id": model_id,
+                        }
+                    )
+
+        if not rows:
+            return 0
+
+        async def write(session):
+            result = await session.execute(
+                sqlite_insert(PreviewImage.__table__).on_conflict_do_nothing(), rows
+            )
+            return result.rowcount
+
+        return await self.write(write)
+
+    async def _sync(self, walks, job, full=False, forced=(), progress=True):
+        """Walks each `(root_path, start)` in `walks`, reads the headers of new
+        and changed model files, and removes models beneath each start that
+        are gone. Directories in `forced` are listed even if their mtime is
+        unchanged. Progress is recorded on `job`. Returns the number of models
+        added, updated, moved and removed.
+
+        Must be called with `write_lock` held, so that two syncs of the same
+        path don't both act on what it held before either of them. Writes go
+        through the writer, in chunks, so API reads and edits carry on while
+        this runs."""
+        starts = [start for _, start in walks]
+
+        async with self.AsyncSession() as session:
+            known = await self._load_known_files(session, starts)
+            dir_mtimes = {}
+            if not full:
+                dir_mtimes = await self._load_dir_mtimes(session, starts)
+            for dirpath in forced:
+                if dirpath in dir_mtimes:
+                    dir_mtimes[dirpath] = None
+
+            job.phase = "discovering"
+            loop = asyncio.get_running_loop()
+            seen, pending, dir_rows = await loop.run_in_executor(
+                None, self._discover, walks, known, dir_mtimes, job
+            )
 
-                    display_name = metadata.get("ssmd_display_name", None)
-                    author = metadata.get("ssmd_author", None)
-                    source = metadata.get("ssmd_source", None)
-                    keywords = metadata.get("ssmd_keywords", None)
-                    negative_keywords = metadata.get("ssmd_negative_keywords", None)
-                    version = metadata.get("ssmd_version", None)
-                    description = metadata.get("ssmd_description", None)
-                    rating = to_int(metadata.get("ssmd_rating", None))
-                    tags = metadata.get("ssmd_tags", None)
-
-                    filepath = f
-                    query = select(LoRAModel).filter(LoRAModel.filepath == filepath)
-                    # query = query.options(selectin_polymorphic(SDModel, [LoRAModel])).options(
-                    #     selectinload(SDModel.preview_images)
-                    # )
-
-                    id = None
-                    row = (await session.execute(query)).one_or_none()
-                    if row is not None:
-                        # print(f"Exists: {filepath} {row}")
-                        # id = row[0].id
+            # Only models under the walked paths were loaded, so leaving a path
+            # out of the config doesn't wipe its models.
+            gone = {f: known[f] for f in known if f not in seen}
+            moves, pending = await self._match_moves(session, gone, pending)
+            moved_ids = {id for id, _, _, _, _ in moves}
+            removed = [id for id, _, _ in gone.values() if id not in moved_ids]
+
+        # Moves and deletions are committed together, so reorganizing a folder
+        # is one transaction
+        async def write_removals(session):
+            await self._move_models(session, moves)
+            await self._delete_models(session, removed)
+
+        if moves or removed:
+            await self.write(write_removals)
+        job.rows_moved = len(moves)
+        job.rows_removed = len(removed)
+
+        added = updated = 0
+        new_rows = []
+        changed_rows = []
+
+        async def write_chunk():
+            nonlocal added, updated
+            new, changed = list(new_rows), list(changed_rows)
+            new_rows.clear()
+            changed_rows.clear()
+
+            async def write(session):
+                ids = []
+                if new:
+                    ids += await self._insert_models(session, new)
+                if changed:
+                    await self._update_models(session, changed)
+                    ids += [id for id, _, _ in changed]
+                await self.refresh_lookups(session, ids)
+                await self.refresh_trained_tags(session, ids)
+                return ids
+
+            ids = await self.write(write)
+            added += len(new)
+            updated += len(changed)
+            job.rows_written = added + updated
+
+            if ids and self.hasher is not None:
+                await self.hasher.models_changed(ids)
+
+        failed_dirs = set()
+        queue = asyncio.Queue(maxsize=self.scan_workers * SCAN_QUEUE_DEPTH)
+
+        job.start_reading(len(pending))
+        executor = self._make_scan_executor()
+
+        async def produce():
+            for item in pending:
+                future = loop.run_in_executor(
+                    executor,
+                    read_model_file,
+                    item[1],
+                    item[4],
+                    item[2],
+                    self.header_cache_path,
+                )
+                await queue.put((item, future))
+            await queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            with tqdm.tqdm(total=len(pending), disable=not progress) as pbar:
+                while True:
+                    entry = await queue.get()
+                    if entry is None:
+                        break
+                    (path, f, fingerprint, id, _), future = entry
+                    result = await future
+                    pbar.update(1)
+                    job.files_read += 1
+                    if result is None:
+                        # List it again next time in case the file was still
+                        # being written
+                        failed_dirs.add(os.path.dirname(f))
                         continue
 
-                    # if "ss_lr_scheduler" not in metadata:
-                    #     continue
-                    lora_model = LoRAModel(
-                        id=id,
-                        root_path=path,
-                        filepath=filepath,
-                        filename=os.path.basename(f),
-                        last_embedded=datetime.min,
-                        display_name=display_name,
-                        author=author,
-                        source=source,
-                        keywords=keywords,
-                        negative_keywords=negative_keywords,
-                        version=version,
-                        description=description,
-                        rating=rating,
-                        tags=tags,
-                        model_hash=metadata.get("sshs_model_hash", None),
-                        legacy_hash=metadata.get("sshs_legacy_hash", None),
-                        session_id=to_int(metadata.get("ss_session_id", None)),
-                        training_started_at=to_datetime(
-                            metadata.get("ss_training_started_at", None)
-                        ),
-                        output_name=metadata.get("ss_output_name", None),
-                        learning_rate=to_float(metadata.get("ss_learning_rate", None)),
-                        text_encoder_lr=to_float(
-                            metadata.get("ss_text_encoder_lr", None)
-                        ),
-                        unet_lr=to_float(metadata.get("ss_unet_lr", None)),
-                        num_train_images=to_int(
-                            metadata.get("ss_num_train_images", None)
-                        ),
-                        num_reg_images=to_int(metadata.get("ss_num_reg_images", None)),
-                        num_batches_per_epoch=to_int(
-                            metadata.get("ss_num_batches_per_epoch", None)
-                        ),
-                        num_epochs=to_int(metadata.get("ss_num_epochs", None)),
-                        epoch=to_int(metadata.get("ss_epoch", None)),
-                        batch_size_per_device=to_int(
-                            metadata.get("ss_batch_size_per_device", None)
-                        ),
-                        total_batch_size=to_int(
-                            metadata.get("ss_total_batch_size", None)
-                        ),
-                        gradient_checkpointing=to_bool(
-                            metadata.get("ss_gradient_checkpointing", None)
-                        ),
-                        gradient_accumulation_steps=to_int(
-                            metadata.get("ss_gradient_accumulation_steps", None)
-                        ),
-                        max_train_steps=to_int(
-                            metadata.get("ss_max_train_steps", None)
-                        ),
-                        lr_warmup_steps=to_int(
-                            metadata.get("ss_lr_warmup_steps", None)
-                        ),
-                        lr_scheduler=metadata.get("ss_lr_scheduler", None),
-                        network_module=metadata.get("ss_network_module", None),
-                        module_name=format_module_name(metadata),
-                        network_dim=metadata.get("ss_network_dim", None),
-                        network_alpha=metadata.get("ss_network_alpha", None),
-                        network_args=to_json(metadata.get("ss_network_args", None)),
-                        mixed_precision=to_bool(
-                            metadata.get("ss_mixed_precision", None)
-                        ),
-                        full_fp16=to_bool(metadata.get("ss_full_fp16", None)),
-                        v2=to_bool(metadata.get("ss_v2", None)),
-                        resolution_width=format_resolution(
-                            metadata.get("ss_resolution", None), 0
-                        ),
-                        resolution_height=format_resolution(
-                            metadata.get("ss_resolution", None), 1
-                        ),
-                        clip_skip=to_int(metadata.get("ss_clip_skip", None)),
-                        max_token_length=to_int(
-                            metadata.get("ss_max_token_length", None)
-                        ),
-                        color_aug=to_bool(metadata.get("ss_color_aug", None)),
-                        flip_aug=to_bool(metadata.get("ss_flip_aug", None)),
-                        random_crop=to_bool(metadata.get("ss_random_crop", None)),
-                        shuffle_caption=to_bool(
-                            metadata.get("ss_shuffle_caption", None)
-                        ),
-                        cache_latents=to_bool(metadata.get("ss_cache_latents", None)),
-                        enable_bucket=to_bool(metadata.get("ss_enable_bucket", None)),
-                        min_bucket_reso=to_int(
-                            metadata.get("ss_min_bucket_reso", None)
-                        ),
-                        max_bucket_reso=to_int(
-                            metadata.get("ss_max_bucket_reso", None)
-                        ),
-                        seed=to_int(metadata.get("ss_seed", None)),
-                        keep_tokens=to_bool(metadata.get("ss_keep_tokens", None)),
-                        dataset_dirs=to_json(metadata.get("ss_dataset_dirs", None)),
-                        reg_dataset_dirs=to_json(
-                            metadata.get("ss_reg_dataset_dirs", None)
-                        ),
-                        tag_frequency=to_json(metadata.get("ss_tag_frequency", None)),
-                        unique_tags=to_unique_tags(
-                            metadata.get("ss_tag_frequency", None)
-                        ),
-                        sd_model_name=metadata.get("ss_sd_model_name", None),
-                        sd_model_hash=metadata.get("ss_sd_model_hash", None),
-                        new_sd_model_hash=metadata.get("ss_new_sd_model_hash", None),
-                        vae_name=metadata.get("ss_vae_name", None),
-                        vae_hash=metadata.get("ss_vae_hash", None),
-                        new_vae_hash=metadata.get("ss_new_vae_hash", None),
-                        training_comment=to_str(
-                            metadata.get("ss_training_comment", None)
-                        ),
-                        bucket_info=to_json(metadata.get("ss_bucket_info", None)),
-                        sd_scripts_commit_hash=metadata.get(
-                            "ss_sd_scripts_commit_hash", None
-                        ),
-                        noise_offset=to_float(metadata.get("ss_noise_offset", None)),
-                        optimizer=metadata.get("ss_optimizer", None),
-                        max_grad_norm=to_float(metadata.get("ss_max_grad_norm", None)),
-                        caption_dropout_rate=to_float(
-                            metadata.get("ss_caption_dropout_rate", None)
-                        ),
-                        caption_dropout_every_n_epochs=to_int(
-                            metadata.get("ss_caption_dropout_every_n_epochs", None)
-                        ),
-                        caption_tag_dropout_rate=to_float(
-                            metadata.get("ss_caption_tag_dropout_rate", None)
-                        ),
-                        face_crop_aug_range=metadata.get(
-                            "ss_face_crop_aug_range", None
-                        ),
-                        prior_loss_weight=to_float(
-                            metadata.get("ss_prior_loss_weight", None)
-                        ),
-                        min_snr_gamma=to_float(metadata.get("ss_min_snr_gamma", None)),
-                        scale_weight_norms=to_float(
-                            metadata.get("ss_scale_weight_norms", None)
-                        ),
-                    )
-                    session.add(lora_model)
-                    await session.flush()
-
-                    # TODO dedup
-                    image_paths = find_preview_images(os.path.splitext(f)[0])
-                    for image_path in image_paths:
-                        preview_image = PreviewImage(
-                            filepath=image_path,
-                            is_autogenerated=False,
-                            model_id=lora_model.id,
-                        )
-                        session.add(preview_image)
+                    if result["cache_hit"]:
+                        job.cache_hits += 1
+                        self.header_cache_hits += 1
+                    else:
+                        job.cache_misses += 1
+                        self.header_cache_misses += 1
+
+                    if id is None:
+                        new_rows.append((path, f, fingerprint, result))
+                    else:
+                        changed_rows.append((id, fingerprint, result))
+
+                    if len(new_rows) + len(changed_rows) >= SCAN_CHUNK_SIZE:
+                        await write_chunk()
+
+            if new_rows or changed_rows:
+                await write_chunk()
+        finally:
+            producer.cancel()
+            # Don't wait on header reads still queued if the scan was
+            # cancelled
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        job.phase = "finishing"
+        for row in dir_rows:
+            if row["path"] in failed_dirs:
+                row["mtime_ns"] = None
+
+        async def write_dir_mtimes(session):
+            await self._save_dir_mtimes(session, starts, dir_rows)
+
+        await self.write(write_dir_mtimes)
+        job.phase = None
+
+        return added, updated, len(moves), len(removed)
+
+    async def find_duplicates(self, job=None):
+        """Finds model files with identical contents.
+
+        Files are narrowed down in three stages, so only a fraction of the
+        library is ever read in full: models are grouped by file size, files
+        sharing a size are grouped by their partial hash, and only files whose
+        partial hashes still collide are hashed in full. Models that were
+        already hashed skip straight to the last stage. Partial and full
+        hashes are kept in the header cache by fingerprint, so running this
+        again only reads files that changed.
+
+        Returns a list of groups of duplicates, stored on `job.groups`."""
+        if job is None:
+            job = DuplicatesJob()
+
+        job.phase = "grouping"
+        lora_model_table = LoRAModel.__table__
+        shared_sizes = (
+            select(FileFingerprint.size)
+            .group_by(FileFingerprint.size)
+            .having(func.count() > 1)
+        )
+        async with self.AsyncSession() as session:
+            rows = await session.execute(
+                select(
+                    SDModel.id,
+                    SDModel.filepath,
+                    FileFingerprint.size,
+                    FileFingerprint.mtime_ns,
+                    FileFingerprint.inode,
+                    lora_model_table.c.sha256,
+                )
+                .join(FileFingerprint, FileFingerprint.model_id == SDModel.id)
+                .outerjoin(lora_model_table, lora_model_table.c.id == SDModel.id)
+                .where(FileFingerprint.size.in_(shared_sizes))
+                .order_by(SDModel.id)
+            )
+            by_size = {}
+            for id, filepath, size, mtime_ns, inode, sha256 in rows:
+                entry = [id, filepath, (size, mtime_ns, inode), sha256]
+                by_size.setdefault(size, []).append(entry)
+
+        job.files_total = sum(len(entries) for entries in by_size.values())
+
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(
+            max_workers=self.scan_workers, thread_name_prefix="sdmm-dupes"
+        )
+
+        async def run_all(worker, entries, counter):
+            async def run(entry):
+                result = await loop.run_in_executor(
+                    executor, worker, entry[1], entry[2], self.header_cache_path
+                )
+                setattr(job, counter, getattr(job, counter) + 1)
+                return result
+
+            return await asyncio.gather(*(run(entry) for entry in entries))
+
+        try:
+            # Files of the same size whose partial hashes also match
+            job.phase = "partial_hashing"
+            need_partial = [
+                entry
+                for entries in by_size.values()
+                if any(entry[3] is None for entry in entries)
+                for entry in entries
+            ]
+            partials = await run_all(
+                partial_hash_file, need_partial, "files_partially_hashed"
+            )
+            partial_of = {
+                entry[0]: partial for entry, partial in zip(need_partial, partials)
+            }
+
+            candidates = []
+            for entries in by_size.values():
+                by_partial = {}
+                for entry in entries:
+                    # Groups where every model is hashed already are grouped
+                    # by their full hash
+                    if entry[0] in partial_of:
+                        key = partial_of[entry[0]]
+                    else:
+                        key = entry[3]
+                    if key is not None:
+                        by_partial.setdefault(key, []).append(entry)
+                for group in by_partial.values():
+                    if len(group) > 1:
+                        candidates += group
+
+            # Hash whatever still collides in full
+            job.phase = "hashing"
+            need_full = [entry for entry in candidates if entry[3] is None]
+            results = await run_all(hash_model_file, need_full, "files_hashed")
+            for entry, result in zip(need_full, results):
+                if result is not None:
+                    entry[3] = result[0]["sha256"]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        by_hash = {}
+        for id, filepath, fingerprint, sha256 in candidates:
+            if sha256 is not None:
+                group = by_hash.setdefault(
+                    sha256, {"sha256": sha256, "size": fingerprint[0], "models": []}
+                )
+                group["models"].append({"id": id, "filepath": filepath})
+
+        job.groups = [group for group in by_hash.values() if len(group["models"]) > 1]
+        job.phase = None
+        return job.groups
+
+
+def setup_db(app: web.Application) -> None:
+    """Closes the database on shutdown, once the writes queued by everything
+    else shutting down have finished. Should be set up last."""
+
+    async def on_cleanup(app):
+        await app["sdmm_db"].close()
 
-                await session.commit()
+    app.on_cleanup.append(on_cleanup)
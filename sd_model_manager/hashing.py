@@ -0,0 +1,278 @@
+import time
+import asyncio
+import itertools
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from sqlalchemy import select, update, bindparam
+
+from sd_model_manager.db import HASH_COLUMNS, hash_model_file
+from sd_model_manager.models.sd_models import FileFingerprint, LoRAModel, short_hash
+
+
+# Queue priorities, lowest first
+PRIORITY_USER = 0
+PRIORITY_NEW = 1
+PRIORITY_BACKLOG = 2
+
+# Files hashed at once. Hashing is bound by disk reads, so more than a couple
+# at a time just makes them seek against each other
+HASH_WORKERS = 2
+
+# Number of hashed models written to the database per transaction
+HASH_CHUNK_SIZE = 100
+
+# The read rate is averaged over this many seconds
+RATE_WINDOW_SECONDS = 10
+
+
+class TokenBucket:
+    """Limits the rate of reads across all hashing threads to `rate` bytes per
+    second, allowing bursts of up to `capacity` bytes.
+
+    A read larger than what's in the bucket is let through and leaves it in
+    debt, and the next read waits for it to be paid back, so reads don't need
+    to be split up to fit."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HashService:
+    """Hashes model files in the background while the server runs.
+
+    Models are taken from a priority queue: ones the user asked for first,
+    then ones a scan just added or found changed, then the backlog of
+    models that were never hashed. Results are kept in the header cache by
+    file fingerprint, so a file is never hashed twice, even if the database
+    is rebuilt. Reads are limited to `rate_limit` bytes per second, if set,
+    so hashing doesn't starve other programs loading models from the same
+    disk."""
+
+    def __init__(self, db, rate_limit=None, workers=HASH_WORKERS):
+        self.db = db
+        self.rate_limit = rate_limit or None
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.workers = workers
+
+        self.queue = None
+        self.queued = {}
+        self.counter = itertools.count()
+        self.executor = None
+        self.tasks = []
+        self.rows = []
+
+        self.active = 0
+        self.files_hashed = 0
+        self.files_from_store = 0
+        self.files_failed = 0
+        self.bytes_hashed = 0
+        self.reads = deque()
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="sdmm-hash"
+        )
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        await self._flush()
+
+    async def enqueue(self, ids=None, priority=PRIORITY_BACKLOG, force=False):
+        """Queues models for hashing, or every model that hasn't been hashed
+        if `ids` is None. Models that already have hashes are skipped unless
+        `force` is set. Returns the number of models queued.
+
+        A model that's already queued is moved up if `priority` is higher."""
+        stmt = select(
+            LoRAModel.id,
+            LoRAModel.filepath,
+            FileFingerprint.size,
+            FileFingerprint.mtime_ns,
+            FileFingerprint.inode,
+        ).join(FileFingerprint, FileFingerprint.model_id == LoRAModel.id)
+        if ids is not None:
+            stmt = stmt.where(LoRAModel.id.in_(ids))
+        if not force:
+            stmt = stmt.where(LoRAModel.sha256 == None)
+
+        async with self.db.AsyncSession() as session:
+            rows = (await session.execute(stmt.order_by(LoRAModel.id))).all()
+
+        count = 0
+        for id, filepath, size, mtime_ns, inode in rows:
+            queued = self.queued.get(id)
+            if queued is not None and queued[0] <= priority:
+                continue
+            self.queued[id] = (priority, size)
+            entry = (id, filepath, (size, mtime_ns, inode))
+            self.queue.put_nowait((priority, next(self.counter), entry))
+            count += 1
+        return count
+
+    async def models_changed(self, ids):
+        """Called by scans with the ids of models they added or updated."""
+        await self.enqueue(ids, PRIORITY_NEW)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        throttle = self.bucket.consume if self.bucket is not None else None
+
+        while True:
+            priority, _, (id, filepath, fingerprint) = await self.queue.get()
+            # Skip entries left behind when a model was moved up the queue
+            if self.queued.get(id, (None,))[0] != priority:
+                continue
+
+            self.active += 1
+            try:
+                result = await loop.run_in_executor(
+                    self.executor,
+                    hash_model_file,
+                    filepath,
+                    fingerprint,
+                    self.db.header_cache_path,
+                    throttle,
+                )
+            finally:
+                self.active -= 1
+                del self.queued[id]
+
+            if result is None:
+                self.files_failed += 1
+            else:
+                hashes, from_store = result
+                if from_store:
+                    self.files_from_store += 1
+                else:
+                    self.files_hashed += 1
+                    self.bytes_hashed += fingerprint[0]
+                    self.reads.append((time.monotonic(), fingerprint[0]))
+
+                size, mtime_ns, _ = fingerprint
+                self.rows.append(
+                    {
+                        "_id": id,
+                        "_size": size,
+                        "_mtime_ns": mtime_ns,
+                        **{column: hashes[column] for column in HASH_COLUMNS},
+                        "model_hash": hashes["model_hash"],
+                        "short_hash": short_hash(hashes["model_hash"]),
+                        "legacy_hash": hashes["legacy_hash"],
+                    }
+                )
+
+            if len(self.rows) >= HASH_CHUNK_SIZE or not self.queued:
+                try:
+                    await self._flush()
+                except Exception:
+                    traceback.print_exc()
+
+    async def _flush(self):
+        """Writes the hashes computed so far to the database."""
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+
+        lora_model_table = LoRAModel.__table__
+
+        # Only store the hashes if the file is still the one that was hashed
+        # by the time they're written
+        stmt = (
+            update(lora_model_table)
+            .where(lora_model_table.c.id == bindparam("_id"))
+            .where(
+                select(FileFingerprint.model_id)
+                .where(
+                    FileFingerprint.model_id == bindparam("_id"),
+                    FileFingerprint.size == bindparam("_size"),
+                    FileFingerprint.mtime_ns == bindparam("_mtime_ns"),
+                )
+                .exists()
+            )
+        )
+
+        async def write(session):
+            await session.execute(stmt, rows)
+            await self.db.refresh_lookups(session, [row["_id"] for row in rows])
+
+        await self.db.write(write)
+
+    def rate(self):
+        """Bytes read per second over the last few seconds."""
+        cutoff = time.monotonic() - RATE_WINDOW_SECONDS
+        while self.reads and self.reads[0][0] < cutoff:
+            self.reads.popleft()
+        if not self.reads:
+            return 0.0
+        return sum(n for _, n in self.reads) / RATE_WINDOW_SECONDS
+
+    def stats(self):
+        bytes_queued = sum(size for _, size in self.queued.values())
+        rate = self.rate()
+        return {
+            "queued": len(self.queued),
+            "active": self.active,
+            "bytes_queued": bytes_queued,
+            "files_hashed": self.files_hashed,
+            "files_from_store": self.files_from_store,
+            "files_failed": self.files_failed,
+            "bytes_hashed": self.bytes_hashed,
+            "rate": rate,
+            "rate_limit": self.rate_limit,
+            "eta": bytes_queued / rate if rate else None,
+        }
+
+
+def setup_hashing(app: web.Application) -> None:
+    """Runs the hashing service alongside the app. If background hashing is
+    enabled in the config, models without hashes are queued on startup, and
+    new and changed ones as scans find them."""
+
+    async def on_startup(app):
+        config = app["sdmm_config"]
+        db = app["sdmm_db"]
+        rate_limit = config.hash_rate_limit * 1024 * 1024
+        service = HashService(db, rate_limit=rate_limit)
+        service.start()
+        app["sdmm_hasher"] = service
+
+        if config.background_hashing:
+            db.hasher = service
+            count = await service.enqueue()
+            if count:
+                print(f"Queued {count} models for hashing.")
+
+    async def on_cleanup(app):
+        service = app.get("sdmm_hasher")
+        if service is not None:
+            app["sdmm_db"].hasher = None
+            await service.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
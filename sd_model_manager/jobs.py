@@ -0,0 +1,213 @@
+import time
+import uuid
+import asyncio
+import traceback
+from datetime import datetime
+from aiohttp import web
+
+
+def format_datetime(d):
+    return d.isoformat() if d is not None else None
+
+
+class Job:
+    """A long-running task started in the background, whose progress can be
+    polled through the API."""
+
+    kind = "job"
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "pending"
+        self.error = None
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def is_active(self):
+        return self.status in ("pending", "running")
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at or datetime.now()
+        return (end - self.started_at).total_seconds()
+
+    def progress(self):
+        return {}
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "created_at": format_datetime(self.created_at),
+            "started_at": format_datetime(self.started_at),
+            "finished_at": format_datetime(self.finished_at),
+            "elapsed": self.elapsed(),
+            **self.progress(),
+        }
+
+
+class ScanJob(Job):
+    kind = "scan"
+
+    def __init__(self, paths, full=False):
+        super().__init__()
+        self.paths = paths
+        self.full = full
+        self.phase = None
+
+        # Model files found on disk, including ones skipped as unchanged
+        self.files_seen = 0
+        # Files that need their header read, and how many have been so far
+        self.files_total = 0
+        self.files_read = 0
+        # Of the files read, how many headers came from the header cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.rows_written = 0
+        self.rows_moved = 0
+        self.rows_removed = 0
+
+        self.reading_started = None
+
+    def start_reading(self, files_total):
+        self.phase = "reading"
+        self.files_total = files_total
+        self.reading_started = time.perf_counter()
+
+    def rate(self):
+        """Files read per second."""
+        if self.reading_started is None:
+            return None
+        elapsed = time.perf_counter() - self.reading_started
+        if elapsed <= 0:
+            return None
+        return self.files_read / elapsed
+
+    def eta(self):
+        """Estimated seconds left until every file has been read."""
+        rate = self.rate()
+        if not rate:
+            return None
+        return (self.files_total - self.files_read) / rate
+
+    def progress(self):
+        return {
+            "paths": self.paths,
+            "full": self.full,
+            "phase": self.phase,
+            "files_seen": self.files_seen,
+            "files_total": self.files_total,
+            "files_read": self.files_read,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "rows_written": self.rows_written,
+            "rows_moved": self.rows_moved,
+            "rows_removed": self.rows_removed,
+            "rate": self.rate(),
+            "eta": self.eta(),
+        }
+
+
+class DuplicatesJob(Job):
+    kind = "duplicates"
+
+    def __init__(self):
+        super().__init__()
+        self.phase = None
+
+        # Models sharing their file size with another
+        self.files_total = 0
+        self.files_partially_hashed = 0
+        self.files_hashed = 0
+
+        self.groups = None
+
+    def progress(self):
+        return {
+            "phase": self.phase,
+            "files_total": self.files_total,
+            "files_partially_hashed": self.files_partially_hashed,
+            "files_hashed": self.files_hashed,
+            "groups": self.groups,
+        }
+
+
+class JobRegistry:
+    """Keeps track of background jobs, and of recently finished ones so their
+    results can still be fetched."""
+
+    def __init__(self, max_finished=50):
+        self.jobs = {}
+        self.max_finished = max_finished
+
+    def start(self, job, coro):
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, coro))
+        self._prune()
+        return job
+
+    async def _run(self, job, coro):
+        job.status = "running"
+        job.started_at = datetime.now()
+        try:
+            await coro
+            job.status = "finished"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as ex:
+            traceback.print_exc()
+            job.status = "failed"
+            job.error = str(ex)
+        finally:
+            job.finished_at = datetime.now()
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if not job.is_active]
+        for job in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+
+    def get(self, id):
+        return self.jobs.get(id)
+
+    def list(self, kind=None):
+        return [job for job in self.jobs.values() if kind is None or job.kind == kind]
+
+    def active(self, kind=None):
+        return [job for job in self.list(kind) if job.is_active]
+
+    def cancel(self, id):
+        job = self.get(id)
+        if job is None or not job.is_active:
+            return False
+        job.task.cancel()
+        return True
+
+    async def cancel_all(self):
+        tasks = [job.task for job in self.active()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def setup_jobs(app: web.Application) -> None:
+    """Starts the initial scan in the background once the app is running, so
+    the API can serve existing data in the meantime, and stops any running
+    jobs on shutdown."""
+
+    async def on_startup(app):
+        db = app["sdmm_db"]
+        if db.needs_scan:
+            db.start_scan()
+
+    async def on_cleanup(app):
+        await app["sdmm_db"].jobs.cancel_all()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
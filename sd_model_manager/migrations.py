@@ -0,0 +1,236 @@
+from sqlalchemy import inspect, text, select, update, bindparam
+
+from sd_model_manager.models.sd_models import (
+    Base,
+    SDModel,
+    LoRAModel,
+    PreviewImage,
+    create_search_index,
+    create_preview_triggers,
+    network_size,
+    optimizer_parts,
+)
+
+
+def get_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_version(conn, version):
+    conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def add_columns(conn, table_name, column_names):
+    """Adds columns to an existing table as they're declared on the model,
+    skipping any it already has."""
+    table = Base.metadata.tables[table_name]
+    existing = {c["name"] for c in inspect(conn).get_columns(table_name)}
+    for name in column_names:
+        if name in existing:
+            continue
+        column_type = table.c[name].type.compile(dialect=conn.dialect)
+        conn.execute(
+            text(f'ALTER TABLE {table_name} ADD COLUMN "{name}" {column_type}')
+        )
+
+
+def create_indexes(conn, index_names):
+    """Creates indexes declared on the models, skipping any that exist. Ones
+    that are no longer declared are skipped too, since a later migration
+    has replaced them."""
+    indexes = {
+        index.name: index
+        for table in Base.metadata.tables.values()
+        for index in table.indexes
+    }
+    # Looked up directly, since SQLAlchemy can't reflect expression indexes
+    existing = set(
+        conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'index'")
+        ).scalars()
+    )
+    for name in index_names:
+        if name in indexes and name not in existing:
+            indexes[name].create(conn)
+
+
+def add_hash_columns(conn):
+    add_columns(conn, "lora_model", ["sha256", "autov1", "autov2", "autov3"])
+
+
+def add_search_indexes(conn):
+    create_indexes(
+        conn,
+        [
+            "ix_preview_images_model_id",
+            "ix_file_fingerprints_size",
+            "ix_sd_model_rating",
+            "ix_sd_model_order_rating",
+            "ix_sd_model_order_name",
+            "ix_sd_model_order_root_path",
+            "ix_lora_model_unique_tags",
+            "ix_lora_model_order_network_dim",
+            "ix_lora_model_order_unique_tags",
+            "ix_lora_model_order_training_started_at",
+            "ix_lora_model_module_name",
+            "ix_lora_model_network_dim",
+            "ix_lora_model_model_hash",
+            "ix_lora_model_sha256",
+        ],
+    )
+    conn.execute(text("ANALYZE"))
+
+
+def add_full_text_search(conn):
+    if create_search_index(SDModel.__table__, conn):
+        conn.execute(text("INSERT INTO model_search(model_search) VALUES ('rebuild')"))
+
+
+def add_network_size_columns(conn):
+    add_columns(conn, "lora_model", ["network_dim_value", "network_alpha_value"])
+
+    lora = LoRAModel.__table__
+    rows = conn.execute(
+        select(lora.c.id, lora.c.network_dim, lora.c.network_alpha).where(
+            (lora.c.network_dim.is_not(None)) | (lora.c.network_alpha.is_not(None))
+        )
+    ).all()
+    if rows:
+        conn.execute(
+            update(lora)
+            .where(lora.c.id == bindparam("model_id"))
+            .values(
+                network_dim_value=bindparam("dim"),
+                network_alpha_value=bindparam("alpha"),
+            ),
+            [
+                {
+                    "model_id": id,
+                    "dim": network_size(dim),
+                    "alpha": network_size(alpha),
+                }
+                for id, dim, alpha in rows
+            ],
+        )
+
+    # Replaced by indexes on the numbers
+    conn.execute(text("DROP INDEX IF EXISTS ix_lora_model_order_network_dim"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_lora_model_network_dim"))
+    create_indexes(
+        conn,
+        [
+            "ix_lora_model_network_dim_value",
+            "ix_lora_model_network_alpha_value",
+            "ix_lora_model_order_network_dim_value",
+            "ix_lora_model_order_network_alpha_value",
+        ],
+    )
+    conn.execute(text("ANALYZE"))
+
+
+def add_derived_columns(conn):
+    add_columns(conn, "sd_model", ["file_size", "preview_count", "cover_image"])
+    add_columns(conn, "lora_model", ["optimizer_name", "optimizer_args", "short_hash"])
+
+    conn.execute(
+        text(
+            "UPDATE sd_model SET file_size = (SELECT size FROM file_fingerprints "
+            "WHERE model_id = sd_model.id)"
+        )
+    )
+    conn.execute(
+        text(
+            "UPDATE sd_model SET "
+            "preview_count = (SELECT count(*) FROM preview_images "
+            "WHERE model_id = sd_model.id), "
+            "cover_image = (SELECT filepath FROM preview_images "
+            "WHERE model_id = sd_model.id ORDER BY id LIMIT 1)"
+        )
+    )
+    create_preview_triggers(PreviewImage.__table__, conn)
+    conn.execute(text("UPDATE lora_model SET short_hash = substr(model_hash, 1, 12)"))
+
+    lora = LoRAModel.__table__
+    rows = []
+    for id, optimizer in conn.execute(
+        select(lora.c.id, lora.c.optimizer).where(lora.c.optimizer.is_not(None))
+    ):
+        name, args = optimizer_parts(optimizer)
+        rows.append({"model_id": id, "name": name, "args": args})
+    if rows:
+        conn.execute(
+            update(lora)
+            .where(lora.c.id == bindparam("model_id"))
+            .values(optimizer_name=bindparam("name"), optimizer_args=bindparam("args")),
+            rows,
+        )
+
+    create_indexes(
+        conn,
+        [
+            "ix_sd_model_file_size",
+            "ix_sd_model_order_file_size",
+            "ix_sd_model_order_preview_count",
+            "ix_lora_model_short_hash",
+            "ix_lora_model_optimizer_name",
+        ],
+    )
+    conn.execute(text("ANALYZE"))
+
+
+def add_cover_preview_id(conn):
+    add_columns(conn, "sd_model", ["cover_preview_id"])
+
+    # Replaced by ones that also set the cover's id
+    for name in ["insert", "delete", "update"]:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS preview_images_{name}"))
+    create_preview_triggers(PreviewImage.__table__, conn)
+
+    conn.execute(
+        text(
+            "UPDATE sd_model SET cover_preview_id = (SELECT id FROM preview_images "
+            "WHERE model_id = sd_model.id ORDER BY id LIMIT 1)"
+        )
+    )
+
+
+# Each migration brings a database from the version before it up to its own.
+# New tables are created by `create_all` beforehand, along with the full-text
+# index when `sd_model` is one of them, so migrations only need to change
+# tables that already existed. They should also cope with finding their
+# changes already made, since databases from before versioning may have some
+# of them.
+MIGRATIONS = [
+    (1, "Add file hash columns", add_hash_columns),
+    (2, "Add indexes for searching and sorting", add_search_indexes),
+    (3, "Add full-text search index", add_full_text_search),
+    (4, "Add numeric network dim and alpha columns", add_network_size_columns),
+    (5, "Add derived columns for searching and sorting", add_derived_columns),
+    (6, "Add cover preview image id", add_cover_preview_id),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn, created=False):
+    """Upgrades the database on `conn` to the current schema version, in the
+    same transaction. A database that was just `created` is already current.
+    Returns the version it was upgraded from."""
+    version = get_version(conn)
+    if created:
+        set_version(conn, SCHEMA_VERSION)
+        return version
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database is from a newer version of sd-model-manager (schema "
+            f"version {version}, this version supports up to {SCHEMA_VERSION})"
+        )
+
+    for target, description, upgrade in MIGRATIONS:
+        if target <= version:
+            continue
+        print(f"Upgrading database to version {target}: {description}...")
+        upgrade(conn)
+        set_version(conn, target)
+
+    return version
@@ -0,0 +1,463 @@
+import string
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    select,
+    text,
+    type_coerce,
+    DateTime,
+    Float,
+    Integer,
+    Numeric,
+    String,
+)
+from sqlalchemy.orm import selectin_polymorphic
+from sqlakeyset import Paging, unserialize_bookmark
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+from sd_model_manager.models.sd_models import SDModel, LoRAModel
+from sd_model_manager.query import (
+    ALL_CRITERIA,
+    SCOPE_QUALIFIERS,
+    Compiler,
+    HasCriteria,
+    NumberCriteria,
+    OrderByCriteria,
+    StringCriteria,
+    And,
+    Or,
+    Not,
+    compare,
+    parse_comparison,
+    parse_query,
+    search_orders,
+)
+
+
+# Stay under SQLite's limit on bound parameters per statement
+LOAD_CHUNK_SIZE = 500
+
+EPOCH = datetime(1970, 1, 1)
+
+# SQLite's lower() only lowercases ASCII
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Models changed by the writer's transaction, kept by temporary triggers on
+# its connection
+CHANGES_TABLE = "model_index_changes"
+
+
+def to_micros(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def change_triggers():
+    """Statements setting up the temporary table and triggers that record
+    which models the writer's connection changes."""
+    statements = [
+        f"CREATE TEMP TABLE IF NOT EXISTS {CHANGES_TABLE} (id INTEGER PRIMARY KEY)"
+    ]
+
+    def trigger(table, event, ids):
+        name = f"{CHANGES_TABLE}_{table}_{event.lower()}"
+        body = " ".join(
+            f"INSERT OR IGNORE INTO {CHANGES_TABLE} SELECT {id} WHERE {id} IS NOT NULL;"
+            for id in ids
+        )
+        statements.append(
+            f"CREATE TEMP TRIGGER IF NOT EXISTS {name} AFTER {event} ON main.{table} "
+            f"BEGIN {body} END"
+        )
+
+    for table, id in [
+        (SDModel.__tablename__, "id"),
+        (LoRAModel.__tablename__, "id"),
+    ]:
+        trigger(table, "INSERT", [f"new.{id}"])
+        trigger(table, "UPDATE", [f"old.{id}", f"new.{id}"])
+        trigger(table, "DELETE", [f"old.{id}"])
+    return statements
+
+
+class NotIndexed(Exception):
+    """Raised for parts of a query the index can't answer, which are left to
+    SQLite."""
+
+
+class NumberColumn:
+    """A numeric or date column, with NULLs kept apart in `valid`."""
+
+    def __init__(self, expression, convert, dtype):
+        self.expression = expression
+        self.convert = convert
+        self.dtype = dtype
+        self.values = np.empty(0, dtype)
+        self.valid = np.empty(0, bool)
+
+    def encode(self, values):
+        valid = np.array([v is not None for v in values], bool)
+        if self.convert is to_micros:
+            values = [0 if v is None else to_micros(v) for v in values]
+        else:
+            values = [0 if v is None else v for v in values]
+        return np.array(values, self.dtype), valid
+
+    def mask(self, criteria, value, negate):
+        comparisons = parse_comparison(value, criteria.type)
+        if comparisons is None:
+            return None
+        if any(v != v for _, v in comparisons):
+            # NaN, which SQLite compares as NULL
+            raise NotIndexed()
+        try:
+            stmt = np.logical_and.reduce(
+                [compare(self.values, op, v) for op, v in comparisons]
+            )
+        except OverflowError:
+            raise NotIndexed()
+        if negate:
+            return ~self.valid | ~stmt
+        return self.valid & stmt
+
+    def sort_key(self, default):
+        return np.where(self.valid, self.values, self.place_key(default))
+
+    def place_key(self, value):
+        try:
+            return self.convert(value)
+        except ValueError:
+            # Text, like a default of "", which SQLite sorts after numbers
+            return np.inf
+
+
+class StringColumn:
+    """A string column, dictionary-encoded: `values` holds each row's code in
+    `strings`, or -1 for NULL."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.values = np.empty(0, np.int32)
+        self.valid = np.empty(0, bool)
+        self.strings = []
+        self.codes = {}
+        self.lowered = {}
+        self.lowered_count = 0
+        self.sorted = []
+        self.ranks = np.empty(0, np.float64)
+
+    def encode(self, values):
+        for value in dict.fromkeys(values):
+            if value is not None and value not in self.codes:
+                self.codes[value] = len(self.strings)
+                self.strings.append(value)
+        codes = np.array([self.codes.get(v, -1) for v in values], np.int32)
+        return codes, codes >= 0
+
+    def mask(self, criteria, value, negate):
+        # Only exact searches need codes by lowercased string, so they're
+        # filled in here, for the strings added since the last one
+        for code in range(self.lowered_count, len(self.strings)):
+            lowered = self.strings[code].translate(ASCII_LOWER)
+            self.lowered.setdefault(lowered, []).append(code)
+        self.lowered_count = len(self.strings)
+        codes = self.lowered.get(value.lower())
+        stmt = (
+            np.isin(self.values, codes) if codes else np.zeros(len(self.values), bool)
+        )
+        if negate:
+            return ~stmt
+        return stmt
+
+    def update_ranks(self):
+        if len(self.sorted) == len(self.strings):
+            return
+        order = sorted(range(len(self.strings)), key=self.strings.__getitem__)
+        self.sorted = [self.strings[i] for i in order]
+        self.ranks = np.empty(len(order), np.float64)
+        self.ranks[order] = np.arange(len(order))
+
+    def sort_key(self, default):
+        self.update_ranks()
+        # Code -1 picks the rank of the default
+        ranks = np.append(self.ranks, self.place_key(default))
+        return ranks[self.values]
+
+    def place_key(self, value):
+        """Where `value` falls among the column's strings in SQLite's order,
+        halfway between two if it isn't one of them."""
+        self.update_ranks()
+        i = bisect_left(self.sorted, value)
+        if i < len(self.sorted) and self.sorted[i] == value:
+            return float(i)
+        return i - 0.5
+
+
+class FlagColumn:
+    """Whether each row matches a criteria that takes no value, like
+    `has:image`, as worked out by SQLite."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.values = np.empty(0, bool)
+        self.valid = np.empty(0, bool)
+
+    def encode(self, values):
+        values = np.array([bool(v) for v in values], bool)
+        return values, np.ones(len(values), bool)
+
+    def mask(self, criteria, value, negate):
+        if negate:
+            return ~self.values
+        return self.values
+
+
+def make_column(expression):
+    type = expression.type
+    if isinstance(type, DateTime):
+        return NumberColumn(expression, to_micros, np.int64)
+    if isinstance(type, Numeric):
+        # Compared as stored rather than rounded to a Decimal
+        return NumberColumn(type_coerce(expression, Float), float, np.float64)
+    if isinstance(type, Float):
+        return NumberColumn(expression, float, np.float64)
+    if isinstance(type, Integer):
+        return NumberColumn(expression, int, np.int64)
+    if isinstance(type, String):
+        return StringColumn(expression)
+    return None
+
+
+class ModelIndex:
+    """Keeps the LoRA columns that searches filter and sort by in memory as
+    NumPy arrays, so that queries made only of number, exact string and
+    `has:` qualifiers and orderings can be answered without SQLite, which
+    is then only asked for the models on the page.
+
+    Loaded with `load`, then kept up to date by `collect`, which the writer
+    runs before committing each batch."""
+
+    def __init__(self):
+        self.ids = np.empty(0, np.int64)
+        self.columns = []
+        self.by_criteria = {}
+        self.version = 0
+        self.rank_cache = {}
+        self.compiler = Compiler()
+
+        by_key = {}
+        for criteria in ALL_CRITERIA:
+            if isinstance(criteria, HasCriteria):
+                expression = criteria.compile(None, False, {})
+                make = FlagColumn
+            elif isinstance(criteria, (NumberCriteria, OrderByCriteria)) or (
+                isinstance(criteria, StringCriteria) and criteria.exact
+            ):
+                expression = criteria.column.expression
+                make = make_column
+            else:
+                continue
+            # Criteria with the same column share it
+            column = by_key.get(str(expression))
+            if column is None:
+                column = by_key[str(expression)] = make(expression)
+            if column is not None:
+                self.by_criteria[criteria] = column
+                if column not in self.columns:
+                    self.columns.append(column)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def statement(self):
+        id = LoRAModel.__table__.c.id
+        return (
+            select(id, *[c.expression for c in self.columns])
+            .select_from(LoRAModel)
+            .order_by(id)
+        )
+
+    async def install(self, session):
+        for statement in change_triggers():
+            await session.execute(text(statement))
+
+    async def load(self, session):
+        """Loads every LoRA into the index, replacing what it held."""
+        conn = await session.connection()
+        self.reload((await conn.execute(self.statement())).all())
+
+    async def collect(self, session):
+        """Reads the models changed in the writer's transaction. Returns a
+        function updating the index with them, to be called once the
+        transaction is committed."""
+        stmt = text("SELECT 1 FROM sqlite_temp_master WHERE name = :name")
+        if (await session.execute(stmt, {"name": CHANGES_TABLE})).first() is None:
+            # A new connection, which hasn't been recording changes
+            await self.install(session)
+            conn = await session.connection()
+            rows = (await conn.execute(self.statement())).all()
+            return lambda: self.reload(rows)
+
+        stmt = text(f"SELECT id FROM temp.{CHANGES_TABLE}")
+        ids = (await session.execute(stmt)).scalars().all()
+        if not ids:
+            return None
+        await session.execute(text(f"DELETE FROM temp.{CHANGES_TABLE}"))
+
+        conn = await session.connection()
+        rows = []
+        for i in range(0, len(ids), LOAD_CHUNK_SIZE):
+            chunk = ids[i : i + LOAD_CHUNK_SIZE]
+            stmt = self.statement().where(LoRAModel.__table__.c.id.in_(chunk))
+            rows.extend((await conn.execute(stmt)).all())
+        rows.sort(key=lambda row: row[0])
+        return lambda: self.apply(ids, rows)
+
+    def reload(self, rows):
+        self.ids = np.empty(0, np.int64)
+        for column in self.columns:
+            column.values = column.values[:0]
+            column.valid = column.valid[:0]
+        self.apply([], rows)
+
+    def apply(self, changed, rows):
+        """Drops the models with ids in `changed`, then adds `rows`, the
+        current state of those still there."""
+        keep = ~np.isin(self.ids, np.array(changed, np.int64))
+        new_ids = np.array([row[0] for row in rows], np.int64)
+        ids = np.concatenate([self.ids[keep], new_ids])
+
+        order = None
+        if len(ids) > 1 and (ids[1:] < ids[:-1]).any():
+            order = np.argsort(ids, kind="stable")
+            ids = ids[order]
+
+        columns = list(zip(*rows))[1:] or [()] * len(self.columns)
+        for column, loaded in zip(self.columns, columns):
+            values, valid = column.encode(loaded)
+            values = np.concatenate([column.values[keep], values])
+            valid = np.concatenate([column.valid[keep], valid])
+            if order is not None:
+                values, valid = values[order], valid[order]
+            column.values, column.valid = values, valid
+
+        self.ids = ids
+        self.version += 1
+        self.rank_cache.clear()
+
+    def mask(self, node, negate=False):
+        """Which rows match `node` of a query's syntax tree, or None if all
+        of them do. Mirrors `Compiler.compile`."""
+        if isinstance(node, Not):
+            return self.mask(node.node, not negate)
+        if isinstance(node, (And, Or)):
+            masks = [self.mask(n, negate) for n in node.nodes]
+            masks = [m for m in masks if m is not None]
+            if not masks:
+                return None
+            if isinstance(node, And) != negate:
+                return np.logical_and.reduce(masks)
+            # NOT (a AND b) is NOT a OR NOT b
+            return np.logical_or.reduce(masks)
+
+        if node.name is None or node.name in SCOPE_QUALIFIERS:
+            raise NotIndexed()
+        criteria, value = self.compiler.lookup(node)
+        if criteria is None:
+            return None
+        column = self.by_criteria.get(criteria)
+        if column is None:
+            raise NotIndexed()
+        return column.mask(criteria, value, negate)
+
+    def ranks(self, criteria, key):
+        """Each row's position when ordered ascending by `key`, then id."""
+        ranks = self.rank_cache.get(criteria)
+        if ranks is None:
+            ranks = np.empty(len(self.ids), np.int64)
+            ranks[np.lexsort((self.ids, key))] = np.arange(len(self.ids))
+            self.rank_cache[criteria] = ranks
+        return ranks
+
+    def find(self, query_string, per_page, place, backwards):
+        """The ids of the models on a page of results, in the order they're
+        fetched in: backwards from `place` if `backwards`. Raises
+        `NotIndexed` if the query can't be answered from the index."""
+        tree, orders = parse_query(query_string)
+        orders = search_orders(orders)
+
+        mask = self.mask(tree) if tree is not None else None
+        if mask is None:
+            mask = np.ones(len(self.ids), bool)
+
+        if orders:
+            # Ties are broken by id, so later orders never come into it
+            criteria, reverse = orders[0]
+            column = self.by_criteria.get(criteria)
+            if column is None:
+                raise NotIndexed()
+            desc = reverse != criteria.reversed
+            key = column.sort_key(criteria.default)
+            ranks = self.ranks(criteria, key)
+            place_size = 2 * len(orders)
+        else:
+            column, desc, key = None, False, self.ids
+            ranks = np.arange(len(self.ids))
+            place_size = 1
+
+        if place is not None:
+            if len(place) != place_size:
+                raise NotIndexed()
+            if column is not None:
+                pk, pid = column.place_key(place[0]), place[1]
+            else:
+                pk = pid = place[0]
+            if desc != backwards:
+                mask = mask & ((key < pk) | ((key == pk) & (self.ids < pid)))
+            else:
+                mask = mask & ((key > pk) | ((key == pk) & (self.ids > pid)))
+
+        rows = np.flatnonzero(mask)
+        positions = ranks[rows]
+        if desc != backwards:
+            positions = -positions
+        count = per_page + 1
+        if len(rows) > count:
+            nearest = np.argpartition(positions, count - 1)[:count]
+            rows, positions = rows[nearest], positions[nearest]
+        rows = rows[np.argsort(positions)]
+        return self.ids[rows].tolist(), orders
+
+    async def select_page(self, session, query_string, per_page, page=None):
+        """Like sqlakeyset's `select_page` for the LoRAs matching
+        `query_string`, with the same bookmarks. Returns its `Paging`, or None
+        if the query can't be answered from the index."""
+        place, backwards = unserialize_bookmark(page or "")
+        try:
+            ids, orders = self.find(query_string, per_page, place, backwards)
+        except NotIndexed:
+            return None
+
+        # The places of the rows on the page are read back as SQLite orders
+        # by them, so bookmarks are the same whichever way a page was found
+        keys = [key for criteria, _ in orders for key in criteria.keys()]
+        keys = keys or [LoRAModel.__table__.c.id]
+        stmt = (
+            select(LoRAModel, *keys)
+            .where(LoRAModel.__table__.c.id.in_(ids))
+            .options(selectin_polymorphic(SDModel, [LoRAModel]))
+        )
+        found = {row[0].id: row for row in await session.execute(stmt)}
+        rows = [found[id] for id in ids if id in found]
+        return Paging(
+            [(row[0],) for row in rows],
+            per_page,
+            backwards,
+            place,
+            [tuple(row[1:]) for row in rows],
+        )
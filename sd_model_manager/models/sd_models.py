@@ -5,8 +5,17 @@ from sqlalchemy.orm import (
     Mapped,
     mapped_column,
 )
+import re
+import math
+from datetime import datetime
 from sqlalchemy import (
     func,
+    text,
+    event,
+    table,
+    column,
+    literal,
+    Index,
     Column,
     Integer,
     String,
@@ -16,6 +25,7 @@ from sqlalchemy import (
     Integer,
     LargeBinary,
     Numeric,
+    Float,
 )
 from marshmallow import fields
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
@@ -35,7 +45,73 @@ class PreviewImage(Base):
 
     filepath = Column(String, unique=True)
     is_autogenerated = Column(Boolean)
-    model_id = Column(Integer, ForeignKey("sd_model.id"))
+    model_id = Column(Integer, ForeignKey("sd_model.id"), index=True)
+
+
+class FileFingerprint(Base):
+    """Stat fingerprint of a model file as of the last time its header was read.
+    Used to skip unchanged files when rescanning."""
+
+    __tablename__ = "file_fingerprints"
+
+    model_id = Column(Integer, ForeignKey("sd_model.id"), primary_key=True)
+
+    size = Column(Integer, index=True)
+    mtime_ns = Column(Integer)
+    inode = Column(Integer)
+
+
+class ScannedDirectory(Base):
+    """Modification time of a directory as of the last scan that listed it.
+    Directories whose mtime hasn't changed since aren't listed on rescan."""
+
+    __tablename__ = "scanned_directories"
+
+    id = Column(Integer, primary_key=True)
+
+    root_path = Column(String, index=True)
+    path = Column(String, unique=True)
+    mtime_ns = Column(Integer, nullable=True)
+
+
+class ModelLookup(Base):
+    """A key a model can be referred to by in infotext and workflows: one of
+    its hashes, short hashes or names. Rebuilt by `DB.refresh_lookups`
+    whenever the model's hashes or names change."""
+
+    __tablename__ = "model_lookup"
+
+    id = Column(Integer, primary_key=True)
+
+    model_id = Column(Integer, ForeignKey("sd_model.id"), index=True)
+    kind = Column(String)
+    key = Column(String, index=True)
+
+
+class TrainedTag(Base):
+    """A tag from the `ss_tag_frequency` of any model, stored once so that
+    `ModelTrainedTag` rows can refer to it by id."""
+
+    __tablename__ = "trained_tags"
+
+    id = Column(Integer, primary_key=True)
+
+    name = Column(String, unique=True)
+
+
+class ModelTrainedTag(Base):
+    """How many times a tag appeared in one of the datasets a model was
+    trained on, from its `ss_tag_frequency`. Rebuilt by
+    `DB.refresh_trained_tags` whenever the model's file changes."""
+
+    __tablename__ = "model_trained_tags"
+
+    id = Column(Integer, primary_key=True)
+
+    model_id = Column(Integer, ForeignKey("sd_model.id"), index=True)
+    dataset = Column(String)
+    tag_id = Column(Integer, ForeignKey("trained_tags.id"))
+    count = Column(Integer)
 
 
 class SDModel(Base):
@@ -57,14 +133,29 @@ class SDModel(Base):
     negative_keywords = Column(String, nullable=True)
     version = Column(String, nullable=True)
     description = Column(String, nullable=True)
-    rating = Column(Integer, nullable=True)
+    rating = Column(Integer, nullable=True, index=True)
     pinned = Column(Boolean, nullable=True)
     tags = Column(String, nullable=True)
     notes = Column(String, nullable=True)
 
+    # Derived when the model is scanned, so they can be searched and sorted
+    # by. The number of preview images and the id and path of the first are
+    # kept up to date by triggers on `preview_images`, see
+    # `create_preview_triggers`.
+    file_size = Column(Integer, nullable=True, index=True)
+    preview_count = Column(Integer, nullable=False, default=0, server_default="0")
+    cover_preview_id = Column(Integer, nullable=True)
+    cover_image = Column(String, nullable=True)
+
     preview_images = relationship(
         "PreviewImage", backref="sd_model", cascade="all, delete-orphan"
     )
+    fingerprint = relationship(
+        "FileFingerprint",
+        uselist=False,
+        backref="sd_model",
+        cascade="all, delete-orphan",
+    )
 
     __mapper_args__ = {
         "polymorphic_identity": "sd_model",
@@ -87,6 +178,12 @@ class LoRAModel(SDModel):
     model_hash = Column(String, nullable=True)
     legacy_hash = Column(String, nullable=True)
 
+    # Computed by hashing the file, and cleared when it changes
+    sha256 = Column(String, nullable=True)
+    autov1 = Column(String, nullable=True)
+    autov2 = Column(String, nullable=True)
+    autov3 = Column(String, nullable=True)
+
     session_id = Column(Integer, nullable=True)
     training_started_at = Column(DateTime, nullable=True)
     training_finished_at = Column(DateTime, nullable=True)
@@ -110,6 +207,10 @@ class LoRAModel(SDModel):
     module_name = Column(String, nullable=True)
     network_dim = Column(String, nullable=True)
     network_alpha = Column(String, nullable=True)
+    # network_dim and network_alpha as numbers, for searching and sorting.
+    # The strings are kept as they were written in the metadata.
+    network_dim_value = Column(Float, nullable=True, index=True)
+    network_alpha_value = Column(Float, nullable=True, index=True)
     network_args = Column(JSON, nullable=True)
     mixed_precision = Column(Boolean, nullable=True)
     full_fp16 = Column(Boolean, nullable=True)
@@ -132,7 +233,7 @@ class LoRAModel(SDModel):
     dataset_dirs = Column(JSON, nullable=True)
     reg_dataset_dirs = Column(JSON, nullable=True)
     tag_frequency = Column(JSON, nullable=True)
-    unique_tags = Column(Integer, nullable=True)
+    unique_tags = Column(Integer, nullable=True, index=True)
     sd_model_name = Column(String, nullable=True)
     sd_model_hash = Column(String, nullable=True)
     new_sd_model_hash = Column(String, nullable=True)
@@ -143,6 +244,11 @@ class LoRAModel(SDModel):
     bucket_info = Column(JSON, nullable=True)
     sd_scripts_commit_hash = Column(String, nullable=True)
     optimizer = Column(String, nullable=True)
+    # optimizer split into its class name and arguments, see `optimizer_parts`
+    optimizer_name = Column(String, nullable=True)
+    optimizer_args = Column(String, nullable=True)
+    # The first 12 characters of model_hash, as the webui shows it
+    short_hash = Column(String, nullable=True)
     max_grad_norm = Column(Numeric, nullable=True)
     caption_dropout_rate = Column(Numeric, nullable=True)
     caption_dropout_every_n_epochs = Column(Integer, nullable=True)
@@ -156,6 +262,195 @@ class LoRAModel(SDModel):
         return f"{self.__class__.__name__}({self.filepath!r})"
 
 
+def network_size(value):
+    """The number a `network_dim` or `network_alpha` string stands for, or
+    None if it isn't one."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number):
+        return None
+    return number
+
+
+re_optimizer = re.compile(r"([^.]+)(\(.*\))?$")
+
+
+def optimizer_parts(optimizer):
+    """The class name and arguments in an `ss_optimizer` string like
+    `bitsandbytes.optim.adamw.AdamW8bit(weight_decay=0.1)`. Either is None if
+    it's missing."""
+    if optimizer is None:
+        return None, None
+    matches = re_optimizer.search(optimizer)
+    if matches is None:
+        return optimizer, None
+    args = matches[2]
+    if args is not None:
+        args = args[1:-1]
+    return matches[1], args
+
+
+def short_hash(model_hash):
+    if not model_hash:
+        return None
+    return model_hash[0:12]
+
+
+def coalesced(column, default):
+    """`column` with NULLs replaced by `default`, which is how models are
+    sorted. The default is written into the SQL rather than bound, so SQLite
+    can match the expression to the sorting indexes below."""
+    return func.coalesce(column, literal(default, literal_execute=True))
+
+
+# Sorting indexes end in the id, which keyset paging breaks ties with
+Index("ix_sd_model_order_rating", coalesced(SDModel.rating, 0), SDModel.id)
+Index("ix_sd_model_order_name", coalesced(SDModel.display_name, ""), SDModel.id)
+Index("ix_sd_model_order_root_path", coalesced(SDModel.root_path, ""), SDModel.id)
+Index("ix_sd_model_order_file_size", coalesced(SDModel.file_size, 0), SDModel.id)
+Index(
+    "ix_sd_model_order_preview_count", coalesced(SDModel.preview_count, 0), SDModel.id
+)
+Index(
+    "ix_lora_model_order_network_dim_value",
+    coalesced(LoRAModel.network_dim_value, 0),
+    LoRAModel.__table__.c.id,
+)
+Index(
+    "ix_lora_model_order_network_alpha_value",
+    coalesced(LoRAModel.network_alpha_value, 0),
+    LoRAModel.__table__.c.id,
+)
+Index(
+    "ix_lora_model_order_unique_tags",
+    coalesced(LoRAModel.unique_tags, 0),
+    LoRAModel.__table__.c.id,
+)
+Index(
+    "ix_lora_model_order_training_started_at",
+    coalesced(LoRAModel.training_started_at, datetime.min),
+    LoRAModel.__table__.c.id,
+)
+
+# Exact string searches compare lowercased values
+Index("ix_lora_model_module_name", func.lower(LoRAModel.module_name))
+Index("ix_lora_model_model_hash", func.lower(LoRAModel.model_hash))
+Index("ix_lora_model_sha256", func.lower(LoRAModel.sha256))
+Index("ix_lora_model_short_hash", func.lower(LoRAModel.short_hash))
+Index("ix_lora_model_optimizer_name", func.lower(LoRAModel.optimizer_name))
+Index("ix_trained_tags_name", func.lower(TrainedTag.name))
+
+# Tag searches start from the tag and sum its counts per model
+Index(
+    "ix_model_trained_tags_tag",
+    ModelTrainedTag.tag_id,
+    ModelTrainedTag.model_id,
+    ModelTrainedTag.count,
+)
+
+
+# Text columns covered by the full-text index, for free-text searches and
+# string qualifiers
+SEARCH_COLUMNS = [
+    "display_name",
+    "filepath",
+    "filename",
+    "root_path",
+    "author",
+    "source",
+    "keywords",
+    "description",
+    "tags",
+    "notes",
+]
+
+# An FTS5 table over `sd_model` that stores only the index, and reads column
+# values from `sd_model` itself. SQLAlchemy can't declare virtual tables, so
+# it's created below and queried through this lightweight table.
+model_search = table(
+    "model_search",
+    column("rowid", Integer),
+    column("model_search"),
+    column("rank"),
+    *[column(name, String) for name in SEARCH_COLUMNS],
+)
+
+
+def has_full_text_search(conn):
+    return bool(
+        conn.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar()
+    )
+
+
+def create_search_index(target, conn, **kw):
+    """Creates the full-text index and the triggers that keep it in step with
+    `sd_model`, if this SQLite has FTS5. Returns whether it was created."""
+    if not has_full_text_search(conn):
+        return False
+
+    columns = ", ".join(SEARCH_COLUMNS)
+    new = ", ".join(f"new.{name}" for name in SEARCH_COLUMNS)
+    old = ", ".join(f"old.{name}" for name in SEARCH_COLUMNS)
+    delete = (
+        f"INSERT INTO model_search(model_search, rowid, {columns}) "
+        f"VALUES ('delete', old.id, {old});"
+    )
+    insert = f"INSERT INTO model_search(rowid, {columns}) VALUES (new.id, {new});"
+
+    for ddl in [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS model_search USING fts5({columns}, "
+        "content='sd_model', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS sd_model_search_insert AFTER INSERT ON sd_model "
+        f"BEGIN {insert} END",
+        "CREATE TRIGGER IF NOT EXISTS sd_model_search_delete AFTER DELETE ON sd_model "
+        f"BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS sd_model_search_update AFTER UPDATE OF {columns} "
+        f"ON sd_model BEGIN {delete} {insert} END",
+    ]:
+        conn.execute(text(ddl))
+    return True
+
+
+event.listen(SDModel.__table__, "after_create", create_search_index)
+
+
+def create_preview_triggers(target, conn, **kw):
+    """Creates the triggers that keep each model's `preview_count`, and the
+    id and path of its first preview image, in step with `preview_images`.
+    They run in the same transaction as the change to the images, so
+    searches and listings can rely on these instead of joining them."""
+
+    def refresh(row):
+        first = (
+            f"FROM preview_images WHERE model_id = {row}.model_id ORDER BY id LIMIT 1"
+        )
+        return (
+            "UPDATE sd_model SET "
+            "preview_count = (SELECT count(*) FROM preview_images "
+            f"WHERE model_id = {row}.model_id), "
+            f"cover_preview_id = (SELECT id {first}), "
+            f"cover_image = (SELECT filepath {first}) "
+            f"WHERE id = {row}.model_id;"
+        )
+
+    for ddl in [
+        "CREATE TRIGGER IF NOT EXISTS preview_images_insert AFTER INSERT "
+        f"ON preview_images BEGIN {refresh('new')} END",
+        "CREATE TRIGGER IF NOT EXISTS preview_images_delete AFTER DELETE "
+        f"ON preview_images BEGIN {refresh('old')} END",
+        "CREATE TRIGGER IF NOT EXISTS preview_images_update AFTER UPDATE OF "
+        f"model_id, filepath ON preview_images BEGIN {refresh('old')} "
+        f"{refresh('new')} END",
+    ]:
+        conn.execute(text(ddl))
+
+
+event.listen(PreviewImage.__table__, "after_create", create_preview_triggers)
+
+
 class PreviewImageSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = PreviewImage
@@ -7,107 +7,146 @@ if __name__ == "__main__":
 
 import re
 from datetime import datetime
-from typing import Optional, Pattern
-from sqlalchemy import create_engine, func, select, not_, or_, and_, nulls_last, exists
-
-from sd_model_manager.models.sd_models import SDModel, LoRAModel, LoRAModelSchema
+from dataclasses import dataclass
+from sqlalchemy import func, select, not_, or_, and_
+
+from sd_model_manager.models.sd_models import (
+    SDModel,
+    LoRAModel,
+    LoRAModelSchema,
+    TrainedTag,
+    ModelTrainedTag,
+    coalesced,
+    model_search,
+    SEARCH_COLUMNS,
+)
+
+
+def search_phrase(columns, text):
+    """An FTS5 query for words in `columns` starting with those in `text`,
+    or None if `text` has no words to look up."""
+    if not any(c.isalnum() for c in text):
+        return None
+    text = text.replace('"', '""')
+    return f'{{{" ".join(columns)}}} : "{text}"*'
+
+
+def in_search(phrase):
+    return SDModel.id.in_(
+        select(model_search.c.rowid).where(model_search.c.model_search.match(phrase))
+    )
+
+
+def compare(column, op, value):
+    if op == "!=":
+        return column != value
+    elif op == ">":
+        return column > value
+    elif op == "<":
+        return column < value
+    elif op == ">=":
+        return column >= value
+    elif op == "<=":
+        return column <= value
+    return column == value
+
+
+OPERATOR_RE = re.compile(r"(==|!=|>=|<=|>|<)?(.*)")
+
+
+def parse_comparison(value, type):
+    """The `(op, value)` comparisons a qualifier value like `7`, `>=7`, or a
+    range like `1e-4..5e-4` or `..5` stands for, whose ends are inclusive.
+    None if the value isn't a valid `type`."""
+    try:
+        low, dots, high = value.partition("..")
+        if dots:
+            if not low and not high:
+                return None
+            return [
+                *([(">=", type(low))] if low else []),
+                *([("<=", type(high))] if high else []),
+            ]
+        m = OPERATOR_RE.fullmatch(value)
+        return [(m[1] or "==", type(m[2]))]
+    except (TypeError, ValueError, ArithmeticError):
+        return None
+
+
+def compare_value(column, value, type):
+    """`column` compared with a qualifier value, see `parse_comparison`.
+    None if the value isn't a valid `type`."""
+    comparisons = parse_comparison(value, type)
+    if comparisons is None:
+        return None
+    return and_(*[compare(column, op, v) for op, v in comparisons])
 
 
 class AbstractCriteria:
-    re: Optional[Pattern]
-
-    def apply(self, orm_query, query_string):
-        if self.re is not None:
-            matches = self.re.search(query_string)
-            if matches is None:
-                return orm_query, query_string
-            query_string = re.sub(self.re, "", query_string).strip()
-            return self.do_apply(orm_query, matches), query_string
-
-        return self.do_apply(orm_query, query_string), query_string
-
-    def do_apply(self, orm_query, matches):
+    def compile(self, value, negate, scope):
+        """An SQL expression for models matching this criteria with `value`,
+        or not matching it if `negate`. NULLs count as not matching, so the
+        expression itself is never NULL. None if `value` can't be used."""
         pass
 
 
 class StringCriteria(AbstractCriteria):
     def __init__(self, prefix, column, exact=False):
-        self.re = re.compile(rf'(^| +)(-)?{prefix}:("([^"]+)"|(\S+))', re.I)
         self.prefix = prefix
         self.column = column
         self.exact = exact
 
-    def do_apply(self, orm_query, matches):
-        _not = matches[2]
-        m = matches[4] or matches[3]
+    def search_phrase(self, value):
+        if self.exact or self.column.key not in SEARCH_COLUMNS:
+            return None
+        return search_phrase([self.column.key], value)
+
+    def compile(self, value, negate, scope):
         if self.exact:
-            stmt = func.lower(self.column) == m.lower()
+            stmt = func.lower(self.column) == value.lower()
         else:
-            stmt = self.column.ilike(f"%{m}%")
-        if _not:
-            stmt = or_(self.column.is_(None), not_(stmt))
-        return orm_query.where(stmt)
+            stmt = self.column.ilike(f"%{value}%")
+        if negate:
+            return or_(self.column.is_(None), not_(stmt))
+        return and_(self.column.is_not(None), stmt)
 
 
 class NumberCriteria(AbstractCriteria):
     def __init__(self, prefix, column, type):
-        self.re = re.compile(
-            rf"(^| +)(-)?{prefix}:(==|!=|>|<|>=|<=)?(\d+(?:\.\d+)?)", re.I
-        )
         self.prefix = prefix
         self.column = column
         self.type = type
 
-    def do_apply(self, orm_query, matches):
-        _not = matches[2]
-        op = matches[3] or "=="
-        try:
-            num = self.type(matches[4])
-        except Exception:
-            return orm_query
-        if op == "!=":
-            stmt = self.column != num
-        elif op == ">":
-            stmt = self.column > num
-        elif op == "<":
-            stmt = self.column < num
-        elif op == ">=":
-            stmt = self.column >= num
-        elif op == "<=":
-            stmt = self.column <= num
-        else:
-            stmt = self.column == num
-
-        if _not:
-            stmt = or_(self.column.is_(None), not_(stmt))
-        else:
-            stmt = and_(self.column.is_not(None), stmt)
-
-        return orm_query.where(stmt)
+    def compile(self, value, negate, scope):
+        stmt = compare_value(self.column, value, self.type)
+        if stmt is None:
+            return None
+        if negate:
+            return or_(self.column.is_(None), not_(stmt))
+        return and_(self.column.is_not(None), stmt)
 
 
 class HasCriteria(AbstractCriteria):
     def __init__(self, suffix, column, compare="", count=False):
-        self.re = re.compile(rf"(^| +)(-)?has:{suffix}", re.I)
         self.suffix = suffix
         self.column = column
         self.compare = ""
         self.count = count
 
-    def do_apply(self, orm_query, matches):
-        no = matches[2] is not None
+    def compile(self, value, negate, scope):
         if self.count:
-            stmt = self.column.any()
+            # A column counting related rows, kept up to date on writes so
+            # that they needn't be looked at
+            stmt = coalesced(self.column, 0) > 0
         else:
             stmt = and_(self.column.is_not(None), self.column != self.compare)
-        if no:
+        if negate:
             stmt = not_(stmt)
-        return orm_query.where(stmt)
+        return stmt
 
 
 class OrderByCriteria(AbstractCriteria):
     def __init__(self, suffix, column, reversed=None, default=""):
-        self.re = re.compile(rf"(^| +)order(:reverse)?:{suffix}", re.I)
         self.suffix = suffix
         self.column = column
         self.reversed = reversed or False
@@ -115,31 +154,340 @@ class OrderByCriteria(AbstractCriteria):
             self.reversed = isinstance(default, (int, float))
         self.default = default
 
-    def do_apply(self, orm_query, matches):
-        reverse = matches[2] is not None
+    def keys(self):
+        """What results are ordered by, ascending: the column, with NULLs as
+        the default, then the id of the same table, so that an index on the
+        column can cover the whole order."""
+        return coalesced(self.column, self.default), self.column.expression.table.c.id
+
+    def apply(self, orm_query, reverse):
         if self.reversed:
             reverse = not reverse
-        order = func.coalesce(self.column, self.default)
+        keys = self.keys()
         if reverse:
-            order = order.desc()
-        return orm_query.order_by(order)
+            keys = [key.desc() for key in keys]
+        return orm_query.order_by(*keys)
 
 
-class BasicCriteria(AbstractCriteria):
-    def __init__(self):
-        self.re = None
-
-    def do_apply(self, orm_query, query_string):
-        for s in query_string.split(" "):
-            s = s.strip()
-            if s:
-                orm_query = orm_query.where(
-                    or_(
-                        SDModel.display_name.ilike(f"%{s}%"),
-                        SDModel.filepath.ilike(f"%{s}%"),
+class TrainedTagCriteria(AbstractCriteria):
+    """Matches models trained on a tag, going by their `ss_tag_frequency`.
+    `trained_tag_count:` qualifiers alongside it limit this to models that
+    saw the tag that many times, over all their datasets. On their own, they
+    match models that saw any one tag that many times."""
+
+    def __init__(self, prefix, count_prefix):
+        self.prefix = prefix
+        self.count_prefix = count_prefix
+
+    def compile(self, value, negate, scope):
+        stmt = select(ModelTrainedTag.model_id)
+        if value is not None:
+            stmt = stmt.where(
+                ModelTrainedTag.tag_id.in_(
+                    select(TrainedTag.id).where(
+                        func.lower(TrainedTag.name) == value.lower()
                     )
                 )
-        return orm_query
+            )
+        counts = scope.get(self, [])
+        if counts:
+            if value is None:
+                stmt = stmt.group_by(ModelTrainedTag.tag_id)
+            having = [
+                compare_value(func.sum(ModelTrainedTag.count), count, int)
+                for count in counts
+            ]
+            if any(h is None for h in having):
+                return None
+            stmt = stmt.group_by(ModelTrainedTag.model_id).having(*having)
+        stmt = SDModel.id.in_(stmt)
+        if negate:
+            stmt = not_(stmt)
+        return stmt
+
+
+class BasicCriteria(AbstractCriteria):
+    """Unqualified text, searched for in the name and filepath."""
+
+    def search_phrase(self, value):
+        return search_phrase(["display_name", "filepath"], value)
+
+    def compile(self, value, negate, scope):
+        stmt = or_(
+            and_(
+                SDModel.display_name.is_not(None),
+                SDModel.display_name.ilike(f"%{value}%"),
+            ),
+            SDModel.filepath.ilike(f"%{value}%"),
+        )
+        if negate:
+            stmt = not_(stmt)
+        return stmt
+
+
+# Query syntax tree. Qualifiers keep their name and value as typed, text
+# terms have no name.
+
+
+@dataclass
+class Term:
+    name: str
+    value: str
+
+
+@dataclass
+class Not:
+    node: object
+
+
+@dataclass
+class And:
+    nodes: list
+
+
+@dataclass
+class Or:
+    nodes: list
+
+
+TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<open>\()
+    | (?P<close>\))
+    | (?P<or>(?:OR|\|)(?=[\s()]|$))
+    | (?P<and>AND(?=[\s()]|$))
+    | (?P<not>-(?=[^\s)]))
+    | (?:(?P<name>[A-Za-z_]\w*):)?
+      (?:"(?P<quoted>[^"]*)"?|(?P<value>[^\s()"]*))
+    """,
+    re.X,
+)
+
+
+def tokenize(query_string):
+    """Splits a query into `(kind, name, value)` tokens in one pass."""
+    tokens = []
+    pos = 0
+    while pos < len(query_string):
+        m = TOKEN_RE.match(query_string, pos)
+        if m.end() == pos:
+            # A stray quote or similar, which no token starts with
+            tokens.append(("term", None, query_string[pos]))
+            pos += 1
+            continue
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "space":
+            continue
+        if kind in ("open", "close", "or", "and", "not"):
+            tokens.append((kind, None, None))
+            continue
+        name = m["name"]
+        value = m["quoted"] if m["quoted"] is not None else m["value"]
+        if name is not None and m["quoted"] is None and not value:
+            # `name:` with nothing after it yet is just text
+            name, value = None, f"{name}:"
+        if value:
+            tokens.append(("term", name.lower() if name else None, value))
+    return tokens
+
+
+class Parser:
+    """Parses query tokens into a syntax tree, forgivingly: a query typed
+    into a search box is usually unfinished, so stray operators are dropped
+    and unclosed parentheses are closed at the end.
+
+        query := or*
+        or    := and ("OR" and)*
+        and   := unary ("AND"? unary)*
+        unary := "-" unary | "(" query ")" | term
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.orders = []
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def parse(self):
+        nodes = []
+        while self.peek() is not None:
+            node = self.parse_or()
+            if node is not None:
+                nodes.append(node)
+            elif self.peek() is not None:
+                # Nothing to parse here, like a stray ")"
+                self.pos += 1
+        return make_and(nodes)
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == "or":
+            self.pos += 1
+            nodes.append(self.parse_and())
+        nodes = [n for n in nodes if n is not None]
+        if len(nodes) == 1:
+            return nodes[0]
+        return Or(nodes) if nodes else None
+
+    def parse_and(self):
+        nodes = []
+        while self.peek() not in (None, "or", "close"):
+            if self.peek() == "and":
+                self.pos += 1
+                continue
+            node = self.parse_unary()
+            if node is not None:
+                nodes.append(node)
+        return make_and(nodes)
+
+    def parse_unary(self):
+        kind, name, value = self.tokens[self.pos]
+        self.pos += 1
+        if kind == "not":
+            if self.peek() in (None, "or", "close"):
+                return None
+            if self.peek() == "term" and self.tokens[self.pos][1] == "order":
+                return self.parse_unary()
+            node = self.parse_unary()
+            return Not(node) if node is not None else None
+        if kind == "open":
+            nodes = []
+            while self.peek() not in (None, "close"):
+                node = self.parse_or()
+                if node is not None:
+                    nodes.append(node)
+            if self.peek() == "close":
+                self.pos += 1
+            return make_and(nodes)
+        if kind == "term":
+            if name == "order":
+                self.orders.append(value)
+                return None
+            return Term(name, value)
+        # AND or OR where a term should be
+        return None
+
+
+def make_and(nodes):
+    if not nodes:
+        return None
+    if len(nodes) == 1:
+        return nodes[0]
+    return And(nodes)
+
+
+def parse_query(query_string):
+    """Parses a search query into `(tree, orders)`: the syntax tree of its
+    filters, or None if it has none, and the values of its `order:`
+    qualifiers, in the order they were given."""
+    parser = Parser(tokenize(query_string))
+    tree = parser.parse()
+    return tree, parser.orders
+
+
+class Compiler:
+    """Compiles a query's syntax tree into one SQL expression. With
+    `full_text`, text is looked up in the full-text index. Negations are
+    pushed down to the criteria, so that each can decide how NULLs count."""
+
+    def __init__(self, full_text=False):
+        self.full_text = full_text
+
+    def lookup(self, term):
+        if term.name is None:
+            return BASIC_CRITERIA, term.value
+        if term.name in SCOPE_QUALIFIERS:
+            return SCOPE_QUALIFIERS[term.name], None
+        if term.name == "has":
+            criteria = HAS_CRITERIA.get(term.value.lower())
+            return criteria, term.value
+        criteria = QUALIFIERS.get(term.name)
+        if criteria is None:
+            # Not a qualifier after all, so search for it as text
+            return BASIC_CRITERIA, f"{term.name}:{term.value}"
+        return criteria, term.value
+
+    def search_phrase(self, node):
+        """The full-text query for `node`, if all of it can be matched in the
+        full-text index."""
+        if not self.full_text:
+            return None
+        if isinstance(node, Term):
+            criteria, value = self.lookup(node)
+            if hasattr(criteria, "search_phrase"):
+                return criteria.search_phrase(value)
+            return None
+        if isinstance(node, (And, Or)):
+            phrases = [self.search_phrase(n) for n in node.nodes]
+            if any(p is None for p in phrases):
+                return None
+            op = " AND " if isinstance(node, And) else " OR "
+            return f"({op.join(phrases)})"
+        return None
+
+    def compile(self, node, negate=False, scope=None):
+        scope = scope or {}
+        phrase = self.search_phrase(node)
+        if phrase is not None:
+            stmt = in_search(phrase)
+            return not_(stmt) if negate else stmt
+
+        if isinstance(node, Not):
+            return self.compile(node.node, not negate, scope)
+        if isinstance(node, Or):
+            nodes = node.nodes
+            # NOT (a OR b) is NOT a AND NOT b
+            combine = and_ if negate else or_
+        elif isinstance(node, And):
+            nodes, scope = self.scoped(node.nodes, scope)
+            combine = or_ if negate else and_
+        elif node.name in SCOPE_QUALIFIERS:
+            # Nothing here for it to modify, so it's a search of its own
+            criteria = SCOPE_QUALIFIERS[node.name]
+            scope = {**scope, criteria: scope.get(criteria, []) + [node.value]}
+            return criteria.compile(None, negate, scope)
+        else:
+            criteria, value = self.lookup(node)
+            if criteria is None:
+                return None
+            return criteria.compile(value, negate, scope)
+
+        stmts = [self.compile(n, negate, scope) for n in nodes]
+        stmts = [s for s in stmts if s is not None]
+        if not stmts:
+            return None
+        return combine(*stmts)
+
+    def scoped(self, nodes, scope):
+        """Takes qualifiers that modify others in the same group, like
+        `trained_tag_count:`, out of `nodes` and into the scope the rest are
+        compiled in."""
+        rest = []
+        scope = dict(scope)
+        for node in nodes:
+            criteria = None
+            if isinstance(node, Term) and node.name is not None:
+                criteria = SCOPE_QUALIFIERS.get(node.name)
+            if criteria is not None and any(self.uses(n, criteria) for n in nodes):
+                scope[criteria] = scope.get(criteria, []) + [node.value]
+            else:
+                rest.append(node)
+        return rest, scope
+
+    def uses(self, node, criteria):
+        if isinstance(node, Term):
+            return node.name is not None and QUALIFIERS.get(node.name) is criteria
+        if isinstance(node, Not):
+            return self.uses(node.node, criteria)
+        if isinstance(node, (And, Or)):
+            return any(self.uses(n, criteria) for n in node.nodes)
+        return False
 
 
 ALL_CRITERIA = [
@@ -157,13 +505,16 @@ ALL_CRITERIA = [
     OrderByCriteria("tags", SDModel.tags),
     OrderByCriteria("rating", LoRAModel.rating, default=0),
     OrderByCriteria("notes", SDModel.notes),
-    OrderByCriteria("network_dim", LoRAModel.network_dim),
-    OrderByCriteria("dim", LoRAModel.network_dim),
-    OrderByCriteria("network_alpha", LoRAModel.network_alpha),
-    OrderByCriteria("alpha", LoRAModel.network_alpha),
+    OrderByCriteria("file_size", SDModel.file_size, default=0),
+    OrderByCriteria("preview_count", SDModel.preview_count, default=0),
+    OrderByCriteria("network_dim", LoRAModel.network_dim_value, default=0),
+    OrderByCriteria("dim", LoRAModel.network_dim_value, default=0),
+    OrderByCriteria("network_alpha", LoRAModel.network_alpha_value, default=0),
+    OrderByCriteria("alpha", LoRAModel.network_alpha_value, default=0),
     OrderByCriteria("resolution", LoRAModel.resolution_width, default=0),
     OrderByCriteria("unique_tags", LoRAModel.unique_tags, default=0),
     OrderByCriteria("keep_tokens", LoRAModel.keep_tokens, default=0),
+    OrderByCriteria("optimizer", LoRAModel.optimizer_name),
     OrderByCriteria("noise_offset", LoRAModel.noise_offset, default=0.0),
     OrderByCriteria("num_train_images", LoRAModel.num_train_images, default=0),
     OrderByCriteria("train_images", LoRAModel.num_train_images, default=0),
@@ -190,15 +541,20 @@ ALL_CRITERIA = [
     StringCriteria("network_module", LoRAModel.network_module, exact=True),
     StringCriteria("module_name", LoRAModel.module_name, exact=True),
     StringCriteria("module", LoRAModel.module_name, exact=True),
-    StringCriteria("network_dim", LoRAModel.network_dim, exact=True),
-    StringCriteria("dim", LoRAModel.network_dim, exact=True),
-    StringCriteria("network_alpha", LoRAModel.network_alpha, exact=True),
-    StringCriteria("alpha", LoRAModel.network_alpha, exact=True),
     StringCriteria("model_hash", LoRAModel.model_hash, exact=True),
     StringCriteria("hash", LoRAModel.model_hash, exact=True),
     StringCriteria("legacy_hash", LoRAModel.legacy_hash, exact=True),
+    StringCriteria("sha256", LoRAModel.sha256, exact=True),
+    StringCriteria("autov1", LoRAModel.autov1, exact=True),
+    StringCriteria("autov2", LoRAModel.autov2, exact=True),
+    StringCriteria("autov3", LoRAModel.autov3, exact=True),
+    StringCriteria("short_hash", LoRAModel.short_hash, exact=True),
+    StringCriteria("optimizer", LoRAModel.optimizer_name, exact=True),
+    StringCriteria("optimizer_args", LoRAModel.optimizer_args),
     NumberCriteria("id", SDModel.id, int),
     NumberCriteria("rating", SDModel.rating, int),
+    NumberCriteria("file_size", SDModel.file_size, int),
+    NumberCriteria("preview_count", SDModel.preview_count, int),
     NumberCriteria("unique_tags", LoRAModel.unique_tags, int),
     NumberCriteria("num_epochs", LoRAModel.num_epochs, int),
     NumberCriteria("epochs", LoRAModel.num_epochs, int),
@@ -206,6 +562,10 @@ ALL_CRITERIA = [
     NumberCriteria("session_id", LoRAModel.session_id, int),
     NumberCriteria("resolution", LoRAModel.resolution_width, int),
     NumberCriteria("keep_tokens", LoRAModel.keep_tokens, int),
+    NumberCriteria("network_dim", LoRAModel.network_dim_value, float),
+    NumberCriteria("dim", LoRAModel.network_dim_value, float),
+    NumberCriteria("network_alpha", LoRAModel.network_alpha_value, float),
+    NumberCriteria("alpha", LoRAModel.network_alpha_value, float),
     NumberCriteria("learning_rate", LoRAModel.learning_rate, float),
     NumberCriteria("lr", LoRAModel.learning_rate, float),
     NumberCriteria("text_encoder_lr", LoRAModel.text_encoder_lr, float),
@@ -225,8 +585,8 @@ ALL_CRITERIA = [
     HasCriteria("description", SDModel.description),
     HasCriteria("tags", SDModel.tags),
     HasCriteria("rating", SDModel.rating, 0),
-    HasCriteria("image", SDModel.preview_images, 0, count=True),
-    HasCriteria("preview_image", SDModel.preview_images, 0, count=True),
+    HasCriteria("image", SDModel.preview_count, 0, count=True),
+    HasCriteria("preview_image", SDModel.preview_count, 0, count=True),
     HasCriteria("vae", LoRAModel.vae_hash),
     HasCriteria("tag_frequency", LoRAModel.unique_tags),
     HasCriteria("dataset_dirs", LoRAModel.dataset_dirs),
@@ -234,14 +594,81 @@ ALL_CRITERIA = [
     HasCriteria("network_args", LoRAModel.network_args),
     HasCriteria("noise_offset", LoRAModel.noise_offset, 0.0),
     HasCriteria("keep_tokens", LoRAModel.keep_tokens.is_not(None), 0),
-    BasicCriteria(),
+    TrainedTagCriteria("trained_tag", "trained_tag_count"),
 ]
 
 
-def build_search_query(orm_query, query_string):
-    for criteria in ALL_CRITERIA:
-        orm_query, query_string = criteria.apply(orm_query, query_string)
+BASIC_CRITERIA = BasicCriteria()
+
+# Criteria by qualifier, so that parsing doesn't depend on how many there are
+QUALIFIERS = {}
+for criteria in ALL_CRITERIA:
+    if isinstance(criteria, (StringCriteria, NumberCriteria, TrainedTagCriteria)):
+        QUALIFIERS.setdefault(criteria.prefix, criteria)
+SCOPE_QUALIFIERS = {
+    c.count_prefix: c for c in ALL_CRITERIA if isinstance(c, TrainedTagCriteria)
+}
+HAS_CRITERIA = {c.suffix: c for c in ALL_CRITERIA if isinstance(c, HasCriteria)}
+ORDER_CRITERIA = {c.suffix: c for c in ALL_CRITERIA if isinstance(c, OrderByCriteria)}
 
+
+def search_orders(orders):
+    """The `(criteria, reverse)` pairs of the `order:` values of a query that
+    name an ordering."""
+    result = []
+    for order in orders:
+        reverse = order.lower().startswith("reverse:")
+        if reverse:
+            order = order[len("reverse:") :]
+        criteria = ORDER_CRITERIA.get(order.lower())
+        if criteria is not None:
+            result.append((criteria, reverse))
+    return result
+
+
+def build_search_query(orm_query, query_string, full_text=False):
+    """Filters and orders `orm_query` by `query_string`. With `full_text`,
+    text is looked up in the full-text index, matching the start of words,
+    and results not given an order are ranked by relevance."""
+    tree, orders = parse_query(query_string)
+    compiler = Compiler(full_text)
+
+    # Full-text terms that every result has to match are looked up together
+    # in one join, which also gives the relevance to rank results by
+    nodes = []
+    if tree is not None:
+        nodes = tree.nodes if isinstance(tree, And) else [tree]
+    phrases = []
+    rest = []
+    for node in nodes:
+        phrase = compiler.search_phrase(node)
+        if phrase is not None:
+            phrases.append(phrase)
+        else:
+            rest.append(node)
+
+    if rest:
+        stmt = compiler.compile(make_and(rest))
+        if stmt is not None:
+            orm_query = orm_query.where(stmt)
+    if phrases:
+        orm_query = orm_query.join(
+            model_search, model_search.c.rowid == SDModel.id
+        ).where(model_search.c.model_search.match(" AND ".join(phrases)))
+
+    ordered = False
+    for criteria, reverse in search_orders(orders):
+        orm_query = criteria.apply(orm_query, reverse)
+        ordered = True
+
+    if phrases and not ordered:
+        orm_query = orm_query.order_by(model_search.c.rank)
+
+    # Keyset paging needs a unique order to page through. Orderings end in
+    # an id already; otherwise use the id of the subclass table, which is
+    # what its indexes end in.
+    if not ordered:
+        orm_query = orm_query.order_by(LoRAModel.__table__.c.id)
     return orm_query
 
 
@@ -264,6 +691,8 @@ When using a `query` parameter to search for models, you can use some special sy
 
 An unqualified search term like `some text` will search for the text in the model's name or filepath.
 
+Text searches use SQLite's full-text index where it's available, and match the start of words rather than anywhere in the text: `light` finds `detailed_lighting.safetensors` but `ghting` doesn't. Results without an `order:` qualifier are sorted by how well they match.
+
 You can search by a fuzzy value with qualifiers like `id:123` or `name:"detailed lighting"`.
 
 Additionally, for numeric queries you can use comparison operators like `rating:>=7`. List of operators:
@@ -275,10 +704,16 @@ Additionally, for numeric queries you can use comparison operators like `rating:
 - `>=`
 - `<=`
 
+Numeric queries also take ranges, which include both ends: `lr:1e-4..5e-4`. Either end can be left off, as in `rating:7..`.
+
 Any search qualifier can be negated by prepending `-` to the front: `-name:"bad quality"`
 
+Terms must all match by default. Use `OR` (or `|`) to match either of two terms, and parentheses to group them: `(dim:32 OR dim:64) -tags:anime`. Groups can be negated too: `-(author:someone OR rating:<3)`. A qualifier can be given more than once, like `tags:style tags:anime`.
+
 Some criteria can also be used with the `has:` qualifier to check for existence of the field: `has:image`
 
+To search by the tags a model was trained on, use `trained_tag:"blue hair"`. Add `trained_tag_count:>=50` to only match models that saw the tag at least that many times in their training data.
+
 ### List of Qualifiers
 
 #### Strings:
@@ -21,6 +21,94 @@ p.add_argument("-c", "--config-file", is_config_file=True, help="Config file pat
 p.add_argument("-l", "--listen", type=str, default="127.0.0.1")
 p.add_argument("-p", "--port", type=int, default=7779)
 p.add_argument("--model-paths", type=str, nargs="+")
+p.add_argument(
+    "--rescan",
+    action="store_true",
+    help="Rescan model paths for new, changed or deleted files on startup",
+)
+p.add_argument(
+    "--scan-workers",
+    type=int,
+    default=None,
+    help="Number of workers reading model headers during a scan (default: CPU count)",
+)
+p.add_argument(
+    "--scan-processes",
+    action="store_true",
+    help="Use a process pool instead of threads for scan workers",
+)
+p.add_argument(
+    "--watch",
+    action="store_true",
+    help="Watch model paths and keep the database up to date while running",
+)
+p.add_argument(
+    "--watch-polling",
+    action="store_true",
+    help="Poll model paths for changes instead of using filesystem notifications",
+)
+p.add_argument(
+    "--watch-interval",
+    type=float,
+    default=1.0,
+    help="Seconds between polls when watching by polling",
+)
+p.add_argument(
+    "--background-hashing",
+    action="store_true",
+    help="Hash models that have no hashes in the background while running",
+)
+p.add_argument(
+    "--hash-rate-limit",
+    type=float,
+    default=64,
+    help="Maximum MiB per second read when hashing models, 0 for no limit",
+)
+p.add_argument(
+    "--db-journal-mode",
+    type=str,
+    default="wal",
+    choices=["wal", "delete", "truncate", "persist"],
+    help="SQLite journal mode of the model database. In WAL mode, reads aren't "
+    "blocked while a scan or edit is being written",
+)
+p.add_argument(
+    "--db-synchronous",
+    type=str,
+    default="normal",
+    choices=["off", "normal", "full"],
+    help="How often SQLite waits for the model database to reach the disk",
+)
+p.add_argument(
+    "--db-mmap-size",
+    type=float,
+    default=256,
+    help="MiB of the model database SQLite reads through memory mapping",
+)
+p.add_argument(
+    "--db-cache-size",
+    type=float,
+    default=64,
+    help="MiB of page cache for each connection to the model database",
+)
+p.add_argument(
+    "--db-readers",
+    type=int,
+    default=4,
+    help="Number of connections kept open for reading the model database",
+)
+p.add_argument(
+    "--result-cache-size",
+    type=float,
+    default=32,
+    help="MiB of search results kept in memory for repeated requests, 0 to disable",
+)
+p.add_argument(
+    "--memory-index",
+    action="store_true",
+    help="Keep the model columns searches filter and sort by in memory, which "
+    "makes those searches much faster with many models (requires NumPy)",
+)
 
 
 def get_config(argv):
@@ -50,28 +138,3 @@ def try_load_image(file):
         return image.convert("RGB")
     except Exception as ex:
         return None
-
-
-def find_image(filepath, load=False):
-    path = os.path.dirname(filepath)
-    basename = os.path.splitext(os.path.basename(filepath))[0]
-
-    for s in [".preview.png", ".png"]:
-        file = os.path.join(path, basename + s)
-        if load:
-            image = try_load_image(file)
-            if image:
-                return image, file
-        elif os.path.isfile(file):
-            return None, file
-
-    for fname in os.listdir(path):
-        file = os.path.realpath(os.path.join(path, fname))
-        if basename in file:
-            if load:
-                image = try_load_image(file)
-                if image:
-                    return image, file
-            elif is_image_path(file):
-                return None, file
-    return None, None
@@ -0,0 +1,193 @@
+import os
+import json
+import sqlite3
+import threading
+
+from sd_model_manager.utils import safetensors_hack
+
+
+# Hashes kept for each file, in the order they're stored
+HASH_NAMES = ["sha256", "model_hash", "legacy_hash", "autov1", "autov2", "autov3"]
+HASH_COLUMNS = ", ".join(HASH_NAMES)
+
+# Bumped when the way hashes are computed changes, which forgets the stored
+# ones. 1: legacy hashes of files with non-ASCII metadata or large headers
+HASHES_VERSION = 1
+
+
+class HeaderCache:
+    """Remembers the safetensors headers read during scans, keyed by the
+    file's path, size and mtime, and the hashes computed for each file.
+
+    Lives in its own SQLite file next to the model database, so the model
+    database can be deleted and rebuilt without reading every header again,
+    which matters when the model paths are on a network share. Each thread
+    (and each scan worker process) gets its own connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS headers (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                metadata TEXT NOT NULL,
+                tensors TEXT
+            )"""
+        )
+        conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER,
+                {", ".join(name + " TEXT NOT NULL" for name in HASH_NAMES)}
+            )"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_hashes_size_mtime ON hashes (size, mtime_ns)"
+        )
+        if conn.execute("PRAGMA user_version").fetchone()[0] < HASHES_VERSION:
+            conn.execute("DELETE FROM hashes")
+            conn.execute(f"PRAGMA user_version = {HASHES_VERSION}")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS partial_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                partial_hash TEXT NOT NULL
+            )"""
+        )
+        conn.commit()
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def get(self, path, size, mtime_ns):
+        """Returns `(metadata, tensor_summary)` if the header of `path` was
+        cached while it had this size and mtime, else None."""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT metadata, tensors FROM headers "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]) if row[1] else None
+
+    def put(self, path, size, mtime_ns, metadata, tensor_summary):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+            (
+                path,
+                size,
+                mtime_ns,
+                json.dumps(metadata),
+                json.dumps(tensor_summary) if tensor_summary is not None else None,
+            ),
+        )
+        conn.commit()
+
+    def read_header(self, path, fingerprint=None):
+        """Like `safetensors_hack.read_header(path, tensors=True)`, but served
+        from the cache when the file is unchanged. `fingerprint` is the
+        `(size, mtime_ns, ...)` the caller already has from a stat, if any.
+
+        Returns `(metadata, tensor_summary, hit)`. Hits are reported rather
+        than counted here, since scan workers may run in other processes."""
+        if fingerprint is None:
+            st = os.stat(path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        else:
+            size, mtime_ns = fingerprint[0], fingerprint[1]
+
+        try:
+            cached = self.get(path, size, mtime_ns)
+        except sqlite3.Error:
+            cached = None
+        if cached is not None:
+            return cached[0], cached[1], True
+
+        metadata, tensor_summary = safetensors_hack.read_header(path, tensors=True)
+        try:
+            self.put(path, size, mtime_ns, metadata, tensor_summary)
+        except sqlite3.Error:
+            pass
+        return metadata, tensor_summary, False
+
+    def get_hashes(self, path, size, mtime_ns, inode=None):
+        """Returns the hashes stored for a file with this size and mtime at
+        `path`, or with the same inode elsewhere if it was moved, else None."""
+        row = (
+            self._connect()
+            .execute(
+                f"SELECT {HASH_COLUMNS} FROM hashes "
+                "WHERE size = ? AND mtime_ns = ? AND (path = ? OR inode = ?) "
+                "ORDER BY path = ? DESC LIMIT 1",
+                (size, mtime_ns, path, inode or None, path),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return dict(zip(HASH_NAMES, row))
+
+    def put_hashes(self, path, size, mtime_ns, inode, hashes):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO hashes "
+            f"(path, size, mtime_ns, inode, {HASH_COLUMNS}) "
+            f"VALUES (?, ?, ?, ?, {', '.join('?' * len(HASH_NAMES))})",
+            (path, size, mtime_ns, inode, *(hashes[name] for name in HASH_NAMES)),
+        )
+        conn.commit()
+
+    def get_partial_hash(self, path, size, mtime_ns):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT partial_hash FROM partial_hashes "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            )
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def put_partial_hash(self, path, size, mtime_ns, partial_hash):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO partial_hashes VALUES (?, ?, ?, ?)",
+            (path, size, mtime_ns, partial_hash),
+        )
+        conn.commit()
+
+    def entries(self):
+        return self._connect().execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+
+
+_caches = {}
+
+
+def get_cache(path):
+    """Returns the shared `HeaderCache` for the file at `path`. Scan workers
+    call this with the path they were given, so each process keeps one."""
+    cache = _caches.get(path)
+    if cache is None:
+        cache = _caches.setdefault(path, HeaderCache(path))
+    return cache
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A dict that forgets the least recently used entries once it holds
+    more than `max_entries` of them, or once the sizes given to `put` add up
+    to more than `max_bytes`. Either limit can be None for no limit, and a
+    `max_bytes` of 0 turns the cache off."""
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if self.max_entries == 0:
+            return
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while (
+            self.max_entries is not None and len(self.entries) > self.max_entries
+        ) or (self.max_bytes is not None and self.size > self.max_bytes):
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,137 @@
+import os
+import re
+from PIL import Image
+
+from sd_model_manager.utils.common import IMAGE_EXTS, try_load_image
+from sd_model_manager.utils.lru_cache import LRUCache
+
+
+re_preview_suffix = re.compile(r"\.preview(?:\.(\d+))?$", re.I)
+
+# Number of directory listings kept by `PreviewResolver`
+PREVIEW_LISTING_CACHE_SIZE = 1024
+
+
+def preview_key(filename):
+    """Returns `(stem, order)` if `filename` is named like a preview image of the
+    model called `stem`, or None if it isn't an image.
+
+    `model.png` comes first, followed by `model.preview.png`,
+    `model.preview.1.png`, `model.preview.2.png` and so on."""
+    name, ext = os.path.splitext(filename)
+    if ext.lower() not in IMAGE_EXTS:
+        return None
+
+    matches = re_preview_suffix.search(name)
+    if matches is None:
+        return name, 0
+    if matches[1] is None:
+        return name[: matches.start()], 1
+    return name[: matches.start()], int(matches[1]) + 1
+
+
+def group_preview_images(dirpath, filenames):
+    """Groups the image files among `filenames` by the model stem they're a
+    preview of."""
+    groups = {}
+    for filename in filenames:
+        key = preview_key(filename)
+        if key is None:
+            continue
+        stem, order = key
+        groups.setdefault(stem, []).append((order, filename))
+
+    return {
+        stem: [os.path.join(dirpath, filename) for _, filename in sorted(entries)]
+        for stem, entries in groups.items()
+    }
+
+
+def verify_image(path):
+    """Checks that an image's headers and chunks are intact without decoding
+    its pixels."""
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        return True
+    except Exception:
+        return False
+
+
+def model_stem(filepath):
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+
+class PreviewResolver:
+    """Finds preview images for models with one listing per directory.
+
+    Listings are cached until the directory's mtime changes, so looking up the
+    previews of every model in a folder costs one `os.listdir` in total. Only
+    the most recently used `max_entries` directories are kept."""
+
+    def __init__(self, max_entries=PREVIEW_LISTING_CACHE_SIZE):
+        self.listings = LRUCache(max_entries=max_entries)
+
+    def _listing(self, dirpath):
+        try:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            self.listings.pop(dirpath)
+            return {}, []
+
+        cached = self.listings.get(dirpath)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1], cached[2]
+
+        try:
+            filenames = os.listdir(dirpath)
+        except OSError:
+            return {}, []
+
+        groups = group_preview_images(dirpath, filenames)
+        images = [f for f in filenames if preview_key(f) is not None]
+        self.listings.put(dirpath, (mtime_ns, groups, images))
+        return groups, images
+
+    def candidates(self, filepath):
+        """Returns paths to images named after the model at `filepath`, followed
+        by any other image in its folder with the model's name in it."""
+        dirpath = os.path.dirname(filepath)
+        stem = model_stem(filepath)
+        groups, images = self._listing(dirpath)
+
+        result = list(groups.get(stem, []))
+        exact = set(result)
+        for filename in images:
+            path = os.path.join(dirpath, filename)
+            if stem in filename and path not in exact:
+                result.append(path)
+        return result
+
+    def find_preview_images(self, filepath):
+        """Returns the verified preview images named after the model at
+        `filepath`, as stored in the database."""
+        groups, _ = self._listing(os.path.dirname(filepath))
+        return check_preview_images(groups.get(model_stem(filepath), []))
+
+
+def check_preview_images(paths):
+    return [os.path.normpath(p) for p in paths if verify_image(p)]
+
+
+resolver = PreviewResolver()
+
+
+def find_preview_images(filepath):
+    return resolver.find_preview_images(filepath)
+
+
+def find_image(filepath, load=False):
+    for file in resolver.candidates(filepath):
+        if load:
+            image = try_load_image(file)
+            if image:
+                return image, file
+        elif os.path.isfile(file):
+            return None, file
+    return None, None
@@ -1,117 +1,415 @@
 import io
 import os
-import mmap
-import torch
+import re
 import json
 import hashlib
-import safetensors
-import safetensors.torch
+import numpy as np
 
-from sd_model_manager.models import sd_models
+try:
+    from ml_dtypes import bfloat16
+except ModuleNotFoundError:
+    # NumPy has no bfloat16, so keep the raw bytes in a 2-byte void dtype.
+    # The values can't be used for arithmetic, but hash and serialize the same.
+    bfloat16 = np.dtype("V2")
 
-# PyTorch 1.13 and later have _TypedStorage renamed to TypedStorage
-UntypedStorage = (
-    torch.storage.UntypedStorage
-    if hasattr(torch.storage, "UntypedStorage")
-    else torch.storage._UntypedStorage
-)
+
+# The safetensors format caps headers at 100MB
+MAX_HEADER_SIZE = 100 * 1024 * 1024
+
+re_dtype = re.compile(rb'"dtype"\s*:\s*"(\w+)"')
+re_data_offsets = re.compile(rb'"data_offsets"\s*:\s*\[\s*(\d+)\s*,\s*(\d+)\s*\]')
+re_metadata_key = re.compile(rb'"__metadata__"\s*:\s*')
+
+json_decoder = json.JSONDecoder()
+
+
+def read_at(file_obj, n, offset):
+    """Reads exactly `n` bytes at `offset` in one call where the OS allows it."""
+    if hasattr(os, "pread"):
+        data = os.pread(file_obj.fileno(), n, offset)
+    else:
+        file_obj.seek(offset)
+        data = file_obj.read(n)
+    if len(data) != n:
+        raise ValueError("Unexpected end of file")
+    return data
+
+
+def read_header_bytes(filename, max_header_size=MAX_HEADER_SIZE):
+    """Reads the raw JSON header of a .safetensors file with two reads, one for
+    the length prefix and one for the header itself."""
+    with open(filename, mode="rb", buffering=0) as file_obj:
+        n = int.from_bytes(read_at(file_obj, 8, 0), "little")
+        if n > max_header_size:
+            raise ValueError(f"Header is too large: {n} bytes")
+        return read_at(file_obj, n, 8)
+
+
+def parse_metadata(header):
+    """Returns `(metadata, (start, end))`, where the span is the position of
+    the `__metadata__` object in the header.
+
+    Only the metadata object is decoded, so the tensor descriptors, which can
+    number in the thousands, are skipped. Falls back to decoding the whole
+    header if the key can't be located unambiguously."""
+    matches = re_metadata_key.search(header)
+    if matches is not None and header.count(b'"__metadata__"') == 1:
+        text = header[matches.end() :].decode("utf-8")
+        try:
+            metadata, end = json_decoder.raw_decode(text)
+            if isinstance(metadata, dict):
+                end = matches.end() + len(text[:end].encode("utf-8"))
+                return metadata, (matches.start(), end)
+        except ValueError:
+            pass
+
+    return json.loads(header).get("__metadata__", {}), None
+
+
+def summarize_tensors(header, metadata_span=None):
+    """Summarizes the tensor descriptors in a header without building a dict
+    per tensor."""
+    if metadata_span is not None:
+        header = header[: metadata_span[0]] + header[metadata_span[1] :]
+
+    dtypes = {}
+    for dtype in re_dtype.findall(header):
+        dtype = dtype.decode("ascii")
+        dtypes[dtype] = dtypes.get(dtype, 0) + 1
+
+    count = 0
+    total_bytes = 0
+    for _, end in re_data_offsets.findall(header):
+        count += 1
+        total_bytes = max(total_bytes, int(end))
+
+    return {"count": count, "dtypes": dtypes, "total_bytes": total_bytes}
+
+
+def read_header(filename, tensors=False, max_header_size=MAX_HEADER_SIZE):
+    """Reads the `__metadata__` of a .safetensors file, and a summary of its
+    tensors if `tensors` is set. Returns `(metadata, summary)`."""
+    header = read_header_bytes(filename, max_header_size)
+    metadata, span = parse_metadata(header)
+
+    summary = None
+    if tensors:
+        summary = summarize_tensors(header, span)
+        summary["data_offset"] = len(header) + 8
+
+    return metadata, summary
 
 
 def read_metadata(filename):
     """Reads the JSON metadata from a .safetensors file"""
-    with open(filename, mode="r", encoding="utf8") as file_obj:
-        with mmap.mmap(file_obj.fileno(), length=0, access=mmap.ACCESS_READ) as m:
-            header = m.read(8)
-            n = int.from_bytes(header, "little")
-            metadata_bytes = m.read(n)
-            metadata = json.loads(metadata_bytes)
-
-    return metadata.get("__metadata__", {})
-
-
-def load_file(filename, device):
-    """ "Loads a .safetensors file without memory mapping that locks the model file.
-    Works around safetensors issue: https://github.com/huggingface/safetensors/issues/164"""
-    with open(filename, mode="r", encoding="utf8") as file_obj:
-        with mmap.mmap(file_obj.fileno(), length=0, access=mmap.ACCESS_READ) as m:
-            header = m.read(8)
-            n = int.from_bytes(header, "little")
-            metadata_bytes = m.read(n)
-            metadata = json.loads(metadata_bytes)
-
-    size = os.stat(filename).st_size
-    storage = UntypedStorage.from_file(filename, False, size)
-    offset = n + 8
-    md = metadata.get("__metadata__", {})
-    return {
-        name: create_tensor(storage, info, offset)
-        for name, info in metadata.items()
-        if name != "__metadata__"
-    }, md
+    return read_header(filename)[0]
 
 
-def hash_file(filename):
-    """Hashes a .safetensors file using the new hashing method.
-    Only hashes the weights of the model."""
-    hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+DTYPES = {
+    "BOOL": np.dtype(np.bool_),
+    "U8": np.dtype(np.uint8),
+    "I8": np.dtype(np.int8),
+    "I16": np.dtype("<i2"),
+    "U16": np.dtype("<u2"),
+    "F16": np.dtype("<f2"),
+    "BF16": np.dtype(bfloat16),
+    "I32": np.dtype("<i4"),
+    "U32": np.dtype("<u4"),
+    "F32": np.dtype("<f4"),
+    "F64": np.dtype("<f8"),
+    "I64": np.dtype("<i8"),
+    "U64": np.dtype("<u8"),
+}
 
-    with open(filename, mode="r", encoding="utf8") as file_obj:
-        with mmap.mmap(file_obj.fileno(), length=0, access=mmap.ACCESS_READ) as m:
-            header = m.read(8)
-            n = int.from_bytes(header, "little")
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
 
-    with open(filename, mode="rb") as file_obj:
-        offset = n + 8
-        file_obj.seek(offset)
-        for chunk in iter(lambda: file_obj.read(blksize), b""):
-            hash_sha256.update(chunk)
+# The order the safetensors serializer sorts tensors in, largest dtype first
+DTYPE_ORDER = list(DTYPES)
 
-    return hash_sha256.hexdigest()
 
+def load_file(filename, mmap=False):
+    """Loads the tensors of a .safetensors file as NumPy arrays.
 
-def legacy_hash_file(filename):
-    """Hashes a model file using the legacy `sd_models.model_hash()` method."""
-    hash_sha256 = hashlib.sha256()
+    By default the tensor data is read into memory with one read and the file
+    is closed again, so the model file isn't locked while the arrays are alive
+    (see https://github.com/huggingface/safetensors/issues/164). With `mmap`
+    set, the arrays are zero-copy views of a read-only memory map instead,
+    which keeps the file open until they're all released."""
+    header = read_header_bytes(filename)
+    tensors = json.loads(header)
+    metadata = tensors.pop("__metadata__", {})
+    offset = len(header) + 8
 
-    metadata = read_metadata(filename)
-
-    # For compatibility with legacy models: This replicates the behavior of
-    # sd_models.model_hash as if there were no user-specified metadata in the
-    # .safetensors file. That leaves the training parameters, which are
-    # immutable. It is important the hash does not include the embedded user
-    # metadata as that would mean the hash could change every time the user
-    # updates the name/description/etc. The new hashing method fixes this
-    # problem by only hashing the region of the file containing the tensors.
-    if any(not k.startswith("ss_") for k in metadata):
-        # Strip the user metadata, re-serialize the file as if it were freshly
-        # created from sd-scripts, and hash that with model_hash's behavior.
-        tensors, metadata = load_file(filename, "cpu")
-        metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
-        model_bytes = safetensors.torch.save(tensors, metadata)
-
-        hash_sha256.update(model_bytes[0x100000:0x110000])
-        return hash_sha256.hexdigest()[0:8]
+    if mmap:
+        data = np.memmap(filename, dtype=np.uint8, mode="r", offset=offset)
     else:
-        # This should work fine with model_hash since when the legacy hashing
-        # method was being used the user metadata system hadn't been implemented
-        # yet.
-        return sd_models.model_hash(filename)
-
+        with open(filename, mode="rb") as file_obj:
+            file_obj.seek(offset)
+            data = np.frombuffer(file_obj.read(), dtype=np.uint8)
 
-DTYPES = {"F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16}
+    return {name: create_tensor(data, info) for name, info in tensors.items()}, metadata
 
 
-def create_tensor(storage, info, offset):
-    """Creates a tensor without holding on to an open handle to the parent model
-    file."""
+def create_tensor(data, info):
+    """Returns a view of the bytes of one tensor in `data` with its dtype and
+    shape."""
     dtype = DTYPES[info["dtype"]]
-    shape = info["shape"]
     start, stop = info["data_offsets"]
-    return (
-        torch.asarray(storage[start + offset : stop + offset], dtype=torch.uint8)
-        .view(dtype=dtype)
-        .reshape(shape)
-        .clone()
-        .detach()
+    return data[start:stop].view(dtype).reshape(info["shape"])
+
+
+def serialize_header(tensors, metadata=None):
+    """Builds a .safetensors header the same way as the safetensors library
+    does: tensors sorted by dtype, largest first, then by name, and padded
+    with spaces to a multiple of 8. `tensors` maps each name to its
+    `(dtype, shape, nbytes)`.
+
+    Returns `(header_bytes, names)`, with the names in the order their data
+    follows the header.
+
+    The library writes the metadata keys in hash map order, which this can't
+    reproduce, but the header comes out the same length, so the tensor data
+    lands at the same offsets."""
+    names = sorted(
+        tensors, key=lambda name: (-DTYPE_ORDER.index(tensors[name][0]), name)
+    )
+
+    header = {}
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    offset = 0
+    for name in names:
+        dtype, shape, nbytes = tensors[name]
+        header[name] = {
+            "dtype": dtype,
+            "shape": list(shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+
+    # Non-ASCII text is written as UTF-8 rather than escaped, like the
+    # library does, since the header's length decides where the data goes
+    header_json = json.dumps(header, separators=(",", ":"), ensure_ascii=False)
+    header_bytes = header_json.encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    return header_bytes, names
+
+
+def save(tensors, metadata=None):
+    """Serializes NumPy arrays to .safetensors bytes."""
+    header_bytes, names = serialize_header(
+        {
+            name: (DTYPE_NAMES[tensor.dtype], tensor.shape, tensor.nbytes)
+            for name, tensor in tensors.items()
+        },
+        metadata,
+    )
+
+    buf = io.BytesIO()
+    buf.write(len(header_bytes).to_bytes(8, "little"))
+    buf.write(header_bytes)
+    for name in names:
+        buf.write(np.ascontiguousarray(tensors[name]).tobytes())
+    return buf.getvalue()
+
+
+# The window of the file hashed by the webui's old `model_hash()`
+LEGACY_HASH_OFFSET = 0x100000
+LEGACY_HASH_SIZE = 0x10000
+
+# Files are hashed in reads of this size, a multiple of the page size
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def legacy_hash_window(header):
+    """Works out where the bytes hashed by the legacy hash come from, without
+    loading the tensors.
+
+    Webui's old `model_hash()` hashed 64KiB at 1MiB into the file. For files
+    with user metadata, the legacy hash is taken over the file re-serialized
+    with only the `ss_` training metadata, so that editing the user metadata
+    doesn't change it. The re-serialized file only differs in its header, so
+    the window is found arithmetically from the new header's length and the
+    tensors' offsets.
+
+    Returns a list of pieces that are either literal header bytes or
+    `(offset, length)` ranges of the original file."""
+    tensors = json.loads(header)
+    metadata = tensors.pop("__metadata__", {})
+    if all(k.startswith("ss_") for k in metadata):
+        return [(LEGACY_HASH_OFFSET, LEGACY_HASH_SIZE)]
+
+    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    new_header, names = serialize_header(
+        {
+            name: (info["dtype"], info["shape"], stop - start)
+            for name, info in tensors.items()
+            for start, stop in (info["data_offsets"],)
+        },
+        metadata,
     )
+
+    data_offset = len(header) + 8
+    segments = [(0, len(new_header).to_bytes(8, "little") + new_header)]
+    position = len(new_header) + 8
+    for name in names:
+        start, stop = tensors[name]["data_offsets"]
+        segments.append((position, (data_offset + start, stop - start)))
+        position += stop - start
+
+    window_start = LEGACY_HASH_OFFSET
+    window_stop = LEGACY_HASH_OFFSET + LEGACY_HASH_SIZE
+    pieces = []
+    for position, segment in segments:
+        length = len(segment) if isinstance(segment, bytes) else segment[1]
+        lo = max(position, window_start)
+        hi = min(position + length, window_stop)
+        if lo >= hi:
+            continue
+        if isinstance(segment, bytes):
+            pieces.append(segment[lo - position : hi - position])
+        else:
+            pieces.append((segment[0] + lo - position, hi - lo))
+    return pieces
+
+
+class _Window:
+    """Collects the bytes of some ranges of a file as it streams past."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.buffers = [
+            piece if isinstance(piece, bytes) else bytearray() for piece in pieces
+        ]
+
+    def update(self, position, chunk):
+        end = position + len(chunk)
+        for piece, buf in zip(self.pieces, self.buffers):
+            if isinstance(piece, bytes):
+                continue
+            offset, length = piece
+            lo = max(offset + len(buf), position)
+            hi = min(offset + length, end)
+            if lo < hi:
+                buf += chunk[lo - position : hi - position]
+
+    def hexdigest(self):
+        hash_sha256 = hashlib.sha256()
+        for buf in self.buffers:
+            hash_sha256.update(buf)
+        return hash_sha256.hexdigest()
+
+
+def _fadvise(fd, advice):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+
+def hash_model(filename, block_size=HASH_BLOCK_SIZE, throttle=None):
+    """Computes every hash of a .safetensors file in one sequential read.
+
+    Returns a dict with:
+
+    - `sha256`: SHA-256 of the whole file
+    - `model_hash`: SHA-256 of the tensor data only (the `sshs_model_hash` of
+      sd-webui-additional-networks)
+    - `legacy_hash`: the legacy hash, see `legacy_hash_window`
+    - `autov1`: webui's old `model_hash()` of the file as it is
+    - `autov2`: the first 10 digits of `sha256`
+    - `autov3`: the first 12 digits of `model_hash`
+
+    If given, `throttle` is called with the size of each read before the next
+    one is made, and can block to limit the read rate."""
+    full = hashlib.sha256()
+    data = hashlib.sha256()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+
+    with open(filename, mode="rb", buffering=0) as file_obj:
+        fd = file_obj.fileno()
+        _fadvise(fd, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+
+        prefix = read_at(file_obj, 8, 0)
+        n = int.from_bytes(prefix, "little")
+        if n > MAX_HEADER_SIZE:
+            raise ValueError(f"Header is too large: {n} bytes")
+        data_offset = n + 8
+
+        # The header is read up front, since it says where the legacy hash's
+        # window is, and the window can come before the end of a large header
+        legacy = _Window(legacy_hash_window(read_at(file_obj, n, 8)))
+        file_obj.seek(0)
+
+        autov1 = _Window([(LEGACY_HASH_OFFSET, LEGACY_HASH_SIZE)])
+        position = 0
+        while True:
+            read = file_obj.readinto(buf)
+            if not read:
+                break
+            chunk = view[:read]
+            full.update(chunk)
+            autov1.update(position, chunk)
+
+            legacy.update(position, chunk)
+            if position + read > data_offset:
+                data.update(chunk[max(0, data_offset - position) :])
+
+            position += read
+            if throttle is not None:
+                throttle(read)
+
+        _fadvise(fd, getattr(os, "POSIX_FADV_DONTNEED", 0))
+
+    if position < data_offset:
+        raise ValueError("Unexpected end of file")
+
+    sha256 = full.hexdigest()
+    model_hash = data.hexdigest()
+    return {
+        "sha256": sha256,
+        "model_hash": model_hash,
+        "legacy_hash": legacy.hexdigest()[0:8],
+        "autov1": autov1.hexdigest()[0:8],
+        "autov2": sha256[0:10],
+        "autov3": model_hash[0:12],
+    }
+
+
+# Bytes hashed from each end of a file by `partial_hash`
+PARTIAL_HASH_SIZE = 1024 * 1024
+
+
+def partial_hash(filename, size=PARTIAL_HASH_SIZE):
+    """Hashes the header and the first and last `size` bytes of a file, along
+    with its length. Files that differ almost always differ here, so this
+    weeds out most false duplicates for the price of a couple of reads."""
+    hash_sha256 = hashlib.sha256()
+
+    with open(filename, mode="rb", buffering=0) as file_obj:
+        file_size = os.fstat(file_obj.fileno()).st_size
+        n = int.from_bytes(read_at(file_obj, 8, 0), "little")
+        if n > MAX_HEADER_SIZE:
+            raise ValueError(f"Header is too large: {n} bytes")
+
+        head = min(file_size, max(n + 8, size))
+        tail = min(file_size - head, size)
+        hash_sha256.update(file_size.to_bytes(8, "little"))
+        hash_sha256.update(read_at(file_obj, head, 0))
+        hash_sha256.update(read_at(file_obj, tail, file_size - tail))
+
+    return hash_sha256.hexdigest()
+
+
+def hash_file(filename):
+    """Hashes a .safetensors file using the new hashing method.
+    Only hashes the weights of the model."""
+    return hash_model(filename)["model_hash"]
+
+
+def legacy_hash_file(filename):
+    """Hashes a model file using the legacy `sd_models.model_hash()` method,
+    ignoring any user metadata."""
+    return hash_model(filename)["legacy_hash"]
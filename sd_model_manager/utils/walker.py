@@ -0,0 +1,92 @@
+import os
+
+
+MODEL_EXTENSIONS = (".safetensors",)
+
+
+def walk_models(root, dir_mtimes=None, extensions=MODEL_EXTENSIONS):
+    """Walks `root` for model files with os.scandir.
+
+    Yields `(dirpath, mtime_ns, files, filenames)` for every directory
+    reached, where `files` is a list of `(filepath, (size, mtime_ns, inode))`
+    pairs built from the stat results scandir already fetched, and
+    `filenames` holds the names of the other entries, so that sibling files
+    like preview images can be found without listing the directory again.
+
+    If `dir_mtimes` maps a directory to the mtime it had at the last scan and
+    that still matches, the directory isn't listed and `files` and
+    `filenames` are None. Its subdirectories are still walked, taken from
+    the other `dir_mtimes` keys, since a directory's mtime doesn't change
+    when its subdirectories do. Map a directory to None to have it listed
+    while still being found this way.
+
+    If a directory can't be read, everything but `dirpath` is None and
+    nothing beneath it is walked.
+
+    Symlinked directories and files are followed, but each inode is only
+    visited once, so link cycles terminate and a model reachable through
+    several links is only yielded once."""
+    dir_mtimes = dir_mtimes or {}
+
+    children = {}
+    for path in dir_mtimes:
+        children.setdefault(os.path.dirname(path), []).append(path)
+
+    visited_dirs = set()
+    visited_files = set()
+    stack = [os.path.normpath(root)]
+
+    while stack:
+        dirpath = stack.pop()
+
+        try:
+            st = os.stat(dirpath)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            yield dirpath, None, None, None
+            continue
+
+        key = (st.st_dev, st.st_ino)
+        if key in visited_dirs:
+            continue
+        visited_dirs.add(key)
+
+        if dir_mtimes.get(dirpath) == st.st_mtime_ns:
+            stack.extend(children.get(dirpath, []))
+            yield dirpath, st.st_mtime_ns, None, None
+            continue
+
+        files = []
+        filenames = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            stack.append(entry.path)
+                        elif (
+                            entry.name.lower().endswith(extensions) and entry.is_file()
+                        ):
+                            file_st = entry.stat()
+                            # DirEntry.stat() leaves st_ino zeroed on Windows
+                            inode = file_st.st_ino or entry.inode()
+                            file_key = (file_st.st_dev, inode)
+                            if file_key in visited_files:
+                                continue
+                            visited_files.add(file_key)
+                            files.append(
+                                (
+                                    entry.path,
+                                    (file_st.st_size, file_st.st_mtime_ns, inode),
+                                )
+                            )
+                        else:
+                            filenames.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            yield dirpath, None, None, None
+            continue
+
+        yield dirpath, st.st_mtime_ns, files, filenames
@@ -0,0 +1,190 @@
+import os
+import asyncio
+import traceback
+from aiohttp import web
+
+from sd_model_manager.utils.walker import walk_models
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ModuleNotFoundError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+# Wait this long after the last change before syncing, so that a burst of
+# events from one copy or move becomes one update
+DEBOUNCE_SECONDS = 0.25
+
+# ...but never hold changes back for longer than this while events keep coming
+MAX_DELAY_SECONDS = 1.0
+
+
+class ModelWatcher:
+    """Keeps the model database in step with the model paths while the server
+    runs.
+
+    Uses the native filesystem notifications (inotify on Linux) through
+    watchdog if it's installed, and otherwise polls the model paths, which is
+    also the only option that works reliably on network mounts. Changes are
+    debounced and handed to `DB.sync_paths` in batches."""
+
+    def __init__(self, db, paths, polling=False, interval=1.0):
+        self.db = db
+        self.paths = [os.path.normpath(p) for p in paths]
+        self.polling = polling or Observer is None
+        self.interval = interval
+
+        self.changed = set()
+        self.loop = None
+        self.wakeup = None
+        self.tasks = []
+        self.observer = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+
+        if self.polling:
+            print(f"Watching model paths by polling every {self.interval}s.")
+            self.tasks.append(asyncio.create_task(self._poll()))
+        else:
+            print("Watching model paths for changes.")
+            handler = _EventHandler(self)
+            self.observer = Observer()
+            for path in self.paths:
+                self.observer.schedule(handler, path, recursive=True)
+            self.observer.start()
+
+        self.tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            await self.loop.run_in_executor(None, self.observer.join)
+            self.observer = None
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self, path):
+        """Records a changed path. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._add_change, path)
+
+    def _add_change(self, path):
+        self.changed.add(path)
+        self.wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+
+            deadline = self.loop.time() + MAX_DELAY_SECONDS
+            while self.loop.time() < deadline:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), DEBOUNCE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+            self.wakeup.clear()
+
+            changed, self.changed = self.changed, set()
+            try:
+                await self.db.sync_paths(changed)
+            except Exception:
+                traceback.print_exc()
+
+    async def _poll(self):
+        """Diffs a walk of the model paths against the previous one. Unchanged
+        directories aren't listed again, so a poll with nothing to report
+        costs one stat per directory. Like an incremental scan, this can't
+        see a file being rewritten in place."""
+        dir_mtimes = {}
+        entries_by_dir = {}
+
+        def walk(initial):
+            changed = []
+            reached = set()
+            for path in self.paths:
+                for dirpath, mtime_ns, files, filenames in walk_models(
+                    path, dir_mtimes
+                ):
+                    if mtime_ns is None:
+                        continue
+                    reached.add(dirpath)
+                    if files is None:
+                        continue
+
+                    entries = dict(files)
+                    for filename in filenames:
+                        entries[os.path.join(dirpath, filename)] = None
+
+                    old_entries = entries_by_dir.get(dirpath, {})
+                    if not initial:
+                        for f in entries.keys() | old_entries.keys():
+                            if (
+                                f not in entries
+                                or f not in old_entries
+                                or entries[f] != old_entries[f]
+                            ):
+                                changed.append(f)
+
+                    entries_by_dir[dirpath] = entries
+                    dir_mtimes[dirpath] = mtime_ns
+
+            for dirpath in list(dir_mtimes):
+                if dirpath not in reached:
+                    changed.append(dirpath)
+                    del dir_mtimes[dirpath]
+                    entries_by_dir.pop(dirpath, None)
+
+            return changed
+
+        await self.loop.run_in_executor(None, walk, True)
+
+        while True:
+            await asyncio.sleep(self.interval)
+            for path in await self.loop.run_in_executor(None, walk, False):
+                self._add_change(path)
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        self.watcher.notify(event.src_path)
+        dest_path = getattr(event, "dest_path", None)
+        if dest_path:
+            self.watcher.notify(dest_path)
+
+
+def setup_watcher(app: web.Application) -> None:
+    """Starts watching the configured model paths alongside the app, if enabled
+    in the config."""
+
+    async def on_startup(app):
+        config = app["sdmm_config"]
+        if not config.watch:
+            return
+        watcher = ModelWatcher(
+            app["sdmm_db"],
+            config.model_paths,
+            polling=config.watch_polling,
+            interval=config.watch_interval,
+        )
+        watcher.start()
+        app["sdmm_watcher"] = watcher
+
+    async def on_cleanup(app):
+        watcher = app.get("sdmm_watcher")
+        if watcher is not None:
+            await watcher.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
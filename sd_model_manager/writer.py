@@ -0,0 +1,121 @@
+import asyncio
+import traceback
+
+
+# Most writes queued together that are committed in one transaction
+WRITE_BATCH_SIZE = 64
+
+
+class Writer:
+    """Runs every write to the model database in one task, so writers never
+    wait on each other's locks, and readers in WAL mode never wait on them at
+    all.
+
+    Writes are coroutine functions taking a session, queued with `submit`.
+    Whatever is queued by the time the writer gets to it is run as one
+    batch and committed together, each write in its own savepoint so that
+    one failing doesn't undo the others. Writes must not commit themselves.
+
+    If given, `on_commit` is a coroutine function run with the session after
+    each batch's writes, before they're committed. Whatever it returns is
+    called once they are."""
+
+    def __init__(self, Session, on_commit=None):
+        self.Session = Session
+        self.on_commit = on_commit
+        self.queue = None
+        self.task = None
+
+        self.writes = 0
+        self.batches = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Finishes the writes already queued, then stops."""
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def submit(self, write):
+        """Runs `await write(session)` on the writer, and returns its result
+        once it's committed."""
+        if self.task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((write, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            stopping = False
+            while len(batch) < WRITE_BATCH_SIZE and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._write(batch)
+            except Exception as e:
+                traceback.print_exc()
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+            if stopping:
+                return
+
+    async def _write(self, batch):
+        # Writes whose callers gave up before they started are dropped
+        batch = [(write, future) for write, future in batch if not future.done()]
+        if not batch:
+            return
+
+        results = []
+        async with self.Session() as session:
+            for write, future in batch:
+                try:
+                    async with session.begin_nested():
+                        result = await write(session)
+                except Exception as e:
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+            committed = None
+            if self.on_commit is not None:
+                committed = await self.on_commit(session)
+            await session.commit()
+
+        if committed is not None:
+            committed()
+
+        # Counted only once committed, since it doubles as the revision that
+        # cached reads are checked against
+        self.writes += len(batch)
+        self.batches += 1
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "writes": self.writes,
+            "batches": self.batches,
+        }